@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio engine to download bitmex's bucketed trades.
+
+It is an alternative to the blocking requests.Session of getBitMEXData.main.
+It uses the same queries and writes the same csv files, but one process can
+keep several requests in flight and drive many symbols and bin sizes at once.
+Needs aiohttp (pip install getBitMEXData[async]).
+"""
+
+from collections import deque
+from io import StringIO
+from pathlib import Path
+from time import perf_counter
+
+import asyncio
+import json
+import logging
+
+from pandas import Timedelta, Timestamp
+
+from getBitMEXData.cache import get_cache
+from getBitMEXData.decode import decode_page
+from getBitMEXData.journal import Journal
+from getBitMEXData.metrics import get_metrics
+
+from getBitMEXData.main import (
+    BUCKET_COLUMNS,
+    default_end_time,
+    reached,
+    write_response,
+)
+from getBitMEXData.profiling import phase
+from getBitMEXData.planner import page_query, plan_pages, plan_summary
+from getBitMEXData.ratelimit import get_limiter
+from getBitMEXData.retry import get_retrier
+from getBitMEXData.settings import (
+    BIN_SECONDS,
+    COUNT_DFT,
+    INFLIGHT_DFT,
+    PAUSE_DFT,
+    STRF,
+    TC,
+)
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency
+    aiohttp = None
+
+logger = logging.getLogger()
+
+
+def init_asession(name="foo", inflight: int = INFLIGHT_DFT):
+    """
+    Set an aiohttp session with name `foo`.
+
+    The connections are kept alive and reused, at most `inflight` are open.
+    Must be called from a running event loop.
+    """
+    if aiohttp is None:
+        raise ImportError("The asyncio engine needs aiohttp, pip install aiohttp.")
+
+    connector = aiohttp.TCPConnector(limit=inflight, keepalive_timeout=30)
+    headers = {
+        "user-agent": f"{name}-",
+        "content-type": "application/json",
+        "accept": "application/json",
+    }
+    timeout = aiohttp.ClientTimeout(total=10)
+    return aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout)
+
+
+def query_params(query):
+    """Return the query with values as strings, the way aiohttp wants them."""
+    return {
+        k: (v.isoformat() if isinstance(v, Timestamp) else str(v))
+        for (k, v) in query.items()
+    }
+
+
+async def amake_request(
+    query, sess, url, verb="GET", limiter=None, retrier=None, decode=None
+):
+    """
+    Make the request with query in the aiohttp session sess.
+
+    - decode : function of the response body returning the decoded response
+    (default the json records)
+    - limiter : RateLimiter updated with the response headers
+    (default the one shared by the process)
+    - retrier : Retrier deciding if a failed request is sent again
+    (default the one shared by the process)
+    A page in the cache of the process is read from it (see cache.py).
+    """
+    body = get_cache().get(url, query)
+    if body is not None:
+        with get_metrics().timer("decode_seconds"), phase("decode"):
+            return json.loads(body) if decode is None else decode(body)
+
+    limiter = get_limiter() if limiter is None else limiter
+    retrier = get_retrier() if retrier is None else retrier
+    breaker = retrier.breaker(url)
+    attempt = 0
+    while True:
+        try:
+            breaker.allow()
+            rep = await asend_request(query, sess, url, verb, limiter, decode)
+        except Exception as e:
+            delay = retrier.on_failure(e, attempt, url)
+            if delay is None:
+                raise
+            delay = max(delay, limiter.reserve())
+            get_metrics().inc("retries")
+            get_metrics().inc("backoff_seconds", delay)
+            with phase("sleep"):
+                await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            retrier.on_success(url)
+            return rep
+
+
+async def asend_request(query, sess, url, verb, limiter, decode=None):
+    """
+    Send the request once and return the decoded json response.
+
+    - decode : function of the response body returning the decoded response
+    (default the json records)
+    """
+    metrics = get_metrics()
+    try:
+        t0 = perf_counter()
+        async with sess.request(verb, url, params=query_params(query)) as resp:
+            with phase("request"):
+                content = await resp.read()
+            metrics.observe("request_seconds", perf_counter() - t0)
+            metrics.inc("requests")
+            metrics.inc("response_bytes", len(content))
+            limiter.update(resp.headers)
+            resp.raise_for_status()
+            with metrics.timer("decode_seconds"), phase("decode"):
+                rep = (
+                    await resp.json(content_type=None)
+                    if decode is None
+                    else decode(content)
+                )
+            logger.debug(f"Req: url={resp.url}, parms={query}, status={resp.status}")
+        get_cache().put(url, query, content)
+    except Exception:
+        metrics.inc("request_errors")
+        logger.exception(f"#### ERROR ####\nurl={url}, params={query}")
+        raise
+
+    return rep
+
+
+async def afetch_page(Q, page, sess, url, limiter, inflight, pause=0):
+    """
+    Fetch the records of a planned page and return them as csv text.
+
+    - page : a planner.Page
+    - limiter : RateLimiter shared by all the coroutines
+    - inflight : asyncio.Semaphore bounding the number of requests in flight
+    - pause : minimal time to wait before each request
+    """
+    query = page_query(Q, page)
+    binDelta = Timedelta(seconds=BIN_SECONDS[Q["binSize"]])
+    fd = StringIO()
+
+    while True:
+        async with inflight:
+            if not get_cache().serves(url, query):
+                wait = max(limiter.reserve(), pause)
+                get_metrics().inc("throttle_seconds", wait)
+                with phase("sleep"):
+                    await asyncio.sleep(wait)
+            rep = await amake_request(
+                query, sess, url, limiter=limiter, decode=decode_page
+            )
+        firstReqDate, lastReqDate = write_response(rep, query, fd, step=page.step)
+        get_metrics().inc("rows", len(rep))
+        # the server may send less than asked, we continue until the page end
+        if not len(rep) or reached(lastReqDate, page.endTime):
+            break
+        query["startTime"] = lastReqDate + binDelta
+
+    return fd.getvalue()
+
+
+async def aget_bucketed_trades(
+    url,
+    Q,
+    fout=None,
+    startTime=None,
+    endTime=None,
+    pause: float = PAUSE_DFT,
+    sess=None,
+    limiter=None,
+    inflight: int = INFLIGHT_DFT,
+    resume: bool = False,
+):
+    """
+    Async equivalent of main.get_bucketed_trades.
+
+    - url : live or test url
+    - Q : the query dict with keys binSize, partial, symbol, count and reverse
+    - fout : the name of the file to write to the results to
+    - startTime, endTime : bounds of the records to download.  If endTime is
+    None, up to the last bin closed (see main.default_end_time).
+    - sess : an aiohttp session to share, created if None
+    - pause : minimal time to wait before each request
+    - limiter : RateLimiter to wait for (default the one shared by the process)
+    - inflight : max number of requests in flight for this download.  At
+    most 2 * inflight pages are fetched ahead of the one written.
+    - resume : if True, continue after the last page confirmed in the
+    journal of fout
+    """
+    binSize = Q["binSize"]
+    if startTime is None:
+        startTime = Q["startTime"]
+    startTime = Timestamp(startTime).round(TC[binSize])
+    endTime = (
+        default_end_time(binSize).tz_localize(startTime.tz)
+        if endTime is None
+        else Timestamp(endTime)
+    )
+    fout = Path(
+        f"./{Q['symbol']}-{binSize}-{endTime.strftime(STRF)}.csv"
+        if fout is None
+        else fout
+    )
+    limiter = get_limiter() if limiter is None else limiter
+    journal = Journal(fout)
+    resuming = resume and journal.restore()
+    firstStep = 0
+    if resuming:
+        firstStep = journal.last["step"] + 1
+        startTime = journal.lastTime + Timedelta(seconds=BIN_SECONDS[binSize])
+        logger.warning(f"Resuming {fout} at step {firstStep} from {startTime}.")
+
+    pages = plan_pages(
+        startTime, endTime, binSize, Q.get("count", COUNT_DFT), firstStep
+    )
+    logger.warning(f"Plan for {fout}: {plan_summary(pages, limiter)}")
+    inflightSem = asyncio.Semaphore(inflight)
+
+    metrics, t0 = get_metrics(), perf_counter()
+    ownSession = sess is None
+    sess = init_asession(inflight=inflight) if ownSession else sess
+    # (page, task) fetched ahead, written in order as soon as the previous are
+    window = deque()
+
+    async def write_next(fd):
+        page, task = window.popleft()
+        data = await task
+        with metrics.timer("write_seconds"), phase("write"):
+            fd.write(data)
+            journal.record(page.step, page.startTime, page.endTime, fd)
+
+    try:
+        with open(fout, "a" if resuming else "w") as fd:
+            if not resuming:
+                journal.reset()
+            if not fd.tell():
+                # a new file, or the pages confirmed so far were all empty
+                fd.write(",".join(BUCKET_COLUMNS) + "\n")
+            for page in pages:
+                task = asyncio.ensure_future(
+                    afetch_page(Q, page, sess, url, limiter, inflightSem, pause=pause)
+                )
+                window.append((page, task))
+                if len(window) >= 2 * inflight:
+                    await write_next(fd)
+            while window:
+                await write_next(fd)
+    except BaseException:
+        for _, task in window:
+            task.cancel()
+        raise
+    finally:
+        if ownSession:
+            await sess.close()
+
+    metrics.inc("jobs")
+    metrics.inc("job_seconds", perf_counter() - t0)
+    logger.warning(f"Finished {len(pages)} pages for query={Q} in {fout}")
+    return fout
+
+
+async def aget_many(url, jobs, pause: float = PAUSE_DFT, inflight: int = INFLIGHT_DFT):
+    """
+    Run several downloads concurrently with one session.
+
+    The downloads are throttled by the rate limiter shared by the process.
+
+    - jobs : list of dicts of keyword arguments for aget_bucketed_trades
+    (Q, fout, startTime, endTime).
+    - inflight : max number of requests in flight for all the jobs
+    returns the list of output files.
+    """
+    sess = init_asession(inflight=inflight)
+    try:
+        return await asyncio.gather(
+            *(
+                aget_bucketed_trades(
+                    url, sess=sess, pause=pause, inflight=inflight, **job
+                )
+                for job in jobs
+            )
+        )
+    finally:
+        await sess.close()
+
+
+def get_many(url, jobs, pause: float = PAUSE_DFT, inflight: int = INFLIGHT_DFT):
+    """Blocking wrapper around aget_many."""
+    return asyncio.run(aget_many(url, jobs, pause=pause, inflight=inflight))
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Run many downloads (symbols, bin sizes, ranges) in one process.
+
+All the jobs go through one pooled session and the rate limiter of the
+process.  Their planned pages are dispatched to a pool of workers in a fair
+way: jobs of higher priority first and, for the same priority, one page of
+each job in turn, so a small job is not stuck behind a giant backfill.
+Each job writes its own file, in order, with its journal.
+
+The jobs are given in a json file, a list of objects with keys symbol,
+binSize and optionally startTime, endTime, fout and priority, or in a csv
+file with those columns.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from heapq import heappop, heappush
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+import argparse
+import csv
+import json
+import logging
+import sys
+
+from pandas import Timestamp
+
+from getBitMEXData.cache import cache_option
+from getBitMEXData.discovery import get_start_date
+from getBitMEXData.main import (
+    URLS,
+    PageWriter,
+    default_end_time,
+    init_session,
+    iter_pages,
+)
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.planner import plan_pages, plan_summary
+from getBitMEXData.ratelimit import get_limiter
+from getBitMEXData.settings import (
+    CACHE_DFT,
+    COUNT_DFT,
+    ENTRYPOINT_DFT,
+    FOLDER_DFT,
+    LOGLEVEL_DFT,
+    METRICS_DFT,
+    PAUSE_DFT,
+    STRF,
+    WORKERS_DFT,
+)
+
+logger = logging.getLogger()
+
+
+class Job(NamedTuple):
+    """A download: what to get, where to write it and its priority."""
+
+    symbol: str
+    binSize: str
+    startTime: Optional[Timestamp] = None
+    endTime: Optional[Timestamp] = None
+    fout: Optional[str] = None
+    priority: int = 0
+
+
+def load_jobs(fname) -> list:
+    """Return the jobs described in the json or csv file fname."""
+    with open(fname) as fd:
+        if Path(fname).suffix == ".csv":
+            rows = list(csv.DictReader(fd))
+        else:
+            rows = json.load(fd)
+
+    jobs = []
+    for row in rows:
+        # empty csv cells are missing values
+        row = {k: v for (k, v) in row.items() if v not in ("", None)}
+        for key in ("startTime", "endTime"):
+            if key in row:
+                row[key] = Timestamp(row[key])
+        if "priority" in row:
+            row["priority"] = int(row["priority"])
+        jobs.append(Job(**row))
+
+    return jobs
+
+
+class JobRun:
+    """The state of a job during a batch: its pages and its writer."""
+
+    def __init__(self, job: Job, url, sess, folder=FOLDER_DFT, resume=False):
+        """Plan the pages of the job and open its file."""
+        self.job = job
+        self.t0 = perf_counter()
+        startTime = job.startTime
+        if startTime is None:
+            startTime = get_start_date(url, job.symbol, job.binSize, sess)
+        endTime = default_end_time(job.binSize) if job.endTime is None else job.endTime
+        if startTime.tz is None:
+            startTime = startTime.tz_localize("UTC")
+        if endTime.tz is None:
+            endTime = endTime.tz_localize("UTC")
+        self.fout = (
+            Path(folder).joinpath(
+                f"{job.symbol}-{job.binSize}-{endTime.strftime(STRF)}.csv"
+            )
+            if job.fout is None
+            else Path(job.fout)
+        )
+
+        self.query = {
+            "binSize": job.binSize,
+            "count": COUNT_DFT,
+            "partial": "false",
+            "reverse": "false",
+            "symbol": job.symbol,
+        }
+        self.writer = PageWriter(self.fout, job.binSize, resume)
+        nextStart = (
+            startTime if self.writer.nextStart is None else self.writer.nextStart
+        )
+        # the newest bar stored
+        self.lastTime = None
+        if self.writer.nextStart is not None:
+            self.lastTime = self.writer.journal.lastTime
+        self.pages = plan_pages(
+            nextStart, endTime, job.binSize, COUNT_DFT, self.writer.firstStep
+        )
+        self.nextPage = 0  # next page to dispatch
+        self.nextStep = self.writer.firstStep  # next page to write
+        self.done = {}  # fetched pages waiting for the previous ones
+        self.error = None
+        logger.warning(f"Plan for {self.fout}: {plan_summary(self.pages)}")
+
+    @property
+    def pending(self) -> bool:
+        """True if some pages are still to dispatch."""
+        return self.error is None and self.nextPage < len(self.pages)
+
+    def dispatch(self):
+        """Return the next page to fetch."""
+        page = self.pages[self.nextPage]
+        self.nextPage += 1
+        return page
+
+    def deliver(self, page, responses):
+        """Receive the responses of page and write all the pages now in order."""
+        self.done[page.step] = responses
+        metrics = get_metrics()
+        while self.nextStep in self.done:
+            for step, query, rep in self.done.pop(self.nextStep):
+                with metrics.timer("write_seconds"):
+                    _, lastReqDate = self.writer.write(step, query, rep)
+                if len(rep):
+                    metrics.inc("rows", len(rep))
+                    self.lastTime = lastReqDate
+            self.nextStep += 1
+
+    def fail(self, exc):
+        """Stop the job on error."""
+        self.error = exc
+        self.done.clear()
+        logger.error(f"Job {self.job} failed: {exc!r}")
+
+    def close(self):
+        """Close the file of the job."""
+        self.writer.close()
+        metrics = get_metrics()
+        metrics.inc("jobs")
+        metrics.inc("job_seconds", perf_counter() - self.t0)
+        metrics.set_lag(self.lastTime, self.job.symbol, self.job.binSize)
+
+
+def run_batch(
+    url,
+    jobs,
+    workers: int = WORKERS_DFT,
+    pause: float = PAUSE_DFT,
+    folder=FOLDER_DFT,
+    resume: bool = False,
+):
+    """
+    Download all the jobs with workers threads, one session and one rate limit.
+
+    - url : live or test url of the trade/bucketed entry point
+    - jobs : list of Job
+    - pause : minimal time to wait before each request
+    - folder : where to write the jobs without fout
+    - resume : continue the jobs from their journal
+    Returns a dict {job: None or the exception that stopped it}.
+    """
+    auth = None
+    sess = init_session(pool=workers)
+    limiter = get_limiter()
+    runs = [JobRun(job, url, sess, folder, resume) for job in jobs]
+
+    # queue of runs with pages to dispatch, by priority then pages dispatched
+    seq = count()
+    queue = []
+    for run in runs:
+        if run.pending:
+            heappush(queue, (-run.job.priority, 0, next(seq), run))
+
+    def fetch(run, page):
+        return list(iter_pages(run.query, [page], sess, auth, url, pause))
+
+    inflight = {}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        while queue or inflight:
+            # keep each worker busy with one page and one page ahead
+            while queue and len(inflight) < 2 * workers:
+                prio, served, _, run = heappop(queue)
+                if not run.pending:
+                    continue
+                page = run.dispatch()
+                inflight[ex.submit(fetch, run, page)] = (run, page)
+                if run.pending:
+                    heappush(queue, (prio, served + 1, next(seq), run))
+
+            finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                run, page = inflight.pop(future)
+                if run.error is not None:
+                    continue
+                try:
+                    run.deliver(page, future.result())
+                except Exception as e:
+                    run.fail(e)
+
+    for run in runs:
+        run.close()
+        status = "failed" if run.error else "done"
+        logger.warning(f"{run.fout}: {status}, {run.writer.nreq} requests.")
+
+    logger.warning(f"Batch finished, rate limiter at {limiter.tokens:.0f} tokens.")
+    return {run.job: run.error for run in runs}
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("jobs", help="json or csv file describing the jobs")
+    parser.add_argument(
+        "--folder",
+        "-f",
+        help="folder for the jobs without fout",
+        default=FOLDER_DFT,
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="Number of concurrent requests for all the jobs",
+        default=WORKERS_DFT,
+    )
+    parser.add_argument(
+        "--pause",
+        "-p",
+        type=float,
+        help="Minimun waiting time between 2 requests of a worker",
+        default=PAUSE_DFT,
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        action="store_true",
+        help="If present, continue the jobs from their journal",
+    )
+    parser.add_argument(
+        "--live",
+        "-l",
+        action="store_true",
+        help="If present use LIVE keys else bitmex testnet.",
+    )
+    parser.add_argument(
+        "--entryPoint",
+        "-E",
+        help="Set the path to append to the LIVE or TEST url before the query.",
+        default=ENTRYPOINT_DFT,
+    )
+    parser.add_argument(
+        "--metrics",
+        "-M",
+        help=(
+            "File where to write the metrics of the batch: a Prometheus"
+            " textfile if it ends with .prom, else a json line is appended"
+        ),
+        default=METRICS_DFT,
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=True,
+        help=(
+            "Keep the pages of closed bins in a folder and read them from"
+            " there instead of requesting them again (default folder"
+            " ~/.cache/getBitMEXData/pages)"
+        ),
+        default=CACHE_DFT,
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="If present, read the pages from the cache only, send no request.",
+    )
+    parser.add_argument(
+        "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
+    )
+    return parser.parse_args()
+
+
+def main_prg():
+    """Run the jobs of the file given on the command line."""
+    args = parse_args()
+    logger.setLevel(args.logLevel)
+    cache_option(args.cache, args.offline)
+    jobs = load_jobs(args.jobs)
+    try:
+        results = run_batch(
+            f"{URLS[args.live]}{args.entryPoint}",
+            jobs,
+            workers=args.workers,
+            pause=args.pause,
+            folder=args.folder,
+            resume=args.resume,
+        )
+    finally:
+        if args.metrics:
+            get_metrics().export(args.metrics)
+    return any(results.values())
+
+
+if __name__ == "__main__":
+    sys.exit(main_prg())
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the download engines offline, against the mock bitmex server.
+
+A mock server (see mockserver.py) is started in its own process, then each
+engine downloads the same range in a fresh process so that its cpu time and
+its peak memory are its own.  For each engine it reports the pages and rows
+per second, the cpu time per row, the peak RSS, the time the rate limiter
+asked to wait and the backoff of the retries.
+
+Engines:
+- make_request : the planned pages with make_request, nothing written
+- request_write_nlog : the planned pages written one by one
+- sequential : get_bucketed_trades without prefetch nor workers
+- prefetch : get_bucketed_trades with a prefetch thread
+- workers : get_bucketed_trades with --workers threads
+- stream : iter_bucketed_trades, the pages are only consumed
+- async : aio.get_many with --workers requests in flight (needs aiohttp)
+
+python -m getBitMEXData.bench --binSize 1m --latency 0.02
+"""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from urllib.request import urlopen
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+
+from pandas import Timestamp
+
+from getBitMEXData.settings import LOGLEVEL_DFT, PREFETCH_DFT
+
+logger = logging.getLogger()
+
+ENGINES = (
+    "make_request",
+    "request_write_nlog",
+    "sequential",
+    "prefetch",
+    "workers",
+    "stream",
+    "async",
+)
+
+
+def run_engine(engine, url, Q, startTime, endTime, fout, workers):
+    """Download Q from startTime to endTime with engine, in this process."""
+    from getBitMEXData import main
+
+    startTime, endTime = Timestamp(startTime), Timestamp(endTime)
+    if engine in ("make_request", "request_write_nlog"):
+        from getBitMEXData.planner import page_query, plan_pages
+
+        sess = main.init_session()
+        plan = plan_pages(startTime, endTime, Q["binSize"], Q["count"])
+        with open(fout, "w") as fd:
+            for page in plan:
+                query = page_query(Q, page)
+                if engine == "make_request":
+                    main.make_request(query, sess, None, url)
+                else:
+                    main.request_write_nlog(
+                        query, sess, None, url, fd, header=not page.step, step=page.step
+                    )
+    elif engine == "stream":
+        for _ in main.iter_bucketed_trades(url, dict(Q), startTime, endTime):
+            pass
+    elif engine == "async":
+        from getBitMEXData.aio import get_many
+
+        job = {"Q": dict(Q), "fout": fout, "startTime": startTime, "endTime": endTime}
+        get_many(url, [job], inflight=workers)
+    else:
+        kwargs = {
+            "sequential": {"workers": 1, "prefetch": 0},
+            "prefetch": {"workers": 1, "prefetch": PREFETCH_DFT},
+            "workers": {"workers": workers, "prefetch": PREFETCH_DFT},
+        }[engine]
+        main.get_bucketed_trades(
+            url, dict(Q), fout, startTime, endTime, pause=0, **kwargs
+        )
+
+
+def measure(engine, url, Q, startTime, endTime, fout, workers) -> dict:
+    """Run the engine in this process and return its wall and cpu times, RSS and waits."""
+    from getBitMEXData.ratelimit import get_limiter
+    from getBitMEXData.retry import get_retrier
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = perf_counter()
+    run_engine(engine, url, Q, startTime, endTime, fout, workers)
+    wall = perf_counter() - t0
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "wall": wall,
+        "cpu": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        # in KB on linux
+        "rss": after.ru_maxrss * 1024,
+        "throttled": get_limiter().waited,
+        "backoff": get_retrier().stats["backoff"],
+        "retries": get_retrier().stats["retries"],
+    }
+
+
+def server_stats(url) -> dict:
+    """Return the counters of the mock server at url."""
+    with urlopen(f"{url}stats") as rep:
+        return json.load(rep)
+
+
+def bench(engine, url, args, folder) -> dict:
+    """Run engine in a new process and return its metrics."""
+    cmd = [
+        sys.executable,
+        "-m",
+        "getBitMEXData.bench",
+        "--run",
+        engine,
+        "--url",
+        url,
+        "--binSize",
+        args.binSize,
+        "--startTime",
+        args.startTime,
+        "--endTime",
+        args.endTime,
+        "--count",
+        str(args.count),
+        "--workers",
+        str(args.workers),
+        "--folder",
+        str(folder),
+    ]
+    before = server_stats(url)
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    after = server_stats(url)
+    metrics = json.loads(out.decode().strip().splitlines()[-1])
+
+    served = {k: after[k] - before[k] for k in after}
+    pages = served["requests"] - served["errors"]
+    rows = served["rows"]
+    return {
+        "engine": engine,
+        "pages": pages,
+        "rows": rows,
+        "errors": served["errors"],
+        "wall": metrics["wall"],
+        "pages/s": pages / metrics["wall"],
+        "rows/s": rows / metrics["wall"],
+        "cpu us/row": 1e6 * metrics["cpu"] / max(rows, 1),
+        "peak MB": metrics["rss"] / 2**20,
+        "throttled": metrics["throttled"],
+        "backoff": metrics["backoff"],
+    }
+
+
+def print_table(results):
+    """Print the metrics of the engines."""
+    columns = list(results[0])
+    print(" ".join(f"{c:>18}" for c in columns))
+    for result in results:
+        cells = (
+            f"{v:>18.2f}" if isinstance(v, float) else f"{v:>18}"
+            for v in result.values()
+        )
+        print(" ".join(cells))
+
+
+def start_mock(args):
+    """Start the mock server in a new process and return it and its url."""
+    cmd = [
+        sys.executable,
+        "-m",
+        "getBitMEXData.mockserver",
+        "--port",
+        str(args.port),
+        "--latency",
+        str(args.latency),
+        "--limit",
+        str(args.limit),
+        "--errors",
+        str(args.errors),
+    ]
+    if args.recorded:
+        cmd += ["--recorded", args.recorded]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    # it prints its url when ready
+    line = proc.stdout.readline().decode()
+    return proc, line.split()[-1].rsplit("trade/bucketed", 1)[0]
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=ENGINES,
+        default=[e for e in ENGINES if e != "async"],
+    )
+    parser.add_argument("--binSize", "-b", default="1m")
+    parser.add_argument("--startTime", "-s", default="2020-01-01 00:00+00:00")
+    parser.add_argument("--endTime", "-e", default="2020-01-15 00:00+00:00")
+    parser.add_argument("--count", "-c", type=int, default=1000)
+    parser.add_argument("--workers", "-w", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=100000,
+        help="Requests per minute allowed by the mock, lower it to measure throttling",
+    )
+    parser.add_argument("--errors", type=float, default=0.0)
+    parser.add_argument("--recorded", help="csv file of the candles to serve")
+    parser.add_argument("--json", help="file where to write the results")
+    # to run one engine, in the processes started by the benchmark
+    parser.add_argument("--run", choices=ENGINES, help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("--folder", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
+    )
+    return parser.parse_args()
+
+
+def main_prg():
+    """Run the benchmark, or one engine with --run."""
+    args = parse_args()
+    logger.setLevel(args.logLevel)
+    Q = {
+        "binSize": args.binSize,
+        "count": args.count,
+        "partial": "false",
+        "reverse": "false",
+        "symbol": "XBTUSD",
+    }
+
+    if args.run:
+        url = f"{args.url}trade/bucketed"
+        fout = Path(args.folder).joinpath(f"{args.run}.csv")
+        metrics = measure(
+            args.run, url, Q, args.startTime, args.endTime, fout, args.workers
+        )
+        print(json.dumps(metrics))
+        return
+
+    proc, url = start_mock(args)
+    try:
+        with TemporaryDirectory() as folder:
+            results = [bench(engine, url, args, folder) for engine in args.engines]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(results, fd, indent=1)
+
+
+if __name__ == "__main__":
+    main_prg()
+    sys.exit()
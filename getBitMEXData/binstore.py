@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed width binary storage of the candles, read by memory mapping.
+
+Bucketed candles sit on a regular grid, so the row of a candle follows from
+its timestamp: row = (timestamp - start) / binSize.  A binary file is a
+header of HEADER_SIZE bytes (magic and json with the symbol, bin size, start
+time and dtype of the rows) followed by the rows, a numpy structured array
+without the timestamp and the symbol.  Bins without a candle are rows with
+nan prices.
+
+Reading maps the file in memory: a time range is a slice of the array, a
+view without copy nor parsing.  Writing puts each page at its place in the
+grid, so writing a page twice is harmless.
+"""
+
+from pathlib import Path
+
+import json
+import logging
+import os
+
+import numpy as np
+from pandas import Timedelta, Timestamp
+
+from getBitMEXData.decode import BUCKET_SCHEMA, ColumnBatch, decode_records
+from getBitMEXData.settings import BIN_SECONDS, BINARY_EXT, STRF
+
+logger = logging.getLogger()
+
+MAGIC = b"BTXBIN1\n"
+HEADER_SIZE = 4096
+
+# the rows, little endian, in the order of the records
+ROW_DTYPE = np.dtype(
+    [
+        (name, np.dtype(dtype).newbyteorder("<"))
+        for (name, dtype) in BUCKET_SCHEMA.items()
+        if name not in ("timestamp", "symbol")
+    ]
+)
+
+
+def binary_path(folder, symbol, binSize) -> Path:
+    """Return the path of the binary file of symbol in binSize in folder."""
+    return Path(folder).joinpath(f"{symbol}-{binSize}{BINARY_EXT}")
+
+
+def empty_rows(n, dtype=ROW_DTYPE) -> np.ndarray:
+    """Return n rows of missing candles: nan floats and 0 integers."""
+    rows = np.zeros(n, dtype=dtype)
+    for name in dtype.names:
+        if dtype[name].kind == "f":
+            rows[name] = np.nan
+    return rows
+
+
+class BinFile:
+    """A binary candles file, see the module doc."""
+
+    def __init__(self, path):
+        """Init the file at path, reading its header if it exists."""
+        self.path = Path(path)
+        self.symbol, self.binSize, self.start = None, None, None
+        self.dtype = ROW_DTYPE
+        if self.path.exists():
+            self.read_header()
+
+    def read_header(self):
+        """Set the symbol, bin size, start and dtype of the file from its header."""
+        with open(self.path, "rb") as fd:
+            head = fd.read(HEADER_SIZE)
+        if not head.startswith(MAGIC):
+            raise ValueError(f"{self.path} is not a binary candles file.")
+        header = json.loads(head[len(MAGIC) :].rstrip(b"\0 "))
+        self.symbol, self.binSize = header["symbol"], header["binSize"]
+        self.start = Timestamp(header["start"])
+        self.dtype = np.dtype([tuple(field) for field in header["dtype"]])
+
+    def create(self, symbol, binSize, start):
+        """Create an empty file for symbol's candles of binSize from start."""
+        self.symbol, self.binSize = symbol, binSize
+        self.start = Timestamp(start)
+        header = {
+            "symbol": symbol,
+            "binSize": binSize,
+            "start": self.start.isoformat(),
+            "dtype": self.dtype.descr,
+        }
+        head = MAGIC + json.dumps(header).encode()
+        assert len(head) <= HEADER_SIZE, f"Header too long {header}"
+        with open(self.path, "wb") as fd:
+            fd.write(head.ljust(HEADER_SIZE, b"\0"))
+
+    @property
+    def binDelta(self) -> Timedelta:
+        return Timedelta(seconds=BIN_SECONDS[self.binSize])
+
+    def __len__(self):
+        """Number of rows in the file."""
+        if not self.path.exists():
+            return 0
+        return (self.path.stat().st_size - HEADER_SIZE) // self.dtype.itemsize
+
+    def localize(self, timestamp) -> Timestamp:
+        """Return timestamp in the time zone of the file if it is naive."""
+        timestamp = Timestamp(timestamp)
+        if timestamp.tz is None:
+            timestamp = timestamp.tz_localize(self.start.tz)
+        return timestamp
+
+    def row_of(self, timestamp) -> int:
+        """Return the row of the bin at or after timestamp (may be out of the file)."""
+        return -((self.start - self.localize(timestamp)) // self.binDelta)
+
+    def timestamp_of(self, row) -> Timestamp:
+        """Return the timestamp of the bin of row."""
+        return self.start + row * self.binDelta
+
+    def last_timestamp(self):
+        """Return the timestamp of the last candle or None."""
+        n = len(self)
+        return None if not n else self.timestamp_of(n - 1)
+
+    def mmap(self) -> np.ndarray:
+        """Return all the rows, mapped read only."""
+        if not len(self):
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(
+            self.path, dtype=self.dtype, mode="r", offset=HEADER_SIZE, shape=len(self)
+        )
+
+    def slice(self, startTime=None, endTime=None):
+        """
+        Return the rows of the bins between startTime and endTime (included).
+
+        Returns the timestamp of the first row and a view of the mapped file.
+        """
+        rows = self.mmap()
+        first = 0 if startTime is None else max(self.row_of(startTime), 0)
+        last = len(rows) if endTime is None else self.row_of(endTime) + 1
+        if endTime is not None and self.timestamp_of(last - 1) > self.localize(endTime):
+            # endTime is between two bins
+            last -= 1
+        return self.timestamp_of(first), rows[first : max(last, first)]
+
+    def read(self, startTime=None, endTime=None, dropna=True):
+        """
+        Return the candles between startTime and endTime in a DataFrame.
+
+        The DataFrame is indexed by timestamp and has a symbol column.
+        - dropna : if True, the bins without candle are dropped
+        """
+        from pandas import DataFrame, date_range
+
+        first, rows = self.slice(startTime, endTime)
+        index = date_range(first, periods=len(rows), freq=self.binDelta)
+        df = DataFrame(rows, index=index)
+        df.index.name = "timestamp"
+        if dropna:
+            df = df.loc[df.close.notna()]
+        df.insert(0, "symbol", self.symbol)
+        return df
+
+    def rows_of(self, batch: ColumnBatch):
+        """Return the first row of batch and its candles as a block of rows."""
+        start = self.start.value
+        binNs = self.binDelta.value
+        positions = (batch.columns["timestamp"] - start) // binNs
+        block = empty_rows(positions[-1] - positions[0] + 1, self.dtype)
+        offsets = positions - positions[0]
+        for name in self.dtype.names:
+            values = batch.columns[name]
+            if self.dtype[name].kind == "i" and values.dtype.kind == "f":
+                # nulls in an int column
+                values = np.nan_to_num(values)
+            block[name][offsets] = values
+        return int(positions[0]), block
+
+    def write(self, batch: ColumnBatch, fd):
+        """
+        Write the candles of batch at their rows with fd, open on the file.
+
+        The bins between the end of the file and the batch are filled with
+        missing candles.
+        """
+        if self.start is None:
+            raise ValueError(f"Create {self.path} before writing in it.")
+        if batch.symbol != self.symbol:
+            raise ValueError(f"Got {batch.symbol} candles for {self.path}.")
+        firstRow, block = self.rows_of(batch)
+        if firstRow < 0:
+            raise ValueError(
+                f"Candles from {batch.first} are before the start of {self.path}."
+            )
+
+        n = len(self)
+        if firstRow > n:
+            fd.seek(HEADER_SIZE + n * self.dtype.itemsize)
+            fd.write(empty_rows(firstRow - n, self.dtype).tobytes())
+        fd.seek(HEADER_SIZE + firstRow * self.dtype.itemsize)
+        fd.write(block.tobytes())
+        fd.flush()
+
+    def writer(self, resume=False):
+        """Return a BinWriter of the pages of a download in the file."""
+        return BinWriter(self, resume)
+
+
+class BinWriter:
+    """
+    Write the pages of a download in a BinFile, like main.PageWriter.
+
+    If the file does not exist, it is created for the first candle written.
+    If resume and the file has candles, the download continues after the
+    last one (`nextStart`), else `nextStart` is None.
+    """
+
+    def __init__(self, binFile: BinFile, resume=False):
+        """Prepare to write in binFile."""
+        self.binFile = binFile
+        self.firstStep, self.nextStart = 0, None
+        lastTime = binFile.last_timestamp() if resume else None
+        self.resuming = lastTime is not None
+        if self.resuming:
+            self.nextStart = lastTime + binFile.binDelta
+            logger.warning(f"Resuming {binFile.path} from {self.nextStart}.")
+        self.nreq = 0
+        self.fd = None
+
+    def write(self, step, query, rep):
+        """Write the response rep to query, the page step, at its place."""
+        batch = rep if isinstance(rep, ColumnBatch) else decode_records(rep)
+        if len(batch):
+            firstReqDate, lastReqDate = batch.first, batch.last
+            if self.binFile.start is None:
+                self.binFile.create(batch.symbol, query["binSize"], firstReqDate)
+            if self.fd is None:
+                self.fd = open(self.binFile.path, "r+b")
+            self.binFile.write(batch, self.fd)
+        else:
+            # imported here, main uses this module
+            from getBitMEXData.main import response_window
+
+            firstReqDate, lastReqDate = response_window(rep, query)
+
+        if not self.nreq:
+            logger.info(f"{firstReqDate.strftime(STRF)}:{lastReqDate.strftime(STRF)}")
+        self.nreq += 1
+        return firstReqDate, lastReqDate
+
+    def close(self):
+        """Sync and close the file."""
+        if self.fd is not None:
+            os.fsync(self.fd.fileno())
+            self.fd.close()
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
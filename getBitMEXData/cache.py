@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+On disk cache of the pages of closed bins (--cache and --offline options).
+
+With partial=false, the bins of a page never change once its whole window
+is in the past.  Such pages are kept in a folder, one file per request named
+by the sha256 of the url and of the canonical query (keys sorted, times in
+UTC iso format), so that downloading the same range again, rebuilding a
+dataset or re-running a failed job costs no request nor rate limit budget.
+A page whose window may still get bins (or partial ones) is never cached.
+
+The raw response body is stored and decoded again on a hit, so a page read
+from the cache goes through the same decoding as a fresh one.  The cache is
+bounded in size: the files read least recently (their mtime is set on each
+hit) are removed first.  In offline mode the requests not in the cache fail
+with CacheMiss instead of being sent, eg. to replay recorded data in tests.
+
+Only the standard library is used, core.py relies on it.
+"""
+
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock, get_ident
+
+import json
+import logging
+import os
+
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.settings import (
+    BIN_SECONDS,
+    CACHE_DIR,
+    CACHE_SIZE_DFT,
+    COUNT_SERVER_DFT,
+)
+
+logger = logging.getLogger()
+
+
+class CacheMiss(LookupError):
+    """A request not in the cache, in offline mode."""
+
+
+def cache_folder() -> Path:
+    """Return the default folder of the cached pages."""
+    cacheHome = os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache"))
+    return Path(cacheHome).joinpath(CACHE_DIR)
+
+
+def utc_time(value) -> datetime:
+    """Return value, a datetime or an iso string, as an UTC datetime."""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value).strip())
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def canonical_query(query) -> dict:
+    """Return the query with sorted keys, string values and UTC iso times."""
+    canonical = {}
+    for key in sorted(query):
+        value = query[key]
+        if value is None:
+            # not sent
+            continue
+        if key.endswith("Time"):
+            value = utc_time(value).isoformat()
+        canonical[key] = str(value)
+    return canonical
+
+
+def page_key(url, query) -> str:
+    """Return the key of the response to query on url."""
+    text = json.dumps([str(url), canonical_query(query)], separators=(",", ":"))
+    return sha256(text.encode()).hexdigest()
+
+
+def window_end(query):
+    """
+    Return the time of the last bin the query may get, or None if unknown.
+
+    Only trade/bucketed queries (with a binSize) have a known window.
+    """
+    if query.get("binSize") not in BIN_SECONDS:
+        return None
+    binDelta = timedelta(seconds=BIN_SECONDS[query["binSize"]])
+    startTime, endTime = query.get("startTime"), query.get("endTime")
+    endTime = None if endTime is None else utc_time(endTime)
+    if str(query.get("reverse", "false")).lower() == "true":
+        # the last bins before endTime
+        return endTime
+    if startTime is None:
+        return None
+    count = int(query.get("count", COUNT_SERVER_DFT))
+    end = utc_time(startTime) + count * binDelta
+    return end if endTime is None else min(end, endTime)
+
+
+def is_closed(query, now=None) -> bool:
+    """True if all the bins of the query's window are closed, so won't change."""
+    if str(query.get("partial", "false")).lower() != "false":
+        return False
+    end = window_end(query)
+    if end is None:
+        return False
+    now = datetime.now(timezone.utc) if now is None else now
+    # one more bin for the last one to be closed and published
+    return end + timedelta(seconds=BIN_SECONDS[query["binSize"]]) < now
+
+
+class PageCache:
+    """Pages of closed windows in folder, see the module doc."""
+
+    def __init__(self, folder=None, maxSize=CACHE_SIZE_DFT, offline=False):
+        """Init the cache, disabled while folder is None, see configure."""
+        self._lock = Lock()
+        self.configure(folder, maxSize, offline)
+
+    def configure(self, folder=None, maxSize=CACHE_SIZE_DFT, offline=False):
+        """
+        Set the folder of the pages, None to disable the cache.
+
+        - maxSize : bytes of the pages kept, the least recently read are
+        removed beyond
+        - offline : if True, serve only the pages in the cache
+        """
+        with self._lock:
+            self.folder = None if folder is None else Path(folder)
+            self.maxSize = maxSize
+            self.offline = offline
+            # bytes in folder, counted on the first write
+            self.size = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.folder is not None
+
+    def path(self, url, query) -> Path:
+        key = page_key(url, query)
+        return self.folder.joinpath(key[:2], key)
+
+    def serves(self, url, query) -> bool:
+        """True if the request won't be sent: in the cache or offline."""
+        if not self.enabled:
+            return False
+        return self.offline or self.path(url, query).exists()
+
+    def get(self, url, query):
+        """
+        Return the cached body of the response to query or None.
+
+        Raises CacheMiss if the cache is offline and the page is not in it.
+        """
+        if not self.enabled:
+            return None
+        path = self.path(url, query)
+        try:
+            body = path.read_bytes()
+        except FileNotFoundError:
+            get_metrics().inc("cache_misses")
+            if self.offline:
+                raise CacheMiss(f"Not in the cache {self.folder}: {url} {query}")
+            return None
+        # most recently used
+        os.utime(path)
+        get_metrics().inc("cache_hits")
+        logger.debug(f"Cache hit: url={url}, parms={query}")
+        return body
+
+    def put(self, url, query, body):
+        """Store the body of the response to query if its window is closed."""
+        if not self.enabled or not is_closed(query):
+            return
+        path = self.path(url, query)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.tmp")
+        tmp.write_bytes(body)
+        os.replace(tmp, path)
+        with self._lock:
+            if self.size is None:
+                self.size = self.disk_usage()
+            else:
+                self.size += len(body)
+            if self.size > self.maxSize:
+                self.evict()
+
+    def files(self):
+        """Return the cached files with their stat."""
+        files = []
+        for path in self.folder.glob("??/*"):
+            try:
+                if not path.name.endswith(".tmp"):
+                    files.append((path, path.stat()))
+            except FileNotFoundError:
+                # removed by another process
+                pass
+        return files
+
+    def disk_usage(self) -> int:
+        return sum(st.st_size for (_, st) in self.files())
+
+    def evict(self):
+        """Remove the least recently read pages to keep 90% of maxSize."""
+        files = sorted(self.files(), key=lambda item: item[1].st_mtime)
+        self.size = sum(st.st_size for (_, st) in files)
+        for path, st in files:
+            if self.size <= 0.9 * self.maxSize:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # removed by another process
+                pass
+            self.size -= st.st_size
+            get_metrics().inc("cache_evictions")
+        logger.info(f"Cache {self.folder} evicted down to {self.size} bytes.")
+
+
+# one cache for the whole process, disabled until configured
+CACHE = PageCache()
+
+
+def get_cache() -> PageCache:
+    """Return the page cache shared by the process."""
+    return CACHE
+
+
+def configure_cache(folder=None, maxSize=CACHE_SIZE_DFT, offline=False) -> PageCache:
+    """
+    Set the folder, size and mode of the cache of the process.
+
+    - folder : folder of the pages, True for the default one (see
+    cache_folder), None to disable the cache unless offline
+    """
+    if folder is True or (folder is None and offline):
+        folder = cache_folder()
+    CACHE.configure(folder, maxSize, offline)
+    logger.info(f"Caching the closed pages in {folder}, offline={offline}.")
+    return CACHE
+
+
+def cache_option(value, offline=False) -> PageCache:
+    """Configure the cache from the --cache and --offline options of the scripts."""
+    if not value and not offline:
+        return CACHE
+    return configure_cache(value or None, offline=offline)
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal download core: fetch, paginate and append, with the standard library.
+
+The scripts run by cron (update_kola) start a new interpreter for each file,
+and importing pandas, numpy and requests takes most of their time.  This
+module downloads the trade/bucketed records of a symbol in a csv file with
+http.client, json and datetime only.  It keeps one connection alive, waits
+for the rate limiter and goes through the retrier of the process, records
+the metrics and phases and writes the rows exactly like
+decode.ColumnBatch.to_csv.  pandas is imported only to load or analyse the
+data (see loader.py) or by the other storages.
+
+It is also the request and paging engine of main.py: a client is anything
+with the url it requests and a get method returning a Reply, main wraps its
+requests sessions in one (see main.SessionClient) and decodes the pages in
+ColumnBatch with the decode argument.
+"""
+
+from datetime import datetime, timedelta, timezone
+from http.client import HTTPConnection, HTTPSConnection
+from time import perf_counter, sleep
+from typing import NamedTuple
+from urllib.parse import urlencode, urlsplit
+
+import json
+import logging
+import os
+
+from getBitMEXData.cache import get_cache
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.profiling import phase
+from getBitMEXData.ratelimit import get_limiter
+from getBitMEXData.retry import get_retrier
+from getBitMEXData.settings import BIN_SECONDS, BUCKET_SCHEMA, COUNT_DFT
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+logger = logging.getLogger()
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Reply(NamedTuple):
+    """A response of a client: its status, reason, headers and body."""
+
+    status: int
+    reason: str
+    headers: dict
+    body: bytes
+
+
+class HTTPError(Exception):
+    """An error response, with its status like the exceptions of requests."""
+
+    def __init__(self, status, reason, url):
+        super().__init__(f"{status} {reason} for url: {url}")
+        self.status = status
+
+
+def parse_time(value) -> datetime:
+    """
+    Return value, a datetime or an iso string, as an aware datetime.
+
+    Naive times are in UTC.  Accepts bitmex's timestamps (ending with Z) and
+    the one written by pandas (2020-01-01 00:00:00+00:00).
+    """
+    if not isinstance(value, datetime):
+        value = value.strip()
+        if value.endswith("Z"):
+            value = f"{value[:-1]}+00:00"
+        value = datetime.fromisoformat(value)
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def to_ns(value: datetime) -> int:
+    """Return the epoch nanoseconds of an aware datetime."""
+    return (value - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def from_ns(ns: int) -> datetime:
+    """Return the UTC datetime of epoch nanoseconds (to the microsecond)."""
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+
+def round_time(value: datetime, binSize) -> datetime:
+    """Return value rounded to the nearest bin of binSize."""
+    seconds = BIN_SECONDS[binSize]
+    epoch = (value - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=round(epoch / seconds) * seconds)
+
+
+def format_rows(records, header=False) -> str:
+    """
+    Return the records as csv lines, the way ColumnBatch.to_csv writes them.
+
+    Floats are written with repr and nulls as empty cells.  An int column
+    with a null is written as floats, as numpy would type it.
+    """
+    if not records:
+        return ""
+
+    fields = []
+    for name, dtype in BUCKET_SCHEMA.items():
+        values = [r.get(name) for r in records]
+        if name == "timestamp" or dtype == "object":
+            # bitmex's timestamps are already in the iso format of to_csv
+            fields.append(values)
+        elif dtype == "int64" and None not in values:
+            fields.append([str(int(v)) for v in values])
+        else:
+            fields.append(["" if v is None else repr(float(v)) for v in values])
+
+    lines = [",".join(BUCKET_SCHEMA)] if header else []
+    lines.extend(map(",".join, zip(*fields)))
+    lines.append("")
+    return "\n".join(lines)
+
+
+class Client:
+    """A keep alive connection to the host of url, for GET requests."""
+
+    def __init__(self, url, timeout=10):
+        """Init the client of url, the entry point (eg. trade/bucketed)."""
+        self.url = url
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.netloc, self.path = parts.netloc, parts.path
+        self.timeout = timeout
+        self.headers = {
+            "user-agent": "foo-",
+            "accept": "application/json",
+            "connection": "keep-alive",
+        }
+        self.conn = None
+
+    def connect(self):
+        with phase("session"):
+            connection = HTTPSConnection if self.https else HTTPConnection
+            self.conn = connection(self.netloc, timeout=self.timeout)
+
+    def get(self, query) -> Reply:
+        """Send a GET request with query and return its Reply."""
+        if self.conn is None:
+            self.connect()
+        try:
+            self.conn.request(
+                "GET", f"{self.path}?{urlencode(query)}", None, self.headers
+            )
+            rep = self.conn.getresponse()
+            body = rep.read()
+        except Exception:
+            # the connection is in an unknown state, the next request opens a new one
+            self.close()
+            raise
+        return Reply(rep.status, rep.reason, rep.headers, body)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def query_params(query) -> dict:
+    """Return the query with the times in iso format."""
+    return {
+        k: (v.isoformat() if isinstance(v, datetime) else v) for (k, v) in query.items()
+    }
+
+
+def send_request(client, query, limiter, decode=None):
+    """
+    Send the request once and return the decoded json response.
+
+    - decode : function of the response body returning the decoded response
+    (default the json records, see decode_body)
+
+    Raises HTTPError if the response has an error status.
+    """
+    metrics = get_metrics()
+    try:
+        t0 = perf_counter()
+        with phase("request"):
+            rep = client.get(query_params(query))
+        metrics.observe("request_seconds", perf_counter() - t0)
+        metrics.inc("requests")
+        metrics.inc("response_bytes", len(rep.body))
+        limiter.update(rep.headers)
+        if rep.status >= 400:
+            raise HTTPError(rep.status, rep.reason, client.url)
+        records = decode_body(rep.body, decode)
+        logger.debug(f"Req: url={client.url}, parms={query}, status={rep.status}")
+    except Exception:
+        metrics.inc("request_errors")
+        logger.exception(f"#### ERROR ####\nurl={client.url}, params={query}")
+        raise
+
+    if isinstance(records, dict):
+        # an error message, not records
+        raise ValueError(f"Not a page of records: {records}")
+    get_cache().put(client.url, query, rep.body)
+    return records
+
+
+def decode_body(body, decode=None):
+    """Return the records of a response body, decoded by decode if given."""
+    with get_metrics().timer("decode_seconds"), phase("decode"):
+        if decode is not None:
+            return decode(body)
+        return json.loads(body) if orjson is None else orjson.loads(body)
+
+
+def make_request(client, query, limiter=None, retrier=None, decode=None):
+    """
+    Make the request with query and return the decoded response.
+
+    - limiter : RateLimiter updated with the response headers
+    (default the one shared by the process)
+    - retrier : Retrier deciding if a failed request is sent again
+    (default the one shared by the process)
+    - decode : see send_request
+    On retryable failures (timeouts, 429, 5xx) only this request is sent again.
+    A page in the cache of the process is read from it (see cache.py).
+    """
+    body = get_cache().get(client.url, query)
+    if body is not None:
+        return decode_body(body, decode)
+
+    limiter = get_limiter() if limiter is None else limiter
+    retrier = get_retrier() if retrier is None else retrier
+    breaker = retrier.breaker(client.url)
+    attempt = 0
+    while True:
+        try:
+            breaker.allow()
+            records = send_request(client, query, limiter, decode)
+        except Exception as e:
+            delay = retrier.on_failure(e, attempt, client.url)
+            if delay is None:
+                raise
+            # the limiter may ask for more, eg. with a Retry-After header
+            delay = max(delay, limiter.reserve())
+            get_metrics().inc("retries")
+            get_metrics().inc("backoff_seconds", delay)
+            with phase("sleep"):
+                sleep(delay)
+            attempt += 1
+        else:
+            retrier.on_success(client.url)
+            return records
+
+
+def request_page(client, query, pause=0, limiter=None, decode=None):
+    """
+    Wait for the rate limiter and request a page, see make_request.
+
+    - pause : minimal time to wait before the request
+    - limiter : RateLimiter to wait for (default the one shared by the process)
+    """
+    # wait for the rate limit budget to avoid been rejected, the server bans
+    # us for a while if we go over it.  A cached page costs nothing.
+    limiter = get_limiter() if limiter is None else limiter
+    if not get_cache().serves(client.url, query):
+        wait = max(limiter.reserve(), pause)
+        get_metrics().inc("throttle_seconds", wait)
+        with phase("sleep"):
+            sleep(wait)
+    return make_request(client, query, limiter, decode=decode)
+
+
+def page_window(rep):
+    """Return the first and last timestamps of a decoded page, None if empty."""
+    if not len(rep):
+        return None
+    if isinstance(rep, list):
+        return parse_time(rep[0]["timestamp"]), parse_time(rep[-1]["timestamp"])
+    # a ColumnBatch
+    return rep.first, rep.last
+
+
+def iter_responses(
+    client, Q, startTime, endTime=None, pause=0, decode=None, step=0, limiter=None
+):
+    """
+    Request the pages of the query Q from startTime and yield (step, query, rep).
+
+    The next page starts after the last record of the previous one.  Stops
+    when endTime is reached or when a page holds a single timestamp.  An
+    empty page is skipped over, or ends the download without endTime.  The
+    yielded query is the one sent for that page.
+    - decode : see send_request
+    - step : step of the first page
+    """
+    binDelta = timedelta(seconds=BIN_SECONDS[Q["binSize"]])
+    startTime = parse_time(startTime)
+    endTime = None if endTime is None else parse_time(endTime)
+    limiter = get_limiter() if limiter is None else limiter
+    while True:
+        query = dict(Q, startTime=startTime)
+        if endTime is not None:
+            query["endTime"] = endTime
+        rep = request_page(client, query, pause, limiter, decode)
+        yield step, query, rep
+
+        window = page_window(rep)
+        if window is not None:
+            first, last = window
+            if (endTime is not None and last >= endTime) or first == last:
+                return
+            startTime = last + binDelta
+        else:
+            # nothing in the window of the page, we jump over it
+            startTime += int(Q.get("count", COUNT_DFT)) * binDelta
+            if endTime is None or startTime >= endTime:
+                return
+        step += 1
+
+
+def download(url, Q, fout, startTime, endTime, pause=0, client=None):
+    """
+    Write in fout the records of the query Q from startTime to endTime.
+
+    - url : live or test url of the trade/bucketed entry point
+    - Q : the query dict with keys binSize, partial, symbol, count and reverse
+    - client : Client of url to use and keep open (default a new one, closed
+    at the end)
+    fout is overwritten with the csv header and rows, then synced.  Returns
+    the timestamp of the last record written, or None.
+    """
+    metrics, t0, lastTime = get_metrics(), perf_counter(), None
+    owned = client is None
+    client = Client(url) if owned else client
+    nreq = 0
+    try:
+        with open(fout, "w") as fd:
+            fd.write(",".join(BUCKET_SCHEMA) + "\n")
+            pages = iter_responses(client, Q, startTime, endTime, pause)
+            for _, _, records in pages:
+                nreq += 1
+                with metrics.timer("write_seconds"), phase("write"):
+                    fd.write(format_rows(records))
+                if records:
+                    metrics.inc("rows", len(records))
+                    lastTime = parse_time(records[-1]["timestamp"])
+            fd.flush()
+            os.fsync(fd.fileno())
+    finally:
+        if owned:
+            client.close()
+
+    metrics.inc("jobs")
+    metrics.inc("job_seconds", perf_counter() - t0)
+    metrics.set_lag(lastTime, Q["symbol"], Q["binSize"])
+    logger.warning(f"Finished in {nreq} requests for query={Q} in {fout}")
+    return lastTime
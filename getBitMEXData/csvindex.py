@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the csv data files, to read a time range without reading the file.
+
+The index sits next to the csv file (<csv>.idx, next to the file a link
+points to).  It is json with the size of the csv file indexed and, every
+`every` rows, the timestamp (in ns), the byte offset and the number of the
+row.  Reading a range seeks to the last indexed row before its start and
+parses the rows up to the first indexed row after its end.
+
+The index is brought up to date by scanning only the rows appended since it
+was written, see update_index.  It also keeps the timestamp of the last row,
+so an up to date index gives it without reading the file, see last_ns.
+
+To index an archive:
+python -m getBitMEXData.csvindex <csv files>
+"""
+
+from bisect import bisect_left, bisect_right
+from io import BytesIO
+from pathlib import Path
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from getBitMEXData.core import parse_time, to_ns
+from getBitMEXData.settings import (
+    BUCKET_SCHEMA,
+    INDEX_EVERY_DFT,
+    INDEX_EXT,
+    LOGLEVEL_DFT,
+    TAIL_BLOCK_DFT,
+)
+
+logger = logging.getLogger()
+
+# lines of a csv data file that are not records
+NOT_RECORDS = (b"#", b"timestamp")
+
+
+def index_path(fname) -> Path:
+    """Return the path of the index of the csv file fname."""
+    return Path(f"{Path(fname).resolve()}{INDEX_EXT}")
+
+
+def line_ns(line: bytes) -> int:
+    """Return the timestamp in ns of a csv record."""
+    return to_ns(parse_time(line.split(b",", 1)[0].decode()))
+
+
+def is_record(line: bytes) -> bool:
+    """True if line is a whole csv record, with all its fields and a timestamp."""
+    if line.startswith(NOT_RECORDS) or line.count(b",") != len(BUCKET_SCHEMA) - 1:
+        return False
+    try:
+        line_ns(line)
+    except ValueError:
+        return False
+    return True
+
+
+def reversed_lines(fd, block=TAIL_BLOCK_DFT):
+    """Yield the lines of the binary file fd from the last one, reading blocks."""
+    pos = fd.seek(0, os.SEEK_END)
+    head = b""
+    while pos > 0:
+        size = min(block, pos)
+        pos -= size
+        fd.seek(pos)
+        lines = (fd.read(size) + head).split(b"\n")
+        # the first line may start in the previous block
+        head = lines.pop(0)
+        yield from reversed(lines)
+    yield head
+
+
+def last_record(fname, block=TAIL_BLOCK_DFT):
+    """
+    Return the last record of the csv file fname or None.
+
+    The file is read backward by blocks, skipping the comments, the headers
+    and a truncated last line.
+    """
+    with open(fname, "rb") as fd:
+        for line in reversed_lines(fd, block):
+            line = line.strip()
+            if line and is_record(line):
+                return line
+    return None
+
+
+def last_ns(fname):
+    """
+    Return the timestamp (ns) of the last record of fname or None.
+
+    It is taken from the index of fname if it is up to date, else the end of
+    the file is read.
+    """
+    index = load_index(fname)
+    if (
+        index is not None
+        and index.get("last") is not None
+        and index["size"] == Path(fname).stat().st_size
+    ):
+        return index["last"]
+    line = last_record(fname)
+    return None if line is None else line_ns(line)
+
+
+def load_index(fname):
+    """Return the index of fname or None if it has none."""
+    try:
+        with open(index_path(fname)) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_index(fname, index):
+    """Write the index of fname."""
+    path = index_path(fname)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as fd:
+        json.dump(index, fd)
+    os.replace(tmp, path)
+
+
+def scan(fname, index):
+    """
+    Add to index the rows of fname after its last entry.
+
+    Returns the index, its size is the size of fname scanned.
+    """
+    entries, every = index["entries"], index["every"]
+    if entries:
+        # the last entry is scanned again, to count the rows after it
+        _, offset, row = entries.pop()
+    else:
+        offset, row = 0, 0
+
+    last = None
+    with open(fname, "rb") as fd:
+        fd.seek(offset)
+        for line in fd:
+            if line.strip() and not line.startswith(NOT_RECORDS):
+                if not row % every:
+                    entries.append([line_ns(line), offset, row])
+                row += 1
+                last = line
+            offset += len(line)
+
+    if last is not None and not is_record(last.strip()):
+        # a truncated last line
+        last = last_record(fname)
+    index["size"], index["rows"] = offset, row
+    index["last"] = None if last is None else line_ns(last)
+    return index
+
+
+def update_index(fname, every=None):
+    """
+    Bring the index of fname up to date and return it.
+
+    - every : rows between two entries (default, the one of the existing
+    index or INDEX_EVERY_DFT)
+    Only the rows appended since the last update are scanned.  The index is
+    rebuilt if fname shrank or if the rows are indexed with another step.
+    """
+    index = load_index(fname)
+    if every is None:
+        every = INDEX_EVERY_DFT if index is None else index["every"]
+    size = Path(fname).stat().st_size
+    if index is None or index["every"] != every or index["size"] > size:
+        index = {"every": every, "size": 0, "rows": 0, "entries": []}
+    elif index["size"] == size:
+        return index
+
+    index = scan(fname, index)
+    save_index(fname, index)
+    logger.info(f"Indexed {index['rows']} rows of {fname}.")
+    return index
+
+
+def byte_range(index, startTime=None, endTime=None):
+    """Return the bytes of the file to read to get the rows between the times."""
+    stamps = [entry[0] for entry in index["entries"]]
+    first, last = 0, index["size"]
+    if startTime is not None:
+        i = bisect_right(stamps, startTime.value) - 1
+        first = index["entries"][i][1] if i >= 0 else 0
+    if endTime is not None:
+        j = bisect_left(stamps, endTime.value + 1)
+        last = index["entries"][j][1] if j < len(stamps) else index["size"]
+    return first, max(last, first)
+
+
+def read_range(fname, startTime=None, endTime=None):
+    """
+    Return the records of the csv file fname between startTime and endTime.
+
+    The records are in a DataFrame indexed by timestamp.  The index of fname
+    is updated first, so only the rows near the range are read and parsed.
+    """
+    from pandas import Timestamp, read_csv, to_datetime
+
+    def utc(timestamp):
+        timestamp = Timestamp(timestamp)
+        return timestamp.tz_localize("UTC") if timestamp.tz is None else timestamp
+
+    startTime = None if startTime is None else utc(startTime)
+    endTime = None if endTime is None else utc(endTime)
+
+    index = update_index(fname)
+    first, last = byte_range(index, startTime, endTime)
+    with open(fname, "rb") as fd:
+        fd.seek(first)
+        lines = fd.read(last - first).splitlines(True)
+    data = b"".join(
+        line for line in lines if line.strip() and not line.startswith(NOT_RECORDS)
+    )
+
+    if not data:
+        return read_csv(BytesIO(b""), names=list(BUCKET_SCHEMA), index_col="timestamp")
+
+    df = read_csv(BytesIO(data), names=list(BUCKET_SCHEMA), index_col="timestamp")
+    df.index = to_datetime(df.index, utc=True)
+    if startTime is not None:
+        df = df.loc[df.index >= startTime]
+    if endTime is not None:
+        df = df.loc[df.index <= endTime]
+    return df
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("fnames", nargs="+", help="csv files to index")
+    parser.add_argument(
+        "--every",
+        type=int,
+        help="Number of rows between two indexed rows",
+        default=INDEX_EVERY_DFT,
+    )
+    parser.add_argument(
+        "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
+    )
+    return parser.parse_args()
+
+
+def main_prg():
+    """Index the files given on the command line."""
+    args = parse_args()
+    logger.setLevel(args.logLevel)
+    for fname in args.fnames:
+        index = update_index(fname, args.every)
+        print(f"{fname}: {index['rows']} rows, {len(index['entries'])} entries")
+
+
+if __name__ == "__main__":
+    main_prg()
+    sys.exit()
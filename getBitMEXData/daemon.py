@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Keep all the csv data files of a folder up to date, as the bins close.
+
+The daemon finds the files {prefix}{symbol}-{binsize}-{date}.csv of the
+folder (again every --scan seconds, to pick up new ones) and updates each
+one right after the close of its bins: every minute for 1m, at 00:00 UTC for
+1d.  A bin not yet published is tried again --retry seconds later.
+
+The updates run in a pool of workers and share the rate limiter and the
+retrier of the process.  Each worker keeps its connection alive between
+updates, each file is updated by one worker at a time and the timestamp of
+its last record is kept in memory, so an update only downloads and appends
+the new bars to the partition of the year (see update_kola.append_by_year).
+
+python -m getBitMEXData.daemon ./data --live --metrics /var/lib/node/bitmex.prom
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from heapq import heappop, heappush
+from itertools import count
+from threading import Event, Lock, local
+
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+
+from getBitMEXData.core import EPOCH, Client, download
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.profiling import phase
+from getBitMEXData.settings import (
+    BIN_SECONDS,
+    COUNT_DFT,
+    DAEMON_DELAY_DFT,
+    DAEMON_RETRY_DFT,
+    DAEMON_SCAN_DFT,
+    DAEMON_WORKERS_DFT,
+    LIVE_URL,
+    LOGLEVEL_DFT,
+    METRICS_DFT,
+    PAUSE_DFT,
+    TEST_URL,
+)
+from getBitMEXData.update_kola import (
+    append_by_year,
+    as_partition,
+    find_data_files,
+    get_recent_record_file_date,
+)
+
+logger = logging.getLogger()
+
+
+def last_close(now: datetime, binSize) -> datetime:
+    """Return the time of the last bin of binSize closed at now."""
+    binDelta = timedelta(seconds=BIN_SECONDS[binSize])
+    return EPOCH + (now - EPOCH) // binDelta * binDelta
+
+
+def next_close(now: datetime, binSize) -> datetime:
+    """Return the time of the next bin of binSize to close after now."""
+    return last_close(now, binSize) + timedelta(seconds=BIN_SECONDS[binSize])
+
+
+class Series:
+    """A data file kept up to date, and the time of its last record."""
+
+    def __init__(self, fname, symbol, binSize):
+        # the partition of the last year
+        self.fname = as_partition(fname)
+        self.symbol = symbol
+        self.binSize = binSize
+        # an update is running
+        self.lock = Lock()
+        self.lastTime = get_recent_record_file_date(self.fname)
+
+    def query(self) -> dict:
+        return {
+            "binSize": self.binSize,
+            "count": COUNT_DFT,
+            "partial": "false",
+            "reverse": "false",
+            "symbol": self.symbol,
+        }
+
+    def update(self, url, client, now=None) -> bool:
+        """
+        Append the bins closed since the last record, with the client of url.
+
+        Returns True if the file has all the bins closed at now.
+        """
+        now = datetime.now(timezone.utc) if now is None else now
+        endTime = last_close(now, self.binSize)
+        if self.lastTime >= endTime:
+            return True
+
+        with self.lock:
+            part = f"{self.fname}.part"
+            lastTime = download(
+                url, self.query(), part, self.lastTime, endTime, PAUSE_DFT, client
+            )
+            with phase("write"):
+                self.fname = append_by_year(self.fname, part, removetmp=True)
+                if lastTime is not None and lastTime > self.lastTime:
+                    self.lastTime = lastTime
+        return self.lastTime >= endTime
+
+
+class Daemon:
+    """Update the data files of a folder as their bins close, see the module doc."""
+
+    def __init__(
+        self,
+        folder,
+        url,
+        prefix: str = "",
+        workers: int = DAEMON_WORKERS_DFT,
+        delay: float = DAEMON_DELAY_DFT,
+        retry: float = DAEMON_RETRY_DFT,
+        scan: float = DAEMON_SCAN_DFT,
+        metrics=METRICS_DFT,
+    ):
+        """
+        Init the daemon of folder.
+
+        - url : live or test url of the trade/bucketed entry point
+        - prefix : of the files names, before the symbol
+        - workers : number of files updated concurrently
+        - delay : seconds to wait after the close of a bin
+        - retry : seconds before trying again a bin not published or a failed update
+        - scan : seconds between two scans of the folder for new files
+        - metrics : file where to export the metrics after the updates
+        """
+        self.folder = folder
+        self.url = url
+        self.prefix = prefix
+        self.workers = workers
+        self.delay = timedelta(seconds=delay)
+        self.retry = timedelta(seconds=retry)
+        self.scan = timedelta(seconds=scan)
+        self.metrics = metrics
+        self.series = {}
+        # (due time, seq, series) of the series waiting for their update
+        self.queue = []
+        self._seq = count()
+        self._local = local()
+        self._clients = []
+        self._stopped = Event()
+
+    def client(self) -> Client:
+        """Return the client of the worker, kept alive between its updates."""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client(self.url)
+            self._clients.append(client)
+        return client
+
+    def schedule(self, series, due):
+        heappush(self.queue, (due, next(self._seq), series))
+
+    def discover(self, now):
+        """Add the data files of the folder not updated yet, due now."""
+        for key, fname in find_data_files(self.folder, self.prefix).items():
+            if key in self.series:
+                continue
+            try:
+                series = Series(fname, *key)
+            except Exception:
+                logger.exception(f"Can't update {fname}.")
+                continue
+            logger.warning(f"Updating {fname} every {key[1]}.")
+            self.series[key] = series
+            self.schedule(series, now)
+
+    def update(self, series) -> bool:
+        return series.update(self.url, self.client())
+
+    def next_due(self, series, future, now) -> datetime:
+        """Return when to update series again, its last update finished now."""
+        try:
+            complete = future.result()
+        except Exception:
+            logger.exception(f"Update of {series.fname} failed.")
+            complete = False
+        due = next_close(now, series.binSize) + self.delay
+        if not complete:
+            # not published yet, or an error
+            due = min(due, now + self.retry)
+        return due
+
+    def run(self, once: bool = False):
+        """
+        Update the files until stopped.
+
+        - once : update each file of the folder once, then return
+        """
+        now = datetime.now(timezone.utc)
+        self.discover(now)
+        nextScan = now + self.scan
+        inflight = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            while not self._stopped.is_set():
+                now = datetime.now(timezone.utc)
+                if not once and now >= nextScan:
+                    self.discover(now)
+                    nextScan = now + self.scan
+
+                while self.queue and self.queue[0][0] <= now:
+                    _, _, series = heappop(self.queue)
+                    inflight[ex.submit(self.update, series)] = series
+
+                if once and not inflight and not self.queue:
+                    break
+
+                due = min([nextScan] + [item[0] for item in self.queue[:1]])
+                timeout = max((due - now).total_seconds(), 0)
+                if not inflight:
+                    self._stopped.wait(timeout)
+                    continue
+
+                finished, _ = wait(inflight, timeout, FIRST_COMPLETED)
+                now = datetime.now(timezone.utc)
+                for future in finished:
+                    series = inflight.pop(future)
+                    due = self.next_due(series, future, now)
+                    if not once:
+                        self.schedule(series, due)
+                if finished and self.metrics:
+                    get_metrics().export(self.metrics)
+
+        for client in self._clients:
+            client.close()
+
+    def stop(self, *args):
+        """Stop after the updates running (also a signal handler)."""
+        logger.warning("Stopping the updates.")
+        self._stopped.set()
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "folder", nargs="?", help="folder of the data files", default="."
+    )
+    parser.add_argument(
+        "--prefix",
+        "-p",
+        help="prefix of the files names, before the symbol",
+        default="",
+    )
+    parser.add_argument(
+        "--live", "-l", action="store_true", help="If present use live historic data"
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="Number of files updated concurrently",
+        default=DAEMON_WORKERS_DFT,
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        help="Seconds to wait after the close of a bin",
+        default=DAEMON_DELAY_DFT,
+    )
+    parser.add_argument(
+        "--retry",
+        type=float,
+        help="Seconds before trying again a bin not yet published or a failed update",
+        default=DAEMON_RETRY_DFT,
+    )
+    parser.add_argument(
+        "--scan",
+        type=float,
+        help="Seconds between two scans of the folder for new files",
+        default=DAEMON_SCAN_DFT,
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="If present, update each file once and exit",
+    )
+    parser.add_argument(
+        "--metrics",
+        "-M",
+        help=(
+            "File where to write the metrics after the updates: a Prometheus"
+            " textfile if it ends with .prom, else a json line is appended"
+        ),
+        default=METRICS_DFT,
+    )
+    parser.add_argument(
+        "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
+    )
+    return parser.parse_args()
+
+
+def main_prg():
+    """Run the daemon on the folder given on the command line."""
+    args = parse_args()
+    logger.setLevel(args.logLevel)
+    os.environ["TZ"] = "UTC"
+    time.tzset()
+
+    url = f"{LIVE_URL if args.live else TEST_URL}trade/bucketed"
+    daemon = Daemon(
+        args.folder,
+        url,
+        args.prefix,
+        args.workers,
+        args.delay,
+        args.retry,
+        args.scan,
+        args.metrics,
+    )
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run(args.once)
+
+
+if __name__ == "__main__":
+    main_prg()
+    sys.exit()
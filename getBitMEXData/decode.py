@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Decode trade/bucketed responses in typed columns without building DataFrames.
+
+A page is turned into a ColumnBatch: one numpy array per field of the known
+schema, timestamps as int64 epoch nanoseconds, and the symbol kept once for
+the page.  The batch can be written as csv directly or turned into a
+DataFrame when needed.  orjson is used to parse the json if installed.
+"""
+
+from typing import Dict
+
+import json
+
+import numpy as np
+from pandas import Timestamp
+
+from getBitMEXData.settings import BUCKET_SCHEMA
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def loads(content: bytes):
+    """Parse json content with the fastest parser available."""
+    return json.loads(content) if orjson is None else orjson.loads(content)
+
+
+def iso_to_ns(timestamps) -> np.ndarray:
+    """Convert bitmex iso timestamps (UTC, ending with Z) to epoch ns."""
+    stamps = np.array([t.rstrip("Z") for t in timestamps], dtype="datetime64[ns]")
+    return stamps.astype("int64")
+
+
+def ns_to_iso(stamps: np.ndarray) -> np.ndarray:
+    """Convert epoch ns to bitmex iso timestamps."""
+    iso = np.datetime_as_string(stamps.astype("datetime64[ns]"), unit="ms")
+    return np.char.add(iso, "Z")
+
+
+class ColumnBatch:
+    """The records of a page as typed columns."""
+
+    def __init__(self, symbol: str, columns: Dict[str, np.ndarray]):
+        """Init with the symbol of the page and its columns, timestamp first."""
+        self.symbol = symbol
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def __repr__(self):
+        return f"ColumnBatch({self.symbol}, {len(self)} rows)"
+
+    @property
+    def first(self) -> Timestamp:
+        """Timestamp of the first record.  Raises IndexError if empty."""
+        return Timestamp(int(self.columns["timestamp"][0]), tz="UTC")
+
+    @property
+    def last(self) -> Timestamp:
+        """Timestamp of the last record.  Raises IndexError if empty."""
+        return Timestamp(int(self.columns["timestamp"][-1]), tz="UTC")
+
+    def to_csv(self, header=False) -> str:
+        """Return the records as csv lines, the way DataFrame.to_csv writes them."""
+        if not len(self):
+            return ""
+
+        fields = [ns_to_iso(self.columns["timestamp"]).tolist()]
+        fields.append([self.symbol] * len(self))
+        for name, values in self.columns.items():
+            if name == "timestamp":
+                continue
+            if values.dtype.kind == "f":
+                # nan are empty cells
+                fields.append([repr(v) if v == v else "" for v in values.tolist()])
+            else:
+                fields.append([str(v) for v in values.tolist()])
+
+        lines = [",".join(BUCKET_SCHEMA)] if header else []
+        lines.extend(map(",".join, zip(*fields)))
+        lines.append("")
+        return "\n".join(lines)
+
+    def to_frame(self):
+        """Return the records as a DataFrame indexed by timestamp."""
+        from pandas import DataFrame, to_datetime
+
+        df = DataFrame(self.columns)
+        df.insert(1, "symbol", self.symbol)
+        df["timestamp"] = to_datetime(df["timestamp"], utc=True)
+        return df.set_index("timestamp")
+
+
+def decode_records(records) -> ColumnBatch:
+    """Return the ColumnBatch of a list of bitmex bucketed records."""
+    columns = {"timestamp": iso_to_ns([r["timestamp"] for r in records])}
+    symbol = records[0]["symbol"] if records else None
+    for name, dtype in BUCKET_SCHEMA.items():
+        if name in ("timestamp", "symbol"):
+            continue
+        values = [r.get(name) for r in records]
+        try:
+            columns[name] = np.array(values, dtype=dtype)
+        except TypeError:
+            # a null in an int column
+            columns[name] = np.array(values, dtype="float64")
+
+    return ColumnBatch(symbol, columns)
+
+
+def decode_page(content: bytes) -> ColumnBatch:
+    """Return the ColumnBatch of the raw body of a trade/bucketed response."""
+    records = loads(content)
+    if isinstance(records, dict):
+        # an error message, not records
+        raise ValueError(f"Not a page of records: {records}")
+    return decode_records(records)
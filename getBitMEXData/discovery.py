@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Find the first bar available for a symbol and a bin size.
+
+Bitmex sends the records at or after the query's startTime, so a single
+request for one record (count=1) starting at BITMEX_EPOCH returns the first
+bar of any instrument, however long before its listing we start.  The
+result is cached on disk, per server, symbol and bin size.
+"""
+
+from pathlib import Path
+from urllib.parse import urlparse
+
+import json
+import logging
+import os
+
+from pandas import Timestamp
+
+from getBitMEXData.settings import BITMEX_EPOCH, LISTING_CACHE, STARTDATE_DFT
+
+logger = logging.getLogger()
+
+
+def cache_path() -> Path:
+    """Return the path of the listing dates cache file."""
+    cacheHome = os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache"))
+    return Path(cacheHome).joinpath(LISTING_CACHE)
+
+
+def cache_key(url, symbol, binSize) -> str:
+    """Return the key of the first bar of symbol in binSize on url's server."""
+    return f"{urlparse(url).netloc}/{symbol}/{binSize}"
+
+
+def load_cache() -> dict:
+    """Return the cached first bars."""
+    try:
+        with open(cache_path()) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(key, firstBar: Timestamp):
+    """Add firstBar to the cache under key."""
+    path = cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    cache = load_cache()
+    cache[key] = firstBar.isoformat()
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as fd:
+        json.dump(cache, fd, indent=1)
+    os.replace(tmp, path)
+
+
+def find_first_bar(url, symbol, binSize, sess=None, auth=None, refresh=False):
+    """
+    Return the timestamp of the first bar of symbol in binSize or None.
+
+    - url : live or test url of the trade/bucketed entry point
+    - refresh : if True, ignore the cache
+    Costs one request the first time, none afterwards.
+    """
+    # imported here, main uses this module
+    from getBitMEXData.main import get_time_window, init_session, request_page
+
+    key = cache_key(url, symbol, binSize)
+    if not refresh:
+        cached = load_cache().get(key)
+        if cached is not None:
+            return Timestamp(cached)
+
+    sess = init_session() if sess is None else sess
+    query = {
+        "binSize": binSize,
+        "partial": "false",
+        "symbol": symbol,
+        "count": 1,
+        "reverse": "false",
+        "startTime": Timestamp(BITMEX_EPOCH, tz="UTC"),
+    }
+    _, rep = request_page(query, sess, auth, url)
+    if not len(rep):
+        logger.warning(f"No {binSize} data for {symbol} on {url}.")
+        return None
+
+    firstBar, _ = get_time_window(rep)
+    save_cache(key, firstBar)
+    logger.info(f"First {binSize} bar of {symbol} is {firstBar}.")
+    return firstBar
+
+
+def get_start_date(url, symbol, binSize, sess=None, auth=None) -> Timestamp:
+    """
+    Return the date from which to download symbol.
+
+    The first bar found on the server, or the known start date, or the epoch
+    if the server can't be reached.
+    """
+    try:
+        firstBar = find_first_bar(url, symbol, binSize, sess, auth)
+    except Exception:
+        logger.exception(f"Could not find the first bar of {symbol}.")
+        firstBar = None
+
+    if firstBar is None:
+        firstBar = Timestamp(STARTDATE_DFT.get(symbol, BITMEX_EPOCH), tz="UTC")
+    return firstBar
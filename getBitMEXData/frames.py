@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed csv data files made of independent frames, readable by range.
+
+The csv rows are compressed in frames of about FRAME_SIZE_DFT bytes of text,
+each frame a complete zstd frame (.zst, needs zstandard) or gzip member (.gz,
+the fallback).  Concatenated frames are still a valid .zst or .gz file, so
+zstdcat or zcat read the whole file.  A frame index sits next to the file
+(<file>.fidx): json with the symbol, the bin size and, for each frame, the
+timestamps (ns) of its first and last rows, its offset, its size and its
+number of rows.
+
+Appending adds frames without touching the previous ones, and reading a
+time range decompresses only the frames it overlaps.  The index is written
+after its frame is synced, so a download resumes after the last indexed
+frame.
+"""
+
+from io import BytesIO, StringIO
+from pathlib import Path
+
+import gzip
+import json
+import logging
+import os
+
+from pandas import Timedelta, Timestamp
+
+from getBitMEXData.decode import BUCKET_SCHEMA
+from getBitMEXData.settings import (
+    BIN_SECONDS,
+    FRAME_INDEX_EXT,
+    FRAME_SIZE_DFT,
+    STRF,
+    ZSTD_LEVEL_DFT,
+)
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+logger = logging.getLogger()
+
+
+def compress(data: bytes, ext: str) -> bytes:
+    """Return data compressed in one frame of the codec of ext."""
+    if ext == ".zst":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL_DFT).compress(data)
+    return gzip.compress(data)
+
+
+def decompress(frame: bytes, ext: str) -> bytes:
+    """Return the content of a frame of the codec of ext."""
+    if ext == ".zst":
+        return zstandard.ZstdDecompressor().decompress(frame)
+    return gzip.decompress(frame)
+
+
+def default_ext() -> str:
+    """Return the extension of the best codec available."""
+    return ".gz" if zstandard is None else ".zst"
+
+
+def framed_path(fout) -> Path:
+    """Return the path of the compressed file of fout, with its extension."""
+    fout = Path(fout)
+    if fout.suffix in (".zst", ".gz"):
+        return fout
+    for ext in (".zst", ".gz"):
+        if Path(f"{fout}{ext}").exists():
+            return Path(f"{fout}{ext}")
+    return Path(f"{fout}{default_ext()}")
+
+
+class FramedFile:
+    """A compressed csv file and its frame index, see the module doc."""
+
+    def __init__(self, path):
+        """Init the file at path (with its .zst or .gz extension)."""
+        self.path = Path(path)
+        self.ext = self.path.suffix
+        if self.ext == ".zst" and zstandard is None:
+            raise ImportError(f"{self.path} needs zstandard, pip install zstandard.")
+        self.indexPath = Path(f"{self.path}{FRAME_INDEX_EXT}")
+        self.index = self.load_index()
+
+    def load_index(self) -> dict:
+        """Return the frame index, empty if there is none."""
+        try:
+            with open(self.indexPath) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {"symbol": None, "binSize": None, "frames": []}
+
+    def save_index(self):
+        """Write the frame index."""
+        tmp = self.indexPath.with_suffix(".tmp")
+        with open(tmp, "w") as fd:
+            json.dump(self.index, fd)
+        os.replace(tmp, self.indexPath)
+
+    @property
+    def frames(self) -> list:
+        """The frames: [first ns, last ns, offset, size, rows]."""
+        return self.index["frames"]
+
+    @property
+    def size(self) -> int:
+        """Size of the file up to the end of its last frame."""
+        if not self.frames:
+            return 0
+        _, _, offset, size, _ = self.frames[-1]
+        return offset + size
+
+    def last_timestamp(self):
+        """Return the timestamp of the last row or None."""
+        if not self.frames:
+            return None
+        return Timestamp(self.frames[-1][1], tz="UTC")
+
+    def append(self, data: bytes, first, last, rows, fd):
+        """
+        Compress data in a new frame, appended with fd, and index it.
+
+        - first, last : timestamps of the first and last rows of data
+        """
+        frame = compress(data, self.ext)
+        offset = self.size
+        fd.seek(offset)
+        fd.write(frame)
+        fd.flush()
+        os.fsync(fd.fileno())
+        self.frames.append(
+            [Timestamp(first).value, Timestamp(last).value, offset, len(frame), rows]
+        )
+        self.save_index()
+
+    def read_frames(self, startTime=None, endTime=None) -> bytes:
+        """Return the decompressed content of the frames overlapping the range."""
+        startNs = None if startTime is None else Timestamp(startTime).value
+        endNs = None if endTime is None else Timestamp(endTime).value
+        content = []
+        with open(self.path, "rb") as fd:
+            for first, last, offset, size, _ in self.frames:
+                if startNs is not None and last < startNs:
+                    continue
+                if endNs is not None and first > endNs:
+                    break
+                fd.seek(offset)
+                content.append(decompress(fd.read(size), self.ext))
+        return b"".join(content)
+
+    def read(self, startTime=None, endTime=None):
+        """
+        Return the records between startTime and endTime in a DataFrame.
+
+        The DataFrame is indexed by timestamp, only the frames needed are
+        read.
+        """
+        from pandas import read_csv, to_datetime
+
+        def utc(timestamp):
+            timestamp = Timestamp(timestamp)
+            return timestamp.tz_localize("UTC") if timestamp.tz is None else timestamp
+
+        startTime = None if startTime is None else utc(startTime)
+        endTime = None if endTime is None else utc(endTime)
+        data = b"".join(
+            line
+            for line in self.read_frames(startTime, endTime).splitlines(True)
+            if line.strip() and not line.startswith((b"#", b"timestamp"))
+        )
+        df = read_csv(BytesIO(data), names=list(BUCKET_SCHEMA), index_col="timestamp")
+        df.index = to_datetime(df.index, utc=True)
+        if startTime is not None:
+            df = df.loc[df.index >= startTime]
+        if endTime is not None:
+            df = df.loc[df.index <= endTime]
+        return df
+
+    def writer(self, symbol, binSize, resume=False, frameSize=FRAME_SIZE_DFT):
+        """Return a FrameWriter of the pages of a download in the file."""
+        return FrameWriter(self, symbol, binSize, resume, frameSize)
+
+
+def framed_files(base, binSize, startTime=None, endTime=None) -> list:
+    """
+    Return the compressed files of base with rows between the times, in order.
+
+    - base : the folder and the symbol of the <base>-<binSize>-<date>.zst (or
+    .gz) files, whatever their date: the end of a download (see main_prg), a
+    year, with or without .csv
+    The files are chosen by the timestamps of their frame index, not by their
+    name, so a file updated over several years is found for each of them.
+    Only the frame indexes are read.
+    """
+    base = Path(base)
+    startNs = None if startTime is None else Timestamp(startTime).value
+    endNs = None if endTime is None else Timestamp(endTime).value
+    files = []
+    for ext in (".zst", ".gz"):
+        for path in base.parent.glob(f"{base.name}-{binSize}-*{ext}"):
+            framed = FramedFile(path)
+            frames = framed.frames
+            if not frames or framed.index["binSize"] not in (None, binSize):
+                continue
+            if startNs is not None and frames[-1][1] < startNs:
+                continue
+            if endNs is not None and frames[0][0] > endNs:
+                continue
+            files.append(framed)
+    return sorted(files, key=lambda framed: framed.frames[0][0])
+
+
+class FrameWriter:
+    """
+    Write the pages of a download in a FramedFile, like main.PageWriter.
+
+    The pages are buffered and compressed in frames of about frameSize
+    bytes.  If resume and the file has frames, the file is cut after its
+    last indexed frame and the download continues after its last row
+    (`nextStart`), else the file is overwritten and `nextStart` is None.
+    """
+
+    def __init__(self, framed, symbol, binSize, resume=False, frameSize=FRAME_SIZE_DFT):
+        """Open the file of framed."""
+        self.framed = framed
+        self.frameSize = frameSize
+        self.firstStep, self.nextStart = 0, None
+        self.resuming = resume and framed.path.exists() and bool(framed.frames)
+        if self.resuming:
+            lastTime = framed.last_timestamp()
+            self.nextStart = lastTime + Timedelta(seconds=BIN_SECONDS[binSize])
+            logger.warning(f"Resuming {framed.path} from {self.nextStart}.")
+            # an unindexed frame may be half written
+            os.truncate(framed.path, framed.size)
+        else:
+            framed.index = {"symbol": symbol, "binSize": binSize, "frames": []}
+            framed.save_index()
+
+        self.header = not self.resuming
+        self.nreq = 0
+        self.fd = open(framed.path, "r+b" if self.resuming else "wb")
+        self.buffer, self.rows = StringIO(), 0
+        self.first, self.last = None, None
+
+    def write(self, step, query, rep):
+        """Buffer the response rep to query, the page step, to be compressed."""
+        # imported here, main uses this module
+        from getBitMEXData.main import write_response
+
+        firstReqDate, lastReqDate = write_response(
+            rep, query, self.buffer, self.header, step
+        )
+        if len(rep):
+            self.first = firstReqDate if self.first is None else self.first
+            self.last, self.rows = lastReqDate, self.rows + len(rep)
+            self.header = False
+
+        if not self.nreq:
+            logger.info(f"{firstReqDate.strftime(STRF)}:{lastReqDate.strftime(STRF)}")
+        self.nreq += 1
+        if self.buffer.tell() >= self.frameSize:
+            self.flush()
+        return firstReqDate, lastReqDate
+
+    def flush(self):
+        """Compress the buffered rows in a new frame."""
+        if self.rows:
+            data = self.buffer.getvalue().encode()
+            self.framed.append(data, self.first, self.last, self.rows, self.fd)
+        self.buffer, self.rows = StringIO(), 0
+        self.first, self.last = None, None
+
+    def close(self):
+        """Compress the buffered rows and close the file."""
+        try:
+            self.flush()
+        finally:
+            self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
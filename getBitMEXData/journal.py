@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Progress journal of a download, to resume it after an interruption.
+
+The journal sits next to the data file (<fout>.journal) and is its manifest:
+the data file holds only csv rows, the metadata of the pages is here.  Each
+line is a json record of a page (or shard) completely written in the data
+file: its step, the timestamps of its first and last records, the size of
+the data file once it was written and, if known, its number of rows.  The
+data file is synced before the journal so a journaled page is always on disk.
+"""
+
+from pathlib import Path
+
+import json
+import logging
+import os
+
+from pandas import Timestamp
+
+from getBitMEXData.settings import JOURNAL_EXT
+
+logger = logging.getLogger()
+
+
+class Journal:
+    """The journal of the download written in fout."""
+
+    def __init__(self, fout):
+        """Init the journal of fout, loading the existing records if any."""
+        self.fout = Path(fout)
+        self.path = Path(f"{fout}{JOURNAL_EXT}")
+        self.entries = self.load()
+
+    def load(self):
+        """Return the records of the journal file, ignoring a truncated last line."""
+        entries = []
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"Ignoring broken line in {self.path}.")
+                        break
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @property
+    def last(self):
+        """The last confirmed record or None."""
+        return self.entries[-1] if self.entries else None
+
+    @property
+    def lastTime(self) -> Timestamp:
+        """The timestamp of the last confirmed record or None."""
+        return None if self.last is None else Timestamp(self.last["last"])
+
+    def reset(self):
+        """Start a new journal."""
+        self.entries = []
+        with open(self.path, "w"):
+            pass
+
+    def restore(self) -> bool:
+        """
+        Truncate fout after its last confirmed page.
+
+        Rows written after it may be half written and are dropped.
+        Returns True if there is something to resume from.
+        """
+        if self.last is None or not self.fout.exists():
+            return False
+
+        offset = self.last["offset"]
+        size = self.fout.stat().st_size
+        if size < offset:
+            logger.error(f"{self.fout} is shorter than its journal, can't resume.")
+            return False
+        if size > offset:
+            logger.warning(
+                f"Dropping {size - offset} unconfirmed bytes of {self.fout}."
+            )
+            os.truncate(self.fout, offset)
+
+        return True
+
+    def record(self, step, first, last, fd, rows=None):
+        """Confirm the page step, spanning first to last, written in fd."""
+        return self.confirm([(step, first, last, None, rows)], fd)[0]
+
+    def confirm(self, pages, fd):
+        """
+        Sync fd then confirm the pages written in it with one journal write.
+
+        - pages : list of (step, first, last, offset, rows).  offset is the size
+        of the data file once the page is written, None for the current size
+        of fd.  rows may be None if unknown.
+        """
+        fd.flush()
+        os.fsync(fd.fileno())
+        entries = []
+        for step, first, last, offset, rows in pages:
+            entry = {
+                "step": step,
+                "first": Timestamp(first).isoformat(),
+                "last": Timestamp(last).isoformat(),
+                "offset": fd.tell() if offset is None else offset,
+            }
+            if rows is not None:
+                entry["rows"] = rows
+            entries.append(entry)
+
+        with open(self.path, "a") as jd:
+            jd.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            jd.flush()
+            os.fsync(jd.fileno())
+        self.entries.extend(entries)
+        return entries
@@ -5,21 +5,68 @@ The idea is that the folder contains yearly datafile.
 """
 
 import pandas as pd
-from getBitMEXData.settings import FOLDER_DFT, SYMBOL_DFT, BINSIZE_DFT
+from getBitMEXData.settings import FOLDER_DFT, SYMBOL_DFT, BINSIZE_DFT, STORAGE_DFT
 from getBitMEXData.btxConstantes import PRICE_TICKLOG
+from getBitMEXData.profiling import phase, profile_option
 from mlkHelper.stattimes import timedelta_to_seconds
 from pathlib import Path
 
-def load_btxData(years=[2018], bins=BINSIZE_DFT, folder=FOLDER_DFT, symbol=SYMBOL_DFT):
+
+def year_bounds(year, startTime=None, endTime=None):
+    """Return the first and last times of year within startTime and endTime (UTC)."""
+
+    def utc(timestamp):
+        timestamp = pd.Timestamp(timestamp)
+        return timestamp.tz_localize("UTC") if timestamp.tz is None else timestamp
+
+    first, last = utc(f"{year}-01-01"), utc(f"{year}-12-31 23:59:59")
+    if startTime is not None:
+        first = max(first, utc(startTime))
+    if endTime is not None:
+        last = min(last, utc(endTime))
+    return first, last
+
+
+def load_btxData(
+    years=[2018],
+    bins=BINSIZE_DFT,
+    folder=FOLDER_DFT,
+    symbol=SYMBOL_DFT,
+    storage=STORAGE_DFT,
+    startTime=None,
+    endTime=None,
+    profile=False,
+):
     """
-    years_ a list of years (defautl [2018])
+    years_ a list of years (defautl [2018]).  None for the years of the csv
+    partitions with data between startTime and endTime (see
+    getBitMEXData.partitions), or all the years stored with the other storages
     bins : a bin type '1m', '5m', '1d' def ('5m')
     folder: the directory name where btxfile are
     symbol: is base file name, also used for ticker.  should be a symbol
     filename shoud be in the forme '<symbol>-<BINSIZE>-<YEAR>.csv'
+    storage: csv or parquet, then the years are read from the parquet store
+    of the symbol in folder (see getBitMEXData.storage), or binary to read
+    them from the <symbol>-<BINSIZE>.btx file (see getBitMEXData.binstore)
+    storage can also be compressed to read the <symbol>-<BINSIZE>-<date>.zst
+    (or .gz) files written by the downloader or the updater, found by their
+    frame index and decompressing only the frames needed (see
+    getBitMEXData.frames.framed_files)
+    startTime, endTime: if given, only the rows between them are read, with
+    every storage (the csv files are sought with their index, see
+    getBitMEXData.csvindex)
+    profile: True to print the time and memory of the reading and of the
+    building of the DataFrame on stderr, or a file where to dump a cProfile
+    (see getBitMEXData.profiling)
     ajoute une collone avg
     renvois le tableau
     """
+    if profile:
+        with profile_option(profile):
+            return load_btxData(
+                years, bins, folder, symbol, storage, startTime, endTime
+            )
+
     # defautl headers
     header_df = (
         "timestamp symbol open high low close trades volume vwap lastSize"
@@ -30,62 +77,120 @@ def load_btxData(years=[2018], bins=BINSIZE_DFT, folder=FOLDER_DFT, symbol=SYMBO
     # TODO: header à récupérer dans le fichier sinon problème quand the API return columns order change
     df = None
 
-    for year in years:
-        fname = folder.joinpath(f"{symbol}-{bins}-{year}.csv")
-        _tdf = (
-            pd.read_csv(fname, comment="#", names=header_df, low_memory=False)
-            .dropna()
-            .drop(index=0)
+    with phase("read"):
+        if years is None and storage == "csv":
+            from getBitMEXData.partitions import partition_years
+
+            years = partition_years(folder.joinpath(symbol), bins, startTime, endTime)
+        if years is not None and not years:
+            raise ValueError(
+                f"No {bins} data of {symbol} in {folder}"
+                f" between {startTime} and {endTime}."
+            )
+
+        if storage == "parquet":
+            # typed columns, no parsing to do
+            from getBitMEXData.storage import ParquetStore
+
+            df = ParquetStore(folder, symbol, bins).read(
+                years, startTime=startTime, endTime=endTime
+            )
+        elif storage == "binary":
+            # a slice of the mapped file per year
+            from getBitMEXData.binstore import BinFile, binary_path
+
+            binFile = BinFile(binary_path(folder, symbol, bins))
+            if years is None:
+                df = binFile.read(startTime, endTime)
+            else:
+                df = pd.concat(
+                    [
+                        binFile.read(*year_bounds(year, startTime, endTime))
+                        for year in years
+                    ]
+                )
+        elif storage == "compressed":
+            from getBitMEXData.frames import framed_files
+
+            start, end = startTime, endTime
+            if years is not None:
+                start = year_bounds(min(years), startTime, endTime)[0]
+                end = year_bounds(max(years), startTime, endTime)[1]
+            files = framed_files(folder.joinpath(symbol), bins, start, end)
+            if not files:
+                raise ValueError(
+                    f"No compressed {bins} data of {symbol} in {folder}"
+                    f" between {start} and {end}."
+                )
+            df = pd.concat([framed.read(start, end).dropna() for framed in files])
+            if years is not None:
+                df = df.loc[df.index.year.isin(years)]
+            # the files of several downloads may overlap
+            df = df.loc[~df.index.duplicated(keep="last")]
+
+        for year in years if df is None else []:
+            fname = folder.joinpath(f"{symbol}-{bins}-{year}.csv")
+            if startTime is None and endTime is None:
+                _tdf = (
+                    pd.read_csv(fname, comment="#", names=header_df, low_memory=False)
+                    .dropna()
+                    .drop(index=0)
+                )
+            else:
+                # seeking to the rows of the range
+                from getBitMEXData.csvindex import read_range
+
+                _tdf = read_range(fname, startTime, endTime).reset_index().dropna()
+
+            # On converti manuellement les timestamp car la colonne index
+            # n'est pas 'pure' au chargement
+            _tdf = _tdf.loc[~_tdf.timestamp.isin(["timestamp"])]
+            try:
+                # ignoring header line
+                _tdf.timestamp.iloc[:] = _tdf.timestamp.apply(pd.Timestamp)
+            except ValueError:
+                logging.error("Probably trying to convert header")
+                pass
+
+            _tdf = _tdf.set_index("timestamp")
+
+            df = _tdf if df is None else pd.concat([df, _tdf], sort=True)
+
+    with phase("frame"):
+        _symbol = df.symbol.iloc[0]
+        df = df.drop(columns="symbol")  # the symbol column
+
+        # harmoniser l'index
+        df = df.sort_index()
+        df = df.drop_duplicates()
+
+        # creating a full index for the requested bins
+        fullIndex = pd.date_range(
+            start=df.index[0], end=df.index[-1], freq=timedelta_to_seconds(bins)
         )
 
-        # On converti manuellement les timestamp car la colonne index
-        # n'est pas 'pure' au chargement
-        _tdf = _tdf.loc[~_tdf.timestamp.isin(["timestamp"])]
-        try:
-            # ignoring header line
-            _tdf.timestamp.iloc[:] = _tdf.timestamp.apply(pd.Timestamp)
-        except ValueError:
-            logging.error("Probably trying to convert header")
-            pass
+        # and the associated dataferame  Full DF
 
-        _tdf = _tdf.set_index("timestamp")
+        fdf = pd.DataFrame(index=fullIndex)
+        # we make header similare to those downloaded
+        columns = set(header_df) - set(["symbol", "timestamp"])
+        for c in columns:
+            fdf.loc[:, c] = None
 
-        df = _tdf if df is None else pd.concat([df, _tdf], sort=True)
+        fdf.index.name = "timestamp"
+        # import ipdb; ipdb.set_trace()
 
-    _symbol = df.symbol.iloc[0]
-    df = df.drop(columns="symbol")  # the symbol column
+        # copying in it the data
+        fdf.loc[df.index, :] = df
 
-    # harmoniser l'index
-    df = df.sort_index()
-    df = df.drop_duplicates()
-
-    # creating a full index for the requested bins
-    fullIndex = pd.date_range(
-        start=df.index[0], end=df.index[-1], freq=timedelta_to_seconds(bins)
-    )
-
-    # and the associated dataferame  Full DF
-
-    fdf = pd.DataFrame(index=fullIndex)
-    # we make header similare to those downloaded
-    columns = set(header_df) - set(["symbol", "timestamp"])
-    for c in columns:
-        fdf.loc[:, c] = None
-
-    fdf.index.name = "timestamp"
-    # import ipdb; ipdb.set_trace()
-
-    # copying in it the data
-    fdf.loc[df.index, :] = df
-
-    # and interpolating to remove nan
-    fdf = (
-        fdf.apply(lambda s: pd.to_numeric(s))
-        .interpolate(method="time")
-        .round(PRICE_TICKLOG[symbol])
-    )
+        # and interpolating to remove nan
+        fdf = (
+            fdf.apply(lambda s: pd.to_numeric(s))
+            .interpolate(method="time")
+            .round(PRICE_TICKLOG[symbol])
+        )
 
-    fdf.loc[:, "avg"] = (fdf.low + fdf.high) / 2
-    fdf.loc[:, "amplitude"] = fdf.high - fdf.low
+        fdf.loc[:, "avg"] = (fdf.low + fdf.high) / 2
+        fdf.loc[:, "amplitude"] = fdf.high - fdf.low
 
     return fdf
@@ -3,7 +3,11 @@
 An application to download bitmex's data with fine resolution. Default are in parentheses
 Pour charger les fichiers téléchargés utiliser btxDataLoader.py
 """
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from threading import local
+from time import perf_counter
 from typing import Tuple
 
 import argparse
@@ -15,13 +19,26 @@ import requests as rq
 from pandas import DataFrame, Timestamp, Timedelta
 from pathlib import Path
 
+from getBitMEXData import core
+from getBitMEXData.binstore import BinFile, binary_path
 from getBitMEXData.btx_types import bucketT, oTimestampT, symbolT
+from getBitMEXData.cache import cache_option
+from getBitMEXData.core import Reply
+from getBitMEXData.decode import BUCKET_SCHEMA, ColumnBatch, decode_page
+from getBitMEXData.discovery import get_start_date
+from getBitMEXData.frames import FramedFile, framed_path
+from getBitMEXData.journal import Journal
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.pipeline import prefetch as prefetch_pages
+from getBitMEXData.profiling import phase, profile_option
+from getBitMEXData.planner import page_query, plan_pages, plan_summary
+from getBitMEXData.storage import ParquetStore
 from getBitMEXData.settings import (
     STRF,
     LIVE_URL,
     TEST_URL,
     TC,
-    STARTDATE_DFT,
+    BIN_SECONDS,
     SYMBOL_DFT,
     ENTRYPOINT_DFT,
     LOGLEVEL_DFT,
@@ -31,6 +48,14 @@ from getBitMEXData.settings import (
     PAUSE_DFT,
     COUNT_DFT,
     FOLDER_DFT,
+    WORKERS_DFT,
+    PREFETCH_DFT,
+    STORAGES,
+    STORAGE_DFT,
+    WRITE_BUFFER_DFT,
+    METRICS_DFT,
+    PROFILE_DFT,
+    CACHE_DFT,
 )
 
 # setting the default time zone for the system
@@ -40,11 +65,14 @@ if platform.system() == "Linux":
     OS_TZ = os.environ.get("TZ", "UTC")
 else:
     # in the case os.environ does not exist
-    OZ_TZ = "UTC"
+    OS_TZ = "UTC"
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
+# columns of the trade/bucketed records, in the order sent by bitmex
+BUCKET_COLUMNS = list(BUCKET_SCHEMA)
+
 # Converts bitmex time unit to pd.timestamp time units
 URLS = {
     True: LIVE_URL,
@@ -52,46 +80,77 @@ URLS = {
 }
 
 
-def init_session(name="foo"):
-    """Set a session with name `foo`."""
-    sess = rq.Session()
-    sess.headers.update({"user-agent": f"{name}-"})
-    sess.headers.update({"content-type": "application/json"})
-    sess.headers.update({"accept": "application/json"})
+def init_session(name="foo", pool: int = 0):
+    """
+    Set a session with name `foo`.
+
+    - pool : if > 0, keep up to pool connections alive to share the session
+    between as many threads
+    """
+    with phase("session"):
+        sess = rq.Session()
+        if pool:
+            adapter = rq.adapters.HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+            sess.mount("https://", adapter)
+            sess.mount("http://", adapter)
+        sess.headers.update({"user-agent": f"{name}-"})
+        sess.headers.update({"content-type": "application/json"})
+        sess.headers.update({"accept": "application/json"})
     return sess
 
 
-def make_request(query, sess, auth, url, verb="GET"):
+class SessionClient:
+    """The requests session sess as a client of url for core (see core.Client)."""
+
+    def __init__(self, sess, url, auth=None, verb="GET", timeout=10):
+        self.sess = sess
+        self.url = url
+        self.auth = auth
+        self.verb = verb
+        self.timeout = timeout
+
+    def get(self, query) -> Reply:
+        """Send the request with query and return its Reply."""
+        req = rq.Request(self.verb, f"{self.url}", auth=self.auth, params=query)
+        prepp = self.sess.prepare_request(req)
+        logger.debug(
+            f"Prepp: {prepp}: body={prepp.body}, header={prepp.headers},"
+            f" url={prepp.path_url}"
+        )
+        rep = self.sess.send(prepp, timeout=self.timeout)
+        return Reply(rep.status_code, rep.reason, rep.headers, rep.content)
+
+
+def make_request(
+    query, sess, auth, url, verb="GET", limiter=None, retrier=None, decode=None
+):
     """
     Make the request with query been passed via rest in sessions sess.
 
     - request verb  (default GET)
+    - decode : function of the response body returning the decoded response
+    (default the json records)
+    - limiter : RateLimiter updated with the response headers
+    (default the one shared by the process)
+    - retrier : Retrier deciding if a failed request is sent again
+    (default the one shared by the process)
+    The request, its retries and the cache are those of core.make_request.
     """
-    rep, req = None, None
-    try:
-        req = rq.Request(verb, f"{url}", auth=auth, params=query)
-        print(req.url, query)
-        prepp = sess.prepare_request(req)
-        rep = sess.send(prepp, timeout=10)
-        rep = rep.json()
-        logmsg = (
-            f"Req: {req}, url={req.url}, parms={query}, auth={auth}"
-            f"Prepp: {prepp}: body={prepp.body}, header={prepp.headers},"
-            f" url={prepp.path_url}"
-        )
-        logger.debug(logmsg)
-    except Exception as e:
-        if req:
-            logmsg = (
-                f"#### ERROR ####\nReq: req={req}, url={req.url}, params={query}"
-                f"\nPrepp: header={prepp.headers}, url={prepp.path_url}"
-            )
-            logmsg += f"\nRep: {rep}"
+    client = SessionClient(sess, url, auth, verb)
+    return core.make_request(client, query, limiter, retrier, decode)
 
-            logger.exception(logmsg)
-        raise e
 
-    return rep
+def send_request(query, sess, auth, url, verb, limiter, decode=None):
+    """
+    Send the request once and return the decoded json response.
+
+    - decode : function of the response body returning the decoded response
+    (default the json records)
+
+    Raises core.HTTPError if the response has an error status.
+    """
+    client = SessionClient(sess, url, auth, verb)
+    return core.send_request(client, query, limiter, decode)
 
 
 def get_time_window(rep, reverse=False) -> Tuple[Timestamp, Timestamp]:
@@ -101,8 +160,11 @@ def get_time_window(rep, reverse=False) -> Tuple[Timestamp, Timestamp]:
     - reverse if False (default), oldest date is first,
     """
     try:
-        old = Timestamp(rep[0]["timestamp"])
-        recent = Timestamp(rep[-1]["timestamp"])
+        if isinstance(rep, ColumnBatch):
+            old, recent = rep.first, rep.last
+        else:
+            old = Timestamp(rep[0]["timestamp"])
+            recent = Timestamp(rep[-1]["timestamp"])
     except (KeyError, IndexError) as e:
         logger.error(f"rep={rep}, probably empty.")
         raise e
@@ -116,10 +178,14 @@ def get_bucketed_trades(
     fout=None,
     startTime: oTimestampT = None,
     endTime: oTimestampT = None,
-    pause: float = 0.5,
+    pause: float = PAUSE_DFT,
     binSize: bucketT = "1d",
     reverse: str = "false",
     symbol: symbolT = "XBTUSD",
+    workers: int = WORKERS_DFT,
+    resume: bool = False,
+    prefetch: int = PREFETCH_DFT,
+    storage: str = STORAGE_DFT,
 ):
     """
     Returns the historical data from bitMEX (default).
@@ -129,7 +195,8 @@ def get_bucketed_trades(
 
     - url : live or test url
     Times are in isoformat eg. 2016-12-27T11:00Z
-    - `startTime`: date of first record to download
+    - `startTime`: date of first record to download (default the first bar
+    available for the symbol)
     - `endTime` : date of the last recorde to download
     - binSize : bucketed size to ask: one of 1m, 5m, 1h, 1d
 
@@ -137,8 +204,17 @@ def get_bucketed_trades(
     - Q : The Query requested.
     should be a dictionnary with keys binSize, partial, symbol, count and reverse.
     - fout : the name of the file to write to the results to
-    - pause : to throttle the requests and avoid been rejected by bitMEX
+    - pause : minimal pause between two requests.  The requests are
+    otherwise throttled by the rate limiter shared by the process, to avoid
+    been rejected by bitMEX
     - reverse : should we return earliest data first ?
+    - workers : if > 1, the pages are fetched concurrently (needs an endTime)
+    - resume : if True and fout has a journal, continue the download after
+    its last confirmed page instead of starting over.
+    - prefetch : number of pages requested ahead while the previous ones are
+    written (0 to do everything in one thread).
+    - storage : csv to write fout, see open_writer for the others.
+    To get the pages in memory instead, see iter_bucketed_trades.
     """
     assert Q or (binSize and symbol and reverse), (
         "Either Q is set or binSize, symb and reverse",
@@ -158,87 +234,412 @@ def get_bucketed_trades(
     # prise en compte de windows
     fout = Path(fout)
 
-    Q = (
+    Q = bucketed_query(Q, binSize, reverse, symbol)
+    startTime = set_start_time(url, Q, startTime, sess, auth)
+
+    writer = open_writer(fout, Q["symbol"], Q["binSize"], resume, storage)
+    nextStart = Q["startTime"] if writer.nextStart is None else writer.nextStart
+    logging.warning(f"Writing {fout} from {nextStart}.")
+
+    # the writer consumes the pages as they arrive
+    metrics, t0, lastTime = get_metrics(), perf_counter(), None
+    if writer.nextStart is not None:
+        # the newest bar already stored
+        lastTime = writer.nextStart - Timedelta(seconds=BIN_SECONDS[Q["binSize"]])
+    pages = stream_pages(
+        url,
+        Q,
+        nextStart,
+        endTime,
+        sess,
+        auth,
+        pause,
+        workers,
+        prefetch,
+        writer.firstStep,
+    )
+    with writer:
+        for step, query, rep in pages:
+            with metrics.timer("write_seconds"), phase("write"):
+                _, lastReqDate = writer.write(step, query, rep)
+            if len(rep):
+                metrics.inc("rows", len(rep))
+                lastTime = lastReqDate
+
+    metrics.inc("jobs")
+    metrics.inc("job_seconds", perf_counter() - t0)
+    metrics.set_lag(lastTime, Q["symbol"], Q["binSize"])
+
+    # last log before exit
+    Q["startTime"], Q["endTime"] = startTime, endTime
+    logging.warning(f"Finished in {writer.nreq} requests for query={Q}")
+
+    return sess
+
+
+def iter_bucketed_trades(
+    url,
+    Q=None,
+    startTime: oTimestampT = None,
+    endTime: oTimestampT = None,
+    pause: float = PAUSE_DFT,
+    binSize: bucketT = "1d",
+    reverse: str = "false",
+    symbol: symbolT = "XBTUSD",
+    workers: int = WORKERS_DFT,
+    prefetch: int = PREFETCH_DFT,
+    frames: bool = False,
+):
+    """
+    Yield the pages of historical data as they arrive, nothing is written.
+
+    The parameters are those of get_bucketed_trades, and
+    - frames : if True the pages are DataFrames indexed by timestamp, else
+    ColumnBatch (see decode.py)
+    Empty pages are skipped.  At most prefetch pages (2 * workers with
+    workers) are fetched ahead of the consumer, so the memory stays bounded
+    whatever the time range.
+    """
+    auth = None
+    sess = init_session()
+    Q = bucketed_query(Q, binSize, reverse, symbol)
+    set_start_time(url, Q, startTime, sess, auth)
+    pages = stream_pages(
+        url, Q, Q["startTime"], endTime, sess, auth, pause, workers, prefetch
+    )
+    for _, _, rep in pages:
+        if len(rep) and frames:
+            with phase("frame"):
+                rep = rep.to_frame()
+        if len(rep):
+            yield rep
+
+
+def bucketed_query(Q=None, binSize="1d", reverse="false", symbol="XBTUSD") -> dict:
+    """Return the query Q, by default the query of symbol's bins of binSize."""
+    return (
         {
             "binSize": binSize,
             "partial": "false",
             "symbol": symbol,
-            "count": 180,
+            "count": COUNT_DFT,
             "reverse": reverse,
         }
         if Q is None
         else Q
     )
 
+
+def set_start_time(url, Q, startTime=None, sess=None, auth=None):
+    """
+    Set the startTime of the query Q, rounded to its bin, and return it.
+
+    If startTime is None, the startTime of Q is kept or, if Q has none, the
+    first bar available is looked up.
+    """
+    if startTime is None and "startTime" not in Q:
+        # from the first bar available
+        startTime = get_start_date(url, Q["symbol"], Q["binSize"], sess, auth)
     if startTime is None:
         startTime = Q["startTime"]
     else:
-        Q["startTime"] = Timestamp(startTime).round(TC[binSize])
+        Q["startTime"] = Timestamp(startTime).round(TC[Q["binSize"]])
+    return startTime
+
+
+def stream_pages(
+    url,
+    Q,
+    startTime,
+    endTime=None,
+    sess=None,
+    auth=None,
+    pause: float = PAUSE_DFT,
+    workers: int = WORKERS_DFT,
+    prefetch: int = PREFETCH_DFT,
+    firstStep: int = 0,
+):
+    """
+    Return an iterator of (step, query, rep) for the pages of Q from startTime.
+
+    rep is the decoded response.  Without endTime, the pages sent by the
+    server are followed until one holds a single bin (see iter_responses),
+    else the pages up to endTime are planned and fetched, by several workers
+    if workers > 1.  All the requests wait for the rate limiter of the
+    process.
+    - prefetch : number of pages requested ahead of the consumer, in a
+    background thread (0 to do everything in the consumer's thread)
+    - firstStep : step of the first page
+    """
+    sess = init_session() if sess is None else sess
+    if endTime is None:
+        # without an end, we follow the pages sent by the server
+        pages = iter_responses(Q, sess, auth, url, endTime, pause, firstStep, startTime)
+    else:
+        plan = plan_pages(startTime, endTime, Q["binSize"], Q["count"], firstStep)
+        logging.warning(f"Plan for {Q['symbol']} {Q['binSize']}: {plan_summary(plan)}")
+        if workers > 1:
+            pages = iter_pages_concurrently(Q, plan, auth, url, pause, workers)
+        else:
+            pages = iter_pages(Q, plan, sess, auth, url, pause)
+
+    if prefetch:
+        # the next pages are requested while this one is consumed
+        pages = prefetch_pages(pages, prefetch)
+    return pages
+
+
+def open_writer(fout, symbol, binSize, resume=False, storage=STORAGE_DFT):
+    """
+    Return the writer of the pages of a download.
+
+    - storage : csv writes fout, each page confirmed in its journal.
+    parquet appends to the partitions of the symbol in the folder of fout
+    (see storage.py), binary writes in the binary file of the symbol in the
+    folder of fout (see binstore.py), compressed writes fout.zst or fout.gz
+    (see frames.py).  With those, resume continues after the last record
+    stored.
+    """
+    if storage == "parquet":
+        return ParquetStore(Path(fout).parent, symbol, binSize).writer(resume)
+    if storage == "binary":
+        return BinFile(binary_path(Path(fout).parent, symbol, binSize)).writer(resume)
+    if storage == "compressed":
+        return FramedFile(framed_path(fout)).writer(symbol, binSize, resume)
+    return PageWriter(fout, binSize, resume)
 
-    # Ready to open the file to make several requests and write results
-    with open(fout, "w") as fd:
-        Q, firstReqDate, lastReqDate = request_write_nlog(
-            Q, sess, auth, url, fd, header=True, pause=0
-        )
-        logging.debug(f"Req 0: Q={Q})")
-        logging.info(f"{firstReqDate.strftime(STRF)}:{lastReqDate.strftime(STRF)}")
 
-        i = 1
-        while not (reached(lastReqDate, endTime) or firstReqDate == lastReqDate):
-            Q, firstReqDate, lastReqDate = request_write_nlog(
-                Q, sess, auth, url, fd, step=i, startTime=lastReqDate, pause=pause
+class PageWriter:
+    """
+    Write the pages of a download in fout and confirm them in its journal.
+
+    The pages are formatted in memory and written in blocks of about
+    bufferSize bytes, each block confirmed with one journal write.  fout only
+    holds the csv header and rows, the steps are in the journal.
+    If resume and fout has a journal, the file is truncated after its last
+    confirmed page and the pages are appended from `firstStep` and
+    `nextStart`, else fout is overwritten and `nextStart` is None.
+    """
+
+    def __init__(self, fout, binSize, resume=False, bufferSize=WRITE_BUFFER_DFT):
+        """Open fout for the pages of a binSize download."""
+        self.fout = Path(fout)
+        self.journal = Journal(fout)
+        self.resuming = resume and self.journal.restore()
+        if self.resuming:
+            self.firstStep = self.journal.last["step"] + 1
+            binDelta = Timedelta(seconds=BIN_SECONDS[binSize])
+            self.nextStart = self.journal.lastTime + binDelta
+            logging.warning(
+                f"Resuming {fout} at step {self.firstStep} from {self.nextStart}."
             )
-            i += 1
+        else:
+            self.journal.reset()
+            self.firstStep, self.nextStart = 0, None
+
+        self.nreq = 0
+        self.fd = open(self.fout, "ab" if self.resuming else "wb")
+        self.bufferSize = bufferSize
+        self.offset = self.fd.tell()  # size of fout with the buffered pages
+        # also when resuming after pages all empty, nothing was written
+        self.header = not self.offset
+        self.buffer, self.pending = [], []
+
+    def write(self, step, query, rep):
+        """Buffer the response rep to query, the page step, to be written."""
+        page = StringIO()
+        firstReqDate, lastReqDate = write_response(rep, query, page, self.header, step)
+        data = page.getvalue().encode()
+        self.buffer.append(data)
+        self.offset += len(data)
+        self.pending.append((step, firstReqDate, lastReqDate, self.offset, len(rep)))
+        if self.offset - self.fd.tell() >= self.bufferSize:
+            self.flush()
+
+        if not self.nreq:
+            logging.debug(f"Req 0: Q={query})")
+            logging.info(f"{firstReqDate.strftime(STRF)}:{lastReqDate.strftime(STRF)}")
+        self.nreq += 1
+        self.header = self.header and not len(rep)
+        return firstReqDate, lastReqDate
+
+    def flush(self):
+        """Write the buffered pages in fout and confirm them in the journal."""
+        if self.buffer:
+            self.fd.write(b"".join(self.buffer))
+            self.journal.confirm(self.pending, self.fd)
+            self.buffer, self.pending = [], []
+
+    def close(self):
+        """Write the buffered pages and close fout."""
+        try:
+            self.flush()
+        finally:
+            self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_pages(Q, pages, sess, auth, url, pause=0):
+    """
+    Request the planned pages of the query Q in order and yield (step, query, rep).
 
-    # last log before exit
-    Q["startTime"], Q["endTime"] = startTime, endTime
-    logging.warning(f"Finished in {i} requests for query={Q}")
+    If the server sends less records than asked, the rest of the page is
+    requested in a new query with the same step.
+    """
+    for page in pages:
+        for _, query, rep in iter_responses(
+            page_query(Q, page), sess, auth, url, page.endTime, pause
+        ):
+            yield page.step, query, rep
+            if not len(rep):
+                # nothing at all in the window of the page
+                break
 
-    return sess
+
+def iter_pages_concurrently(Q, pages, auth, url, pause=0, workers=WORKERS_DFT):
+    """
+    Request the planned pages of Q with several workers and yield them in order.
+
+    Each worker has its own session and all share the rate limiter of the
+    process.  At most 2 * workers pages are fetched ahead of the consumer.
+    """
+    sessions = local()
+
+    def fetch(page):
+        sess = getattr(sessions, "sess", None)
+        if sess is None:
+            sess = sessions.sess = init_session()
+        return list(iter_pages(Q, [page], sess, auth, url, pause))
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        try:
+            for page in pages:
+                window.append(ex.submit(fetch, page))
+                if len(window) >= 2 * workers:
+                    yield from window.popleft().result()
+            while window:
+                yield from window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
 
 
 def request_write_nlog(
-    query, sess, auth, url, fd, header=False, pause=1, step=0, startTime=None
+    query,
+    sess,
+    auth,
+    url,
+    fd,
+    header=False,
+    pause=0,
+    step=0,
+    startTime=None,
+    limiter=None,
 ):
     """
     Make the requests and write the results in a file descriptor.
 
+    - pause : minimal time to wait before the request
+    - limiter : RateLimiter to wait for (default the one shared by the process)
     returns the query and 2 timestamps.
     """
-    logger.debug(f"Requesting {query}")
-    # pause to avoid been rejected, below 1.2 s between requests,
-    # it can be rejected by server after a few tens of requests.
-    sleep(pause)
+    query, rep = request_page(query, sess, auth, url, pause, startTime, limiter)
+    firstReqDate, lastReqDate = write_response(rep, query, fd, header, step)
+
+    return query, firstReqDate, lastReqDate
+
+
+def request_page(query, sess, auth, url, pause=0, startTime=None, limiter=None):
+    """
+    Wait for the rate limiter and request a page.
 
+    - pause : minimal time to wait before the request
+    - startTime : if given, set in the query before the request
+    - limiter : RateLimiter to wait for (default the one shared by the process)
+    returns the query and the response decoded in a ColumnBatch.
+    """
+    logger.debug(f"Requesting {query}")
     if startTime is not None:
         query["startTime"] = startTime
+
+    client = SessionClient(sess, url, auth)
     try:
-        rep = make_request(query, sess, auth, url)
-        firstReqDate, lastReqDate = get_time_window(rep)
-    except (KeyError, IndexError):
-        # Then we probably have no data for this request, we jump to next day
-        firstReqDate = Timestamp(query.get("startTime"))
-        lastReqDate = Timestamp(firstReqDate) + Timedelta("1D")
-        logmsg = (
-            f"# Empty Response: Step={step}, {firstReqDate.strftime(STRF)}"
-            f" --> {lastReqDate.strftime(STRF)}.\n"
-        )
+        rep = core.request_page(client, query, pause, limiter, decode_page)
     except Exception:
         logger.error(f"query={query}, auth={auth}, url={url}")
         raise
 
+    return query, rep
+
+
+def iter_responses(
+    query, sess, auth, url, endTime=None, pause=0, step=0, startTime=None
+):
+    """
+    Request the pages of query one after the other and yield (step, query, rep).
+
+    The pages are followed by core.iter_responses: the next page starts after
+    the last timestamp of the previous one, until endTime is reached or a
+    page holds a single timestamp.  rep is decoded in a ColumnBatch.
+    - startTime : if given, start of the first page instead of the query's
+    """
+    startTime = query["startTime"] if startTime is None else startTime
+    client = SessionClient(sess, url, auth)
+    yield from core.iter_responses(
+        client, query, startTime, endTime, pause, decode_page, step
+    )
+
+
+def response_window(rep, query):
+    """
+    Return first and last timestamps of the response rep to query.
+
+    If the response is empty they span the window the query asked for, the
+    next page starts after it.
+    """
+    try:
+        return get_time_window(rep)
+    except (KeyError, IndexError):
+        # Then we have no data for this request, we jump a whole page
+        firstReqDate = Timestamp(query.get("startTime"))
+        binDelta = Timedelta(seconds=BIN_SECONDS[query["binSize"]])
+        lastReqDate = firstReqDate + int(query.get("count", COUNT_DFT)) * binDelta
+        if query.get("endTime") is not None:
+            lastReqDate = min(lastReqDate, Timestamp(query["endTime"]))
+        return firstReqDate, lastReqDate
+
+
+def write_response(rep, query, fd, header=False, step=0):
+    """
+    Write the records of the response rep to the query in fd and log the step.
+
+    Only the csv rows go in fd, the steps are kept in the journal.
+    returns the 2 timestamps of the records, see response_window.
+    """
+    firstReqDate, lastReqDate = response_window(rep, query)
+    if not len(rep):
+        logmsg = "Empty Response: "
     else:
-        df = DataFrame(rep).set_index("timestamp")
-        df.to_csv(fd, header=header)
-        logmsg = (
-            f"# Step={step}, {firstReqDate.strftime(STRF)}"
-            f" --> {lastReqDate.strftime(STRF)}.\n"
-        )
+        if isinstance(rep, ColumnBatch):
+            fd.write(rep.to_csv(header=header))
+        else:
+            with phase("frame"):
+                df = DataFrame(rep).set_index("timestamp")
+            df.to_csv(fd, header=header)
+        logmsg = ""
 
-    fd.write(logmsg)
-    # print(logmsg, end="\r")
+    logger.debug(
+        f"{logmsg}Step={step}, {firstReqDate.strftime(STRF)}"
+        f" --> {lastReqDate.strftime(STRF)}."
+    )
 
-    return query, firstReqDate, lastReqDate
+    return firstReqDate, lastReqDate
 
 
 def reached(lastReqDate, endTime=None):
@@ -268,6 +669,12 @@ def tz_enforced(timestamp_, timezone_):
     return _timestamp
 
 
+def default_end_time(binSize, nUnit=1) -> Timestamp:
+    """Return now minus nUnit bins, rounded to the bin."""
+    timeUnit = TC[binSize]
+    return (Timestamp.now() - nUnit * Timedelta(timeUnit)).round(timeUnit)
+
+
 def parse_args():
     """Settings the applications's arguments and options."""
     parser = argparse.ArgumentParser(
@@ -294,9 +701,22 @@ def parse_args():
         "--pause",
         "-p",
         type=float,
-        help=("Minimun waiting time between 2 requests. Avoid overloading the server"),
+        help=(
+            "Minimun waiting time between 2 requests.  Requests are otherwise"
+            " throttled from the rate limit headers sent by the server"
+        ),
         default=PAUSE_DFT,
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help=(
+            "Number of concurrent downloads.  The pages of the time range are"
+            " then fetched concurrently, sharing the same rate limit"
+        ),
+        default=WORKERS_DFT,
+    )
     parser.add_argument(
         "--binSize",
         "-b",
@@ -307,8 +727,8 @@ def parse_args():
         "--startTime",
         "-s",
         help=(
-            "Start time of data collection (oldest available 2016-05-05"
-            " 04:00:00 'UTC').  Check time zones"
+            "Start time of data collection (default, the first bar available"
+            " for the symbol).  Check time zones"
         ),
         default=STARTTIME_DFT,
     )
@@ -321,12 +741,82 @@ def parse_args():
         ),
         default=ENDTIME_DFT,
     )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help=(
+            "Number of pages requested ahead while the previous ones are"
+            " written.  0 to fetch and write in turn."
+        ),
+        default=PREFETCH_DFT,
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        help=(
+            "csv writes one file, parquet appends to the partitions"
+            " <folder>/symbol=<symbol>/binSize=<binSize>/year=<year> and binary"
+            " writes in <folder>/<symbol>-<binSize>.btx.  compressed writes"
+            " the csv in zstd (or gzip) frames"
+        ),
+        default=STORAGE_DFT,
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="If present, print the number of requests and their duration and exit.",
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        action="store_true",
+        help=(
+            "If present and the output file has a journal, continue an"
+            " interrupted download instead of starting over."
+        ),
+    )
     parser.add_argument(
         "--live",
         "-l",
         action="store_true",
         help="If present use LIVE keys else bitmex testnet.",
     )
+    parser.add_argument(
+        "--metrics",
+        "-M",
+        help=(
+            "File where to write the metrics of the download: a Prometheus"
+            " textfile if it ends with .prom, else a json line is appended"
+        ),
+        default=METRICS_DFT,
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=True,
+        help=(
+            "Keep the pages of closed bins in a folder and read them from"
+            " there instead of requesting them again (default folder"
+            " ~/.cache/getBitMEXData/pages)"
+        ),
+        default=CACHE_DFT,
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="If present, read the pages from the cache only, send no request.",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=True,
+        help=(
+            "Print the time and memory peak of each phase on stderr.  If a file"
+            " is given, also write a cProfile in it, or a sampling profile if"
+            " it ends with .folded"
+        ),
+        default=PROFILE_DFT,
+    )
     parser.add_argument(
         "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
     )
@@ -352,56 +842,68 @@ def parse_args():
 def main_prg():
     """Run the main programme."""
     args = parse_args()
+    with profile_option(args.profile):
+        logger.setLevel(args.logLevel)
+        cache_option(args.cache, args.offline)
 
-    logger.setLevel(args.logLevel)
+        # use live or test ids
+        URL = URLS[args.live]
 
-    timeUnit = TC[args.binSize]
-    nUnit, tUnit = int(timeUnit[:-1]), timeUnit[-1]
-
-    startTime = (
-        Timestamp(STARTDATE_DFT[args.symbol]).round(timeUnit)
-        if args.startTime is None
-        else Timestamp(args.startTime)
-    )
-    # localising the timezone
-    startTime = startTime.tz_localize(OS_TZ)
-
-    # To avoid empty request we stop one unit befor the present date.
-    endTime = (
-        (Timestamp.now() - Timedelta(nUnit, tUnit)).round(timeUnit)
-        if args.endTime is None
-        else Timestamp(args.endTime)
-    )
+        startTime = (
+            get_start_date(f"{URL}{args.entryPoint}", args.symbol, args.binSize)
+            if args.startTime is None
+            else Timestamp(args.startTime)
+        )
+        # localising the timezone
+        if startTime.tz is None:
+            startTime = startTime.tz_localize(OS_TZ)
+
+        # To avoid empty request we stop one unit befor the present date.
+        endTime = (
+            default_end_time(args.binSize)
+            if args.endTime is None
+            else Timestamp(args.endTime)
+        )
 
-    # making_sure the format is also valid for windows
-    endTime = endTime.tz_localize(OS_TZ)  # .strftime(STRF)
+        # making_sure the format is also valid for windows
+        endTime = endTime.tz_localize(OS_TZ)  # .strftime(STRF)
 
-    query = {
-        "binSize": args.binSize,
-        "count": args.count,
-        "partial": "false",
-        "reverse": "false",
-        "symbol": args.symbol,
-    }
+        query = {
+            "binSize": args.binSize,
+            "count": args.count,
+            "partial": "false",
+            "reverse": "false",
+            "symbol": args.symbol,
+        }
 
-    _fout = Path(args.folder).joinpath(
-        f"{args.symbol}-{args.binSize}-{endTime.strftime(STRF)}"
-    )
-    # kwargs stand for key words arguments
-    kwargs = {
-        "fout": f"{_fout}",
-        "endTime": endTime,
-        "startTime": startTime,
-        "pause": args.pause,
-    }
+        _fout = Path(args.folder).joinpath(
+            f"{args.symbol}-{args.binSize}-{endTime.strftime(STRF)}"
+        )
+        # kwargs stand for key words arguments
+        kwargs = {
+            "fout": f"{_fout}",
+            "endTime": endTime,
+            "startTime": startTime,
+            "pause": args.pause,
+            "workers": args.workers,
+            "resume": args.resume,
+            "prefetch": args.prefetch,
+            "storage": args.storage,
+        }
 
-    # use live or test ids
-    URL = URLS[args.live]
+        if args.plan:
+            plan = plan_pages(startTime, endTime, args.binSize, args.count)
+            print(f"{_fout}: {plan_summary(plan)}")
+            return None
 
-    logger.warning(f"Writting data to {kwargs['folder']}")
+        logger.warning(f"Writting data to {kwargs['fout']}")
 
-    _ = get_bucketed_trades(url=f"{URL}{args.entryPoint}", Q=query, **kwargs)
-    return None
+        try:
+            _ = get_bucketed_trades(url=f"{URL}{args.entryPoint}", Q=query, **kwargs)
+        finally:
+            if args.metrics:
+                get_metrics().export(args.metrics)
+        return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of the downloads, shared by every request and job of the process.
+
+The hot path only adds to counters and histogram buckets under a lock, so
+the metrics can stay on.  They tell where the time of a slow job goes:
+- request_seconds : histogram of the latency of the http requests
+- requests, request_errors : requests sent and failed
+- response_bytes : bytes of the response bodies
+- decode_seconds : time spent decoding the responses
+- write_seconds, rows : time spent writing the pages and rows written
+- throttle_seconds : time slept waiting for the rate limiter
+- retries, backoff_seconds : requests sent again and time slept before
+- jobs, job_seconds : downloads finished and their duration
+- cache_hits, cache_misses, cache_evictions : pages read from the cache,
+  looked for in vain and removed from it (see cache.py)
+- lag_seconds : per symbol and bin size, age of the newest bar stored
+
+They are exported as json lines (one snapshot per line) or as a Prometheus
+textfile (for node_exporter's textfile collector), see export.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+
+import json
+import logging
+import os
+
+from getBitMEXData.settings import LATENCY_BUCKETS, METRICS_PREFIX
+
+logger = logging.getLogger()
+
+HELP = {
+    "request_seconds": "Latency of the http requests.",
+    "requests": "Http requests sent.",
+    "request_errors": "Http requests failed.",
+    "response_bytes": "Bytes of the response bodies.",
+    "decode_seconds": "Time spent decoding the responses.",
+    "write_seconds": "Time spent writing the pages.",
+    "rows": "Rows written.",
+    "throttle_seconds": "Time slept waiting for the rate limiter.",
+    "retries": "Requests sent again.",
+    "backoff_seconds": "Time slept before sending a request again.",
+    "jobs": "Downloads finished.",
+    "job_seconds": "Duration of the downloads.",
+    "cache_hits": "Pages read from the cache.",
+    "cache_misses": "Pages not found in the cache.",
+    "cache_evictions": "Pages removed from the cache.",
+    "lag_seconds": "Age of the newest bar stored.",
+}
+
+
+class Histogram:
+    """Counts of the values observed in buckets bounded by `bounds`."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last bucket is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the quantile q."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": dict(zip(map(str, self.bounds + ("+Inf",)), self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+            "p50": self.quantile(0.5) if self.count else None,
+            "p99": self.quantile(0.99) if self.count else None,
+        }
+
+
+class Metrics:
+    """Thread safe counters, histograms and gauges, see the module doc."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # gauges by name and labels
+        self.gauges = {}
+        self._lock = Lock()
+
+    def inc(self, name, value=1):
+        """Add value to the counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Add value to the histogram name."""
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def set(self, name, value, **labels):
+        """Set the gauge name with labels to value."""
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def timer(self, name):
+        """Add the time spent in the block to the counter name."""
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, perf_counter() - t0)
+
+    def set_lag(self, lastTime, symbol, binSize):
+        """Set the lag between now and lastTime, the newest bar stored."""
+        if lastTime is not None:
+            self.set(
+                "lag_seconds",
+                time() - lastTime.timestamp(),
+                symbol=symbol,
+                binSize=binSize,
+            )
+
+    def snapshot(self) -> dict:
+        """Return the metrics in a json serializable dict."""
+        with self._lock:
+            snapshot = {"time": time(), "pid": os.getpid(), **self.counters}
+            for name, hist in self.histograms.items():
+                snapshot[name] = hist.to_dict()
+            # a gauge is the list of its values by labels
+            for (name, labels), value in self.gauges.items():
+                snapshot.setdefault(name, []).append(dict(labels, value=value))
+            return snapshot
+
+    def to_prometheus(self, prefix=METRICS_PREFIX) -> str:
+        """Return the metrics in Prometheus text exposition format."""
+        lines = []
+
+        def head(name, kind, family=None):
+            # the counters are exposed as <name>_total, the others as is
+            family = name if family is None else family
+            lines.append(f"# HELP {prefix}_{family} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {prefix}_{family} {kind}")
+
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for (k, v) in labels) + "}"
+
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                head(name, "counter", f"{name}_total")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, hist in sorted(self.histograms.items()):
+                head(name, "histogram")
+                cumul = 0
+                for bound, count in zip(hist.bounds + ("+Inf",), hist.counts):
+                    cumul += count
+                    lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {cumul}')
+                lines.append(f"{prefix}_{name}_sum {hist.sum}")
+                lines.append(f"{prefix}_{name}_count {hist.count}")
+            gauged = None
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name != gauged:
+                    head(name, "gauge")
+                    gauged = name
+                lines.append(f"{prefix}_{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, fname):
+        """
+        Write the metrics in fname.
+
+        A .prom file is replaced by the metrics in Prometheus text format,
+        written atomically for the textfile collector, else a json line is
+        appended to fname.
+        """
+        if str(fname).endswith(".prom"):
+            tmp = f"{fname}.{os.getpid()}.tmp"
+            with open(tmp, "w") as fd:
+                fd.write(self.to_prometheus())
+            os.replace(tmp, fname)
+        else:
+            with open(fname, "a") as fd:
+                fd.write(json.dumps(self.snapshot()) + "\n")
+        logger.info(f"Metrics written in {fname}.")
+
+    def reset(self):
+        with self._lock:
+            self.counters, self.histograms, self.gauges = {}, {}, {}
+
+
+# one set of metrics for the whole process
+METRICS = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Return the metrics shared by every request and job of the process."""
+    return METRICS
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+A local mock of bitmex's trade/bucketed endpoint, to work offline.
+
+It answers the queries of getBitMEXData (binSize, symbol, startTime,
+endTime, count, reverse) with synthetic candles on the bin grid from FIRST,
+or with the candles of a recorded csv file.  It can add latency, keeps a
+rate limit bucket sent in the x-ratelimit-* headers (429 and Retry-After
+when it is empty) and can inject errors (429, 503 and 502) at random.
+GET /stats returns the number of requests, rows and errors served.
+
+python -m getBitMEXData.mockserver --port 8765 --latency 0.05
+then use http://127.0.0.1:8765/ as url with the entry point trade/bucketed.
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from pandas import Timestamp
+
+from getBitMEXData.settings import BIN_SECONDS, COUNT_MAX, LOGLEVEL_DFT
+
+logger = logging.getLogger()
+
+# first synthetic candle
+FIRST = Timestamp("2016-05-05 04:00", tz="UTC")
+ENTRYPOINT = "/trade/bucketed"
+
+
+def synthetic_candle(symbol, binSize, ns):
+    """Return a deterministic candle of symbol at the bin starting at ns."""
+    i = ns // (BIN_SECONDS[binSize] * 10**9)
+    price = 1000.0 + (i * 7919 % 1000) / 4
+    trades = i % 13
+    return {
+        "timestamp": Timestamp(ns, tz="UTC").strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "symbol": symbol,
+        "open": price,
+        "high": price + 2.5,
+        "low": price - 2.0,
+        "close": price + 0.5,
+        "trades": trades,
+        "volume": 10 * trades,
+        "vwap": price + 0.25 if trades else None,
+        "lastSize": 3 if trades else None,
+        "turnover": 12345 * trades,
+        "homeNotional": 0.01 * trades,
+        "foreignNotional": 10.0 * trades,
+    }
+
+
+def load_recorded(fname):
+    """Return the sorted timestamps (ns) and records of a csv data file."""
+    from pandas import read_csv, to_datetime
+
+    df = read_csv(fname, comment="#")
+    df = df.loc[df.timestamp != "timestamp"].drop_duplicates("timestamp")
+    stamps = to_datetime(df.timestamp, utc=True).astype("int64").tolist()
+    records = json.loads(df.to_json(orient="records"))
+    order = sorted(range(len(stamps)), key=stamps.__getitem__)
+    return [stamps[i] for i in order], [records[i] for i in order]
+
+
+class MockBitmex(ThreadingHTTPServer):
+    """The mock server and its settings, see the module doc."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency: float = 0.0,
+        limit: int = 120,
+        errors: float = 0.0,
+        recorded=None,
+        seed: int = 0,
+    ):
+        """
+        Init the server on address (port 0 for any free port).
+
+        - latency : seconds to wait before answering
+        - limit : requests allowed per minute, sent in the rate limit headers
+        - errors : probability to answer with an error
+        - recorded : csv file with the candles to serve instead of synthetic ones
+        """
+        super().__init__(address, MockHandler)
+        self.latency = latency
+        self.limit = limit
+        self.errors = errors
+        self.random = random.Random(seed)
+        self.recorded = None if recorded is None else load_recorded(recorded)
+        self.tokens, self.last = float(limit), time.monotonic()
+        self.stats = {"requests": 0, "rows": 0, "errors": 0, "limited": 0}
+        self.lock = Lock()
+
+    @property
+    def url(self) -> str:
+        """Url to use in place of bitmex's (without the entry point)."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def take_token(self):
+        """Take a token from the rate limit bucket, return the tokens left or None."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.limit, self.tokens + (now - self.last) * self.limit / 60
+            )
+            self.last = now
+            if self.tokens < 1:
+                self.stats["limited"] += 1
+                return None
+            self.tokens -= 1
+            return int(self.tokens)
+
+    def candles(self, query) -> list:
+        """Return the candles answering query."""
+        binSize = query.get("binSize", "1m")
+        symbol = query.get("symbol", "XBTUSD")
+        count = min(int(query.get("count", 100)), COUNT_MAX)
+        binNs = BIN_SECONDS[binSize] * 10**9
+        start = Timestamp(query.get("startTime", FIRST))
+        start = start.tz_localize("UTC") if start.tz is None else start
+        end = Timestamp(query["endTime"]) if "endTime" in query else Timestamp.now()
+        end = end.tz_localize("UTC") if end.tz is None else end
+        # no candle in the future
+        end = min(end.value, Timestamp.now(tz="UTC").value - binNs)
+
+        if self.recorded is not None:
+            stamps, records = self.recorded
+            i = bisect_left(stamps, start.value)
+            return [r for s, r in zip(stamps[i : i + count], records[i:]) if s <= end]
+
+        first = max(start.value, FIRST.value)
+        first = FIRST.value + -(-(first - FIRST.value) // binNs) * binNs
+        last = min(end, first + (count - 1) * binNs)
+        return [
+            synthetic_candle(symbol, binSize, ns)
+            for ns in range(first, last + 1, binNs)
+        ]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answer the requests of the MockBitmex server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            return self.send_json(200, server.stats)
+        if url.path.rstrip("/") != ENTRYPOINT:
+            return self.send_json(404, {"error": {"message": "Not Found"}})
+
+        with server.lock:
+            server.stats["requests"] += 1
+            injected = server.errors and server.random.random() < server.errors
+            status = server.random.choice((429, 503, 502)) if injected else None
+
+        remaining = server.take_token()
+        headers = {
+            "x-ratelimit-limit": str(server.limit),
+            "x-ratelimit-remaining": str(remaining or 0),
+            "x-ratelimit-reset": str(int(time.time()) + 60),
+        }
+        if remaining is None:
+            status = 429
+        if status is not None:
+            with server.lock:
+                server.stats["errors"] += 1
+            headers["retry-after"] = "1"
+            return self.send_json(status, {"error": {"message": "mock"}}, headers)
+
+        time.sleep(server.latency)
+        query = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+        candles = server.candles(query)
+        if query.get("reverse") == "true":
+            candles.reverse()
+        with server.lock:
+            server.stats["rows"] += len(candles)
+        self.send_json(200, candles, headers)
+
+
+def start_server(**kwargs) -> MockBitmex:
+    """Start a MockBitmex in a background thread and return it, see MockBitmex."""
+    server = MockBitmex(**kwargs)
+    Thread(target=server.serve_forever, name="mockbitmex", daemon=True).start()
+    return server
+
+
+def parse_args():
+    """Parse arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--port", "-p", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds before each answer"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=120, help="Requests allowed per minute"
+    )
+    parser.add_argument(
+        "--errors", type=float, default=0.0, help="Probability of an error"
+    )
+    parser.add_argument("--recorded", help="csv file of the candles to serve")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--logLevel", "-L", help="set the log level", default=LOGLEVEL_DFT
+    )
+    return parser.parse_args()
+
+
+def main_prg():
+    """Serve until interrupted."""
+    args = parse_args()
+    logging.basicConfig(level=args.logLevel)
+    server = MockBitmex(
+        ("127.0.0.1", args.port),
+        args.latency,
+        args.limit,
+        args.errors,
+        args.recorded,
+        args.seed,
+    )
+    print(f"Serving {server.url}{ENTRYPOINT[1:]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_prg()
+    sys.exit()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Yearly partitions of the csv data files.
+
+The records of a symbol in a bin size are in one csv file per year,
+<base>-<binSize>-<year>.csv (base is the folder, the prefix and the symbol),
+each with its header, the files loader.load_btxData reads.  The updater
+appends to the partition of the last year and starts the partition of the
+next year when the new records cross the new year (see
+update_kola.append_by_year).  The partitions of the past years are then
+closed: read only, they never change and can be cached or copied as is.
+
+The partitions are listed in a manifest, <base>-<binSize>.parts, json with
+for each year its file, its number of rows, the timestamps (ns) of its first
+and last records and whether it is closed.  It is rebuilt from the files and
+their index (see csvindex.py) after each update, so it stays consistent with
+them even after an interrupted one.
+
+A file of several years, named after its last record as the updater used to
+do (<base>-<binSize>-<date>.csv), is split in partitions by split_years.
+"""
+
+from pathlib import Path
+
+import json
+import logging
+import os
+import re
+import stat
+
+from getBitMEXData.core import parse_time, to_ns
+from getBitMEXData.csvindex import NOT_RECORDS, index_path, line_ns, update_index
+from getBitMEXData.settings import BUCKET_SCHEMA, PARTITIONS_EXT
+
+logger = logging.getLogger()
+
+HEADER = (",".join(BUCKET_SCHEMA) + "\n").encode()
+# <base>-<binSize>-<date>.csv, the date being a year for a partition
+NAME_PATTERN = re.compile(r"^(?P<base>.+)-(?P<binSize>[^-]+)-(?P<date>[^-]+)\.csv$")
+
+
+def parse_name(fname):
+    """Return the base (with its folder), the bin size and the date of a data file."""
+    path = Path(fname)
+    match = NAME_PATTERN.match(path.name)
+    assert match is not None, f"{fname} is not named <base>-<binSize>-<date>.csv"
+    return str(path.with_name(match["base"])), match["binSize"], match["date"]
+
+
+def is_partition(fname) -> bool:
+    """True if fname is a yearly partition, not a link nor a file of several years."""
+    return parse_name(fname)[2].isdigit() and not Path(fname).is_symlink()
+
+
+def partition_path(base, binSize, year) -> Path:
+    return Path(f"{base}-{binSize}-{year}.csv")
+
+
+def manifest_path(base, binSize) -> Path:
+    return Path(f"{base}-{binSize}{PARTITIONS_EXT}")
+
+
+def partition_files(base, binSize) -> dict:
+    """Return the partitions of base in binSize by year, in order."""
+    base = Path(base)
+    files = {}
+    for path in base.parent.glob(f"{base.name}-{binSize}-[0-9][0-9][0-9][0-9].csv"):
+        if not path.is_symlink():
+            files[int(parse_name(path)[2])] = path
+    return dict(sorted(files.items()))
+
+
+def current_partition(base, binSize):
+    """Return the partition of the last year or None."""
+    files = partition_files(base, binSize)
+    return list(files.values())[-1] if files else None
+
+
+def close_partition(path):
+    """Make the partition path read only."""
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def load_manifest(base, binSize):
+    """Return the manifest of the partitions or None."""
+    try:
+        with open(manifest_path(base, binSize)) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def refresh_manifest(base, binSize, years=None) -> dict:
+    """
+    Bring the manifest of the partitions of base up to date and return it.
+
+    - years : the partitions changed, the others are kept as they are in the
+    manifest (default, all the partitions are refreshed)
+    The index of each partition refreshed is updated (only its new rows are
+    read) and the partitions before the last year are closed.
+    """
+    files = partition_files(base, binSize)
+    manifest = None if years is None else load_manifest(base, binSize)
+    kept = {} if manifest is None else manifest["partitions"]
+    partitions = {}
+    for year, path in files.items():
+        closed = year != list(files)[-1]
+        part = kept.get(str(year))
+        if part is not None and part["closed"] == closed and year not in years:
+            partitions[str(year)] = part
+            continue
+
+        index = update_index(path)
+        if closed and os.access(path, os.W_OK):
+            logger.warning(f"Closing the partition {path}.")
+            close_partition(path)
+        partitions[str(year)] = {
+            "file": path.name,
+            "rows": index["rows"],
+            "first": index["entries"][0][0] if index["entries"] else None,
+            "last": index.get("last"),
+            "closed": closed,
+        }
+
+    manifest = {"binSize": binSize, "partitions": partitions}
+    path = manifest_path(base, binSize)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as fd:
+        json.dump(manifest, fd, indent=1)
+    os.replace(tmp, path)
+    return manifest
+
+
+def partition_years(base, binSize, startTime=None, endTime=None) -> list:
+    """
+    Return the years of the partitions with records between the times.
+
+    - startTime, endTime : datetimes or iso strings (naive in UTC) or None
+    """
+    manifest = load_manifest(base, binSize) or refresh_manifest(base, binSize)
+    startNs = None if startTime is None else to_ns(parse_time(startTime))
+    endNs = None if endTime is None else to_ns(parse_time(endTime))
+    years = []
+    for year, part in manifest["partitions"].items():
+        if part["last"] is None:
+            continue
+        if startNs is not None and part["last"] < startNs:
+            continue
+        if endNs is not None and part["first"] > endNs:
+            continue
+        years.append(int(year))
+    return years
+
+
+def split_years(fname) -> Path:
+    """
+    Split the data file fname of several years in yearly partitions.
+
+    The rows are written in order of time, without duplicates, in the
+    partitions of their year.  The links to fname (the year links of the
+    updater) are replaced by the partitions, then fname and its index are
+    removed.  Returns the partition of the last year.
+    """
+    base, binSize, _ = parse_name(fname)
+    folder = Path(fname).parent
+    tmps, fds, lastNs = {}, {}, None
+    try:
+        with open(fname, "rb") as src:
+            for line in src:
+                if not line.strip() or line.startswith(NOT_RECORDS):
+                    continue
+                ns = line_ns(line)
+                if lastNs is not None and ns <= lastNs:
+                    # repeated by an update
+                    continue
+                lastNs = ns
+                year = int(line[:4])
+                if year not in fds:
+                    tmps[year] = Path(f"{partition_path(base, binSize, year)}.tmp")
+                    fds[year] = open(tmps[year], "wb")
+                    fds[year].write(HEADER)
+                fds[year].write(line if line.endswith(b"\n") else line + b"\n")
+        for fd in fds.values():
+            fd.flush()
+            os.fsync(fd.fileno())
+    finally:
+        for fd in fds.values():
+            fd.close()
+
+    target = Path(fname).resolve()
+    links = [
+        link
+        for link in folder.glob(f"{Path(base).name}-{binSize}-*.csv")
+        if link.is_symlink() and link.resolve() == target
+    ]
+    for year in tmps:
+        path = partition_path(base, binSize, year)
+        assert (
+            path in links or not path.exists()
+        ), f"{path} already exists, can't split {fname}."
+    for link in links:
+        os.remove(link)
+    for year, tmp in tmps.items():
+        os.replace(tmp, partition_path(base, binSize, year))
+    logger.warning(f"Split {fname} in the partitions of {list(tmps)}.")
+    os.remove(fname)
+    if index_path(fname).exists():
+        os.remove(index_path(fname))
+
+    refresh_manifest(base, binSize)
+    return current_partition(base, binSize)
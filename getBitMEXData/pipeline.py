@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Producer / consumer helpers to overlap the network with the writing.
+
+`prefetch` runs an iterator of responses in a background thread so the next
+page is requested while the current one is decoded and written.  The queue
+between the two threads is bounded: when the writer falls behind, the
+producer waits (back-pressure) and the memory stays flat.
+"""
+
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+import logging
+
+from getBitMEXData.settings import PREFETCH_DFT
+
+logger = logging.getLogger()
+
+# how often (in s) a blocked thread checks if the other side has stopped
+POLL = 0.1
+
+
+class _Done:
+    """Sent by the producer when it is finished, with its error if any."""
+
+    def __init__(self, exc=None):
+        self.exc = exc
+
+
+def prefetch(iterable, depth: int = PREFETCH_DFT):
+    """
+    Yield the items of iterable, produced in a background thread.
+
+    - depth : max number of items produced ahead of the consumer.
+    An exception raised by the producer is raised again in the consumer.  If
+    the consumer stops early, the producer stops at its next item.
+    """
+    queue = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item):
+        """Put item in the queue unless the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=POLL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Done(e))
+        else:
+            put(_Done())
+
+    producer = Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            try:
+                item = queue.get(timeout=POLL)
+            except Empty:
+                if producer.is_alive():
+                    continue
+                # it may have put its last item just before exiting
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    raise RuntimeError("prefetch producer died without a word.")
+            if isinstance(item, _Done):
+                if item.exc is not None:
+                    raise item.exc
+                return
+            yield item
+    finally:
+        stop.set()
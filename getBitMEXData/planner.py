@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Plan the pages of a download before sending any request.
+
+Bucketed trades sit on a regular grid, so the pages needed to cover a time
+range can be computed up front: consecutive, non overlapping windows of at
+most COUNT_MAX bins.  Each page is a self contained query so the pages can
+be fetched in any order, by several workers, or resumed.
+"""
+
+from math import ceil
+from typing import List, NamedTuple
+
+from pandas import Timedelta, Timestamp
+
+from getBitMEXData.ratelimit import get_limiter
+from getBitMEXData.settings import BIN_SECONDS, COUNT_MAX
+
+
+class Page(NamedTuple):
+    """A page of records: its step, its first and last bins and their number."""
+
+    step: int
+    startTime: Timestamp
+    endTime: Timestamp
+    count: int
+
+
+def align(timestamp, binSize) -> Timestamp:
+    """Return the first bin of binSize at or after timestamp."""
+    timestamp = Timestamp(timestamp)
+    binDelta = Timedelta(seconds=BIN_SECONDS[binSize])
+    origin = Timestamp(0, tz=timestamp.tz)
+    return origin + ceil((timestamp - origin) / binDelta) * binDelta
+
+
+def plan_pages(
+    startTime, endTime, binSize, count: int = COUNT_MAX, firstStep: int = 0
+) -> List[Page]:
+    """
+    Return the pages covering [startTime, endTime] with binSize bins.
+
+    - count : max number of bins per page, capped to COUNT_MAX
+    - firstStep : step of the first page
+    Both bounds of a page are included and pages do not overlap.
+    """
+    count = min(int(count), COUNT_MAX)
+    binDelta = Timedelta(seconds=BIN_SECONDS[binSize])
+    pageStart, endTime = align(startTime, binSize), Timestamp(endTime)
+    pages = []
+    while pageStart <= endTime:
+        nbins = min(count, (endTime - pageStart) // binDelta + 1)
+        pageEnd = pageStart + (nbins - 1) * binDelta
+        pages.append(Page(firstStep + len(pages), pageStart, pageEnd, nbins))
+        pageStart = pageEnd + binDelta
+
+    return pages
+
+
+def page_query(Q, page: Page) -> dict:
+    """Return a copy of the query Q restricted to page."""
+    return dict(Q, startTime=page.startTime, endTime=page.endTime, count=page.count)
+
+
+def plan_summary(pages: List[Page], limiter=None) -> dict:
+    """
+    Return the number of requests and bins of the plan and its estimated duration.
+
+    The duration (in seconds) is the time the rate limiter needs to let all
+    the requests through, the network latency is not counted.
+    """
+    limiter = get_limiter() if limiter is None else limiter
+    burst = max(limiter.tokens - limiter.margin, 0)
+    duration = max(len(pages) - burst, 0) / limiter.rate
+    return {
+        "requests": len(pages),
+        "bins": sum(page.count for page in pages),
+        "duration": duration,
+    }
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling mode of the command line tools (--profile).
+
+The code marks its phases with `phase(name)`:
+- session : setting the http sessions
+- request : waiting for the http responses
+- decode : decoding the json of the responses
+- frame : building DataFrames
+- write : formatting and writing the csv (or other storage) rows
+- sleep : waiting for the rate limiter or before a retry
+- read : reading stored data (loader, last record of a file)
+When profiling is off a phase is a shared null context, nearly free.  When
+on, each phase adds up its wall time, its number of calls and the peak of
+the memory allocated while it runs (with tracemalloc).  With workers or the
+prefetch thread, the phases of several threads overlap, so their times can
+add up to more than the total.  tracemalloc has one peak for the process,
+so it is only measured for the outermost phases, started while no other
+phase runs: the allocations of the nested or overlapping phases count in
+it, and a phase never outermost has no peak.
+
+`profiled` runs a block with profiling on and prints the breakdown on
+stderr.  It can also dump a cProfile of the main thread (.prof file, read it
+with pstats or snakeviz) or a sampling profile of the main thread in
+collapsed stacks (.folded file, for flamegraph.pl or speedscope).
+"""
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from threading import Event, Lock, Thread, main_thread
+from time import perf_counter
+
+import logging
+import sys
+
+from getBitMEXData.settings import SAMPLING_INTERVAL_DFT
+
+logger = logging.getLogger()
+
+# returned by phase when profiling is off
+NULL_PHASE = nullcontext()
+
+
+class Profiler:
+    """Wall time, calls and memory peak of the phases, see the module doc."""
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        # name: [seconds, calls, peak bytes or None]
+        self.phases = {}
+        self.t0 = None
+        # phases running, in all the threads
+        self._running = 0
+        self._lock = Lock()
+
+    def start(self, memory=True):
+        """Reset the phases and start profiling, tracing the memory if memory."""
+        # imported here, not to slow down the start of the scripts
+        import tracemalloc
+
+        self.phases, self.t0, self._running = {}, perf_counter(), 0
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def stop(self):
+        """Stop profiling and return its total wall time."""
+        import tracemalloc
+
+        self.enabled = False
+        if self.memory:
+            tracemalloc.stop()
+        return perf_counter() - self.t0
+
+    def phase(self, name):
+        """Return a context manager adding the block to the phase name."""
+        return self._phase(name) if self.enabled else NULL_PHASE
+
+    @contextmanager
+    def _phase(self, name):
+        import tracemalloc
+
+        with self._lock:
+            # the peak of the process is reset by the outermost phase only
+            outermost = self.memory and not self._running
+            self._running += 1
+            if outermost:
+                current = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - t0
+            with self._lock:
+                self._running -= 1
+                stats = self.phases.setdefault(name, [0.0, 0, None])
+                stats[0] += elapsed
+                stats[1] += 1
+                if outermost:
+                    peak = tracemalloc.get_traced_memory()[1] - current
+                    stats[2] = max(stats[2] or 0, peak)
+
+    def report(self, total) -> str:
+        """Return the breakdown of the phases as a table."""
+        lines = [f"{'phase':>10} {'seconds':>10} {'%':>6} {'calls':>8} {'peak MB':>9}"]
+        for name, (seconds, calls, peak) in sorted(
+            self.phases.items(), key=lambda item: -item[1][0]
+        ):
+            peakMB = "-" if peak is None else f"{peak / 2**20:.1f}"
+            lines.append(
+                f"{name:>10} {seconds:>10.3f} {100 * seconds / total:>6.1f}"
+                f" {calls:>8} {peakMB:>9}"
+            )
+        lines.append(f"{'total':>10} {total:>10.3f} {100:>6.1f}")
+        return "\n".join(lines)
+
+
+class Sampler(Thread):
+    """Sample the stack of the main thread every interval seconds."""
+
+    def __init__(self, interval=SAMPLING_INTERVAL_DFT):
+        super().__init__(name="sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = Event()
+
+    def run(self):
+        target = main_thread().ident
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def dump(self, fname):
+        """Write the samples in collapsed stacks format."""
+        with open(fname, "w") as fd:
+            for stack, count in self.stacks.most_common():
+                fd.write(f"{stack} {count}\n")
+
+
+# one profiler for the whole process
+PROFILER = Profiler()
+
+
+def phase(name):
+    """Return a context manager adding the block to the phase name, see Profiler."""
+    return PROFILER.phase(name)
+
+
+@contextmanager
+def profiled(dump=None, memory=True):
+    """
+    Run the block with profiling on and print the breakdown of its phases.
+
+    - dump : if it ends with .folded, file where to write a sampling profile,
+    else file where to write a cProfile (default None, no dump)
+    - memory : if True, trace the memory peak of each phase (slower)
+    """
+    sampler = profiler = None
+    if dump is not None and str(dump).endswith(".folded"):
+        sampler = Sampler()
+        sampler.start()
+    elif dump is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    PROFILER.start(memory)
+    try:
+        yield PROFILER
+    finally:
+        total = PROFILER.stop()
+        if sampler is not None:
+            sampler.stop()
+            sampler.dump(dump)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        print(PROFILER.report(total), file=sys.stderr)
+        if dump is not None:
+            logger.warning(f"Profile written in {dump}.")
+
+
+def profile_option(value):
+    """
+    Return the context manager of the --profile option of the scripts.
+
+    - value : False (no profiling), True (breakdown only) or the file of the
+    dump, see profiled
+    """
+    if not value:
+        return nullcontext()
+    return profiled(None if value is True else value)
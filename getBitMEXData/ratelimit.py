@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting shared by every request made from the same process.
+
+BitMEX counts the requests in a token bucket and tells, in each response,
+how many tokens remain (x-ratelimit-remaining), when the bucket will be full
+again (x-ratelimit-reset) and, when we overdo it, how long to wait
+(Retry-After).  The RateLimiter mirrors that bucket locally: it lets requests
+go in bursts while budget remains and only slows down when it nears the limit.
+"""
+
+from threading import Lock
+from time import monotonic, sleep, time
+
+from getBitMEXData.settings import RATELIMIT_DFT, RATELIMIT_MARGIN_DFT
+
+# bitmex refills its bucket over one minute
+RATELIMIT_PERIOD = 60
+
+
+class RateLimiter:
+    """
+    A thread safe token bucket fed by bitmex rate limit headers.
+
+    `reserve` books a token and returns how long to wait before using it.
+    `update` syncs the bucket with the headers of a response.
+    """
+
+    def __init__(
+        self,
+        limit: int = RATELIMIT_DFT,
+        period: float = RATELIMIT_PERIOD,
+        margin: int = RATELIMIT_MARGIN_DFT,
+    ):
+        """
+        Init the bucket full.
+
+        - limit : number of requests allowed per period (updated by the headers)
+        - period : seconds to refill the whole bucket
+        - margin : tokens kept in reserve for the requests of other processes
+        """
+        self.limit = limit
+        self.period = period
+        self.margin = margin
+        self.tokens = float(limit)
+        self._lock = Lock()
+        self._last = monotonic()
+        self._blockedUntil = 0.0
+        self.waited = 0.0  # total of the delays returned by reserve
+
+    @property
+    def rate(self) -> float:
+        """Tokens refilled per second."""
+        return self.limit / self.period
+
+    def _refill(self, now):
+        """Add the tokens refilled since the last call.  Lock must be held."""
+        self.tokens = min(self.limit, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self) -> float:
+        """Book a token and return the time to wait (in seconds) before using it."""
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            # tokens can go negative, they are then owed to future requests
+            deficit = self.margin - self.tokens
+            delay = max(deficit / self.rate, self._blockedUntil - now, 0)
+            self.waited += delay
+        return delay
+
+    def wait(self) -> float:
+        """Sleep until a token is available and return the time slept."""
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    def update(self, headers):
+        """Sync the bucket with the rate limit headers of a response."""
+        limit = headers.get("x-ratelimit-limit")
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        retryAfter = headers.get("retry-after")
+
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            if limit is not None:
+                self.limit = int(limit)
+            if remaining is not None:
+                # our count may be late if other processes share the budget
+                self.tokens = min(self.tokens, float(remaining))
+                if int(remaining) <= 0 and reset is not None:
+                    resetIn = float(reset) - time()
+                    self._blockedUntil = max(self._blockedUntil, now + resetIn)
+            if retryAfter is not None:
+                self._blockedUntil = max(self._blockedUntil, now + float(retryAfter))
+
+
+# one limiter for the whole process
+LIMITER = RateLimiter()
+
+
+def get_limiter() -> RateLimiter:
+    """Return the rate limiter shared by every session of the process."""
+    return LIMITER
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Retries, backoff and circuit breakers for the requests sent to bitmex.
+
+A failed request is classified as retryable (timeouts, lost connections, 429
+and 5xx responses) or fatal (any other error).  Retryable ones are sent again
+after an exponential backoff with jitter.  Each endpoint has a circuit breaker
+that stops hammering it after several consecutive failures.
+"""
+
+from http.client import IncompleteRead
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+import logging
+import sys
+
+from getBitMEXData.settings import (
+    BACKOFF_BASE_DFT,
+    BACKOFF_CAP_DFT,
+    BREAKER_COOLDOWN_DFT,
+    BREAKER_THRESHOLD_DFT,
+    RETRY_TRIES_DFT,
+)
+
+logger = logging.getLogger()
+
+# http status worth a second try
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# lost connections and timeouts of the standard library (see core.py)
+RETRY_EXCEPTIONS = (ConnectionError, TimeoutError, IncompleteRead)
+
+
+def retry_exceptions() -> tuple:
+    """
+    Return the exceptions worth a second try.
+
+    Those of requests and aiohttp are added only if they are imported: an
+    exception of a library not imported can't be raised, and importing them
+    here would slow down the start of the scripts that don't use them.
+    """
+    exceptions = RETRY_EXCEPTIONS
+    rq = sys.modules.get("requests")
+    if rq is not None:
+        exceptions += (
+            rq.exceptions.ConnectionError,
+            rq.exceptions.Timeout,
+            rq.exceptions.ChunkedEncodingError,
+        )
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None:
+        exceptions += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+    return exceptions
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to an endpoint that keeps failing."""
+
+    def __init__(self, endpoint, retryAfter):
+        """Init with the endpoint and the seconds before it can be tried again."""
+        super().__init__(f"Circuit open for {endpoint}, retry in {retryAfter:.1f}s")
+        self.endpoint = endpoint
+        self.retryAfter = retryAfter
+
+
+def get_status(exc):
+    """Return the http status of the response attached to exc or None."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    # aiohttp's ClientResponseError has the status itself
+    return getattr(exc, "status", status)
+
+
+def is_retryable(exc) -> bool:
+    """True if the request that raised exc can be sent again."""
+    if isinstance(exc, CircuitOpenError):
+        return True
+    status = get_status(exc)
+    if status is not None:
+        return status in RETRY_STATUS
+    return isinstance(exc, retry_exceptions())
+
+
+class CircuitBreaker:
+    """
+    Open the circuit of an endpoint after `threshold` consecutive failures.
+
+    While open, requests fail fast with CircuitOpenError.  After `cooldown`
+    seconds one request is let through (half open): if it succeeds the
+    circuit is closed again, otherwise it stays open for another cooldown.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        threshold: int = BREAKER_THRESHOLD_DFT,
+        cooldown: float = BREAKER_COOLDOWN_DFT,
+    ):
+        """Init a closed circuit for endpoint."""
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._openUntil = None
+        self._probing = False
+        self._lock = Lock()
+
+    def allow(self):
+        """Raise CircuitOpenError if no request should be sent now."""
+        with self._lock:
+            if self._openUntil is None:
+                return
+            now = monotonic()
+            if now < self._openUntil or self._probing:
+                retryAfter = max(self._openUntil - now, 0)
+                raise CircuitOpenError(self.endpoint, retryAfter)
+            # half open, this request is the probe
+            self._probing = True
+
+    def success(self):
+        """Close the circuit."""
+        with self._lock:
+            self.failures = 0
+            self._openUntil = None
+            self._probing = False
+
+    def failure(self):
+        """Count a failure and open the circuit if there are too many."""
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                if self._openUntil is None:
+                    logger.error(f"Opening circuit for {self.endpoint}.")
+                self._openUntil = monotonic() + self.cooldown
+                self._probing = False
+
+
+class Retrier:
+    """
+    Decide if and when a failed request is retried and count the retries.
+
+    The counters are: retries (requests sent again), failures (requests
+    given up) and backoff (seconds spent waiting before retries).
+    """
+
+    def __init__(
+        self,
+        tries: int = RETRY_TRIES_DFT,
+        base: float = BACKOFF_BASE_DFT,
+        cap: float = BACKOFF_CAP_DFT,
+        threshold: int = BREAKER_THRESHOLD_DFT,
+        cooldown: float = BREAKER_COOLDOWN_DFT,
+    ):
+        """
+        Init with the backoff and circuit breaker settings.
+
+        - tries : max number of times a request is sent
+        - base, cap : the backoff before the nth retry is drawn in
+        [0, min(cap, base * 2**n)]
+        - threshold, cooldown : settings of the circuit breakers
+        """
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.stats = {"retries": 0, "failures": 0, "backoff": 0.0}
+        self._lock = Lock()
+
+    def breaker(self, endpoint) -> CircuitBreaker:
+        """Return the circuit breaker of endpoint."""
+        with self._lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    endpoint, self.threshold, self.cooldown
+                )
+            return self.breakers[endpoint]
+
+    def backoff(self, attempt: int) -> float:
+        """Return a jittered exponential backoff for the attempt (from 0)."""
+        return uniform(0, min(self.cap, self.base * 2**attempt))
+
+    def on_failure(self, exc, attempt: int, endpoint):
+        """
+        Record the failure of the attempt (from 0) on endpoint.
+
+        Returns the seconds to wait before the next attempt or None if the
+        request should be given up (fatal error or no tries left).
+        """
+        if not isinstance(exc, CircuitOpenError):
+            self.breaker(endpoint).failure()
+
+        if not is_retryable(exc) or attempt + 1 >= self.tries:
+            with self._lock:
+                self.stats["failures"] += 1
+            return None
+
+        delay = self.backoff(attempt)
+        if isinstance(exc, CircuitOpenError):
+            delay = max(delay, exc.retryAfter)
+        with self._lock:
+            self.stats["retries"] += 1
+            self.stats["backoff"] += delay
+        logger.warning(
+            f"Retry {attempt + 1}/{self.tries - 1} of {endpoint} in {delay:.1f}s"
+            f" after {exc!r}.  Stats={self.stats}"
+        )
+        return delay
+
+    def on_success(self, endpoint):
+        """Record a successful request on endpoint."""
+        self.breaker(endpoint).success()
+
+
+# one retrier, with its circuit breakers, for the whole process
+RETRIER = Retrier()
+
+
+def get_retrier() -> Retrier:
+    """Return the retrier shared by every session of the process."""
+    return RETRIER
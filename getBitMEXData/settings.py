@@ -4,20 +4,100 @@ LIVE_URL = "https://www.bitmex.com/api/v1/"
 TEST_URL = "https://testnet.bitmex.com/api/v1/"
 
 # Duration converter
-TC = {"1m": "60s", "5m": "300s", "1h": "1H", "1d": "1D"}
+TC = {"1m": "60s", "5m": "300s", "1h": "1h", "1d": "1D"}
+# same durations in seconds, for arithmetic on time ranges
+BIN_SECONDS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
 STRF = "%Y-%m-%dT%H_%M"  # default time format for saving the data
+JOURNAL_EXT = ".journal"  # extension of the progress journal of a data file
+APPEND_EXT = ".append"  # size of a csv file before an append not yet synced
+INDEX_EXT = ".idx"  # extension of the timestamp index of a csv data file
+INDEX_EVERY_DFT = 1000  # rows between two entries of the index
+PARTITIONS_EXT = ".parts"  # extension of the manifest of the yearly csv files
+TAIL_BLOCK_DFT = 1 << 13  # bytes read at once to find the last record of a file
 
 
 # the oldest date I know off but 2015-09-26 for bitmex
 # Should be in UTC
 STARTDATE_DFT = {"XBTUSD": "2016-05-05 04:00", "ADAM20": "2020-03-14"}
+# before any bitmex instrument, start of the search for the first bar
+BITMEX_EPOCH = "2014-11-22"
+# cache of the first bars found, relative to XDG_CACHE_HOME (~/.cache)
+LISTING_CACHE = "getBitMEXData/listing.json"
 
 PRICE_TICKLOG = {"XBT": 1, "ADA": 8}
 
+# fields of the trade/bucketed records, in the order sent by bitmex, and their
+# dtype.  lastSize and vwap are null for bins without trades.
+BUCKET_SCHEMA = {
+    "timestamp": "int64",
+    "symbol": "object",
+    "open": "float64",
+    "high": "float64",
+    "low": "float64",
+    "close": "float64",
+    "trades": "int64",
+    "volume": "int64",
+    "vwap": "float64",
+    "lastSize": "float64",
+    "turnover": "int64",
+    "homeNotional": "float64",
+    "foreignNotional": "float64",
+}
+
 # default arguments
 FOLDER_DFT = "./"
-COUNT_DFT = 600
-PAUSE_DFT = 1.2
+# max number of records bitmex sends in one response
+COUNT_MAX = 1000
+COUNT_DFT = COUNT_MAX
+# number of records bitmex sends when the query has no count
+COUNT_SERVER_DFT = 100
+PAUSE_DFT = 0.0
+# requests per minute allowed to unauthenticated clients, updated from the
+# x-ratelimit-* headers, and requests kept in reserve in the budget
+RATELIMIT_DFT = 30
+RATELIMIT_MARGIN_DFT = 2
+# retries of failed requests, backoff in seconds and circuit breakers
+RETRY_TRIES_DFT = 6
+BACKOFF_BASE_DFT = 1.0
+BACKOFF_CAP_DFT = 60.0
+BREAKER_THRESHOLD_DFT = 10
+BREAKER_COOLDOWN_DFT = 30.0
+WORKERS_DFT = 1
+INFLIGHT_DFT = 4
+PREFETCH_DFT = 2
+# bytes of formatted pages kept in memory before being written in one block
+WRITE_BUFFER_DFT = 1 << 20
+# storage of the candles: csv files, parquet partitions (see storage.py),
+# binary files (see binstore.py) or compressed csv files (see frames.py)
+STORAGES = ("csv", "parquet", "binary", "compressed")
+STORAGE_DFT = "csv"
+BINARY_EXT = ".btx"
+# compressed csv (see frames.py): text bytes per frame and zstd level
+FRAME_INDEX_EXT = ".fidx"
+FRAME_SIZE_DFT = 1 << 20
+ZSTD_LEVEL_DFT = 3
+PARQUET_COMPRESSION_DFT = "zstd"
+ROW_GROUP_DFT = 100_000
+# upper bounds (in seconds) of the buckets of the request latency histogram
+# and prefix of the metrics names (see metrics.py)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PREFIX = "getbitmex"
+METRICS_DFT = None
+# cache of the pages of closed bins (see cache.py), relative to
+# XDG_CACHE_HOME (~/.cache), and its size in bytes
+CACHE_DIR = "getBitMEXData/pages"
+CACHE_SIZE_DFT = 1 << 30
+CACHE_DFT = None
+# update daemon (see daemon.py): concurrent updates, seconds to wait after
+# the close of a bin, before trying again a bin not yet published or a
+# failed update and between two scans of the folder
+DAEMON_WORKERS_DFT = 4
+DAEMON_DELAY_DFT = 2.0
+DAEMON_RETRY_DFT = 10.0
+DAEMON_SCAN_DFT = 60.0
+# seconds between two samples of the sampling profiler (see profiling.py)
+SAMPLING_INTERVAL_DFT = 0.005
+PROFILE_DFT = False
 BINSIZE_DFT = "1d"
 STARTTIME_DFT = None
 ENDTIME_DFT = None
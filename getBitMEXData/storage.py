@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet storage of the downloaded candles, an alternative to the csv files.
+
+The candles of a symbol and bin size are partitioned by year, in hive style
+folders under a root folder:
+
+    <root>/symbol=XBTUSD/binSize=1m/year=2020/part-<first timestamp>.parquet
+
+The columns are typed (timestamps in ns UTC, float64 prices, int64 counts)
+and compressed.  Each download appends new part files, written in row groups
+of about ROW_GROUP_DFT rows, so nothing already stored is rewritten.  A part
+is written under a hidden name and renamed once complete.  Reading only
+touches the years and the columns asked for.
+Needs pyarrow (pip install getBitMEXData[parquet]).
+"""
+
+from pathlib import Path
+
+import logging
+import os
+
+import numpy as np
+from pandas import Timedelta, Timestamp
+
+from getBitMEXData.decode import BUCKET_SCHEMA, ColumnBatch, decode_records
+from getBitMEXData.settings import (
+    BIN_SECONDS,
+    PARQUET_COMPRESSION_DFT,
+    ROW_GROUP_DFT,
+    STRF,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = None
+
+logger = logging.getLogger()
+
+
+def arrow_schema():
+    """Return the arrow schema of the stored candles, the symbol is in the path."""
+    fields = [pa.field("timestamp", pa.timestamp("ns", tz="UTC"))]
+    for name, dtype in BUCKET_SCHEMA.items():
+        if name not in ("timestamp", "symbol"):
+            fields.append(pa.field(name, pa.from_numpy_dtype(np.dtype(dtype))))
+    return pa.schema(fields)
+
+
+class ParquetStore:
+    """The parquet partitions of symbol in binSize under root."""
+
+    def __init__(self, root, symbol, binSize, compression=PARQUET_COMPRESSION_DFT):
+        """Init the store, nothing is read or written."""
+        if pa is None:
+            raise ImportError("The parquet storage needs pyarrow, pip install pyarrow.")
+
+        self.root = Path(root)
+        self.symbol = symbol
+        self.binSize = binSize
+        self.compression = compression
+        self.path = self.root.joinpath(f"symbol={symbol}", f"binSize={binSize}")
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        """Return the store of a <root>/symbol=<symbol>/binSize=<binSize> folder."""
+        path = Path(path)
+        symbol = path.parent.name.split("=", 1)[1]
+        binSize = path.name.split("=", 1)[1]
+        return cls(path.parent.parent, symbol, binSize, **kwargs)
+
+    def partition(self, year) -> Path:
+        """Return the folder of the year partition."""
+        return self.path.joinpath(f"year={year}")
+
+    def years(self) -> list:
+        """Return the years stored, sorted."""
+        if not self.path.exists():
+            return []
+        return sorted(int(p.name.split("=")[1]) for p in self.path.glob("year=*"))
+
+    def files(self, years=None) -> list:
+        """Return the complete part files of years (default all)."""
+        years = self.years() if years is None else years
+        return [
+            f for year in years for f in sorted(self.partition(year).glob("part-*"))
+        ]
+
+    def last_timestamp(self):
+        """Return the timestamp of the last candle stored or None."""
+        years = self.years()
+        files = self.files(years[-1:])
+        if not files:
+            return None
+        stamps = ds.dataset(files, format="parquet").to_table(columns=["timestamp"])
+        return Timestamp(pc.max(stamps["timestamp"]).as_py())
+
+    def read(self, years=None, columns=None, startTime=None, endTime=None):
+        """
+        Return the candles stored in a DataFrame indexed by timestamp.
+
+        - years : list of years to read (default all)
+        - columns : the columns to read (default all, with the symbol)
+        - startTime, endTime : bounds of the timestamps to read (included)
+        A candle stored twice is returned once.
+        """
+        from pandas import DataFrame
+
+        files = self.files(years)
+        if not files:
+            return DataFrame()
+
+        schema = arrow_schema()
+        dataset = ds.dataset(files, format="parquet", schema=schema)
+        filter_ = None
+        for bound, op in ((startTime, "__ge__"), (endTime, "__le__")):
+            if bound is not None:
+                bound = Timestamp(bound)
+                bound = bound.tz_localize("UTC") if bound.tz is None else bound
+                bound = pa.scalar(bound, type=schema.field("timestamp").type)
+                cond = getattr(ds.field("timestamp"), op)(bound)
+                filter_ = cond if filter_ is None else filter_ & cond
+
+        toRead = None
+        if columns is not None:
+            toRead = ["timestamp"] + [
+                c for c in columns if c not in ("timestamp", "symbol")
+            ]
+        df = dataset.to_table(columns=toRead, filter=filter_).to_pandas()
+        df = df.set_index("timestamp").sort_index()
+        df = df.loc[~df.index.duplicated(keep="last")]
+        if columns is None or "symbol" in columns:
+            df.insert(0, "symbol", self.symbol)
+        return df
+
+    def writer(self, resume=False, rowGroup: int = ROW_GROUP_DFT):
+        """Return a StoreWriter appending candles to the store."""
+        return StoreWriter(self, resume, rowGroup)
+
+
+class StoreWriter:
+    """
+    Write the pages of a download in a ParquetStore, like main.PageWriter.
+
+    The pages are kept in memory and written by row groups of rowGroup rows
+    in a new part file per year.  The parts are complete when closed.
+    If resume and the store has candles, the download continues after the
+    last one (`nextStart`), else `nextStart` is None.
+    """
+
+    def __init__(self, store: ParquetStore, resume=False, rowGroup=ROW_GROUP_DFT):
+        """Prepare to write in store."""
+        self.store = store
+        self.rowGroup = rowGroup
+        self.firstStep, self.nextStart = 0, None
+        lastTime = store.last_timestamp() if resume else None
+        self.resuming = lastTime is not None
+        if self.resuming:
+            self.nextStart = lastTime + Timedelta(seconds=BIN_SECONDS[store.binSize])
+            logger.warning(f"Resuming {store.path} from {self.nextStart}.")
+        self.nreq = 0
+        self.batches, self.rows = [], 0
+        self.parts = {}  # year: (writer, hidden path, final path)
+
+    def write(self, step, query, rep):
+        """Buffer the response rep to query, the page step, to be written."""
+        batch = rep if isinstance(rep, ColumnBatch) else decode_records(rep)
+        if len(batch):
+            firstReqDate, lastReqDate = batch.first, batch.last
+            self.batches.append(batch)
+            self.rows += len(batch)
+        else:
+            # imported here, main uses this module
+            from getBitMEXData.main import response_window
+
+            firstReqDate, lastReqDate = response_window(rep, query)
+
+        if not self.nreq:
+            logger.info(f"{firstReqDate.strftime(STRF)}:{lastReqDate.strftime(STRF)}")
+        self.nreq += 1
+        if self.rows >= self.rowGroup:
+            self.flush()
+        return firstReqDate, lastReqDate
+
+    def flush(self):
+        """Write the buffered candles as a row group of each year they span."""
+        if not self.batches:
+            return
+
+        columns = {
+            name: np.concatenate([b.columns[name] for b in self.batches])
+            for name in self.batches[0].columns
+        }
+        self.batches, self.rows = [], 0
+
+        schema = arrow_schema()
+        stamps = columns["timestamp"]
+        years = stamps.astype("datetime64[ns]").astype("datetime64[Y]").astype(int)
+        yearList, starts = np.unique(years + 1970, return_index=True)
+        bounds = list(starts[1:]) + [len(stamps)]
+        for year, start, end in zip(yearList.tolist(), starts, bounds):
+            arrays = []
+            for field in schema:
+                values = columns[field.name][start:end]
+                if field.name == "timestamp":
+                    values = values.astype("datetime64[ns]")
+                # from_pandas turns nan in nulls, int columns may hold some
+                arrays.append(pa.array(values, from_pandas=True).cast(field.type))
+            table = pa.Table.from_arrays(arrays, schema=schema)
+            self.part(year, int(stamps[start])).write_table(table)
+
+    def part(self, year, firstStamp):
+        """Return the parquet writer of the new part of year."""
+        if year not in self.parts:
+            folder = self.store.partition(year)
+            folder.mkdir(parents=True, exist_ok=True)
+            final = folder.joinpath(f"part-{firstStamp}.parquet")
+            hidden = folder.joinpath(f".{final.name}.tmp")
+            writer = pq.ParquetWriter(
+                hidden, arrow_schema(), compression=self.store.compression
+            )
+            self.parts[year] = (writer, hidden, final)
+        return self.parts[year][0]
+
+    def close(self):
+        """Write the buffered candles and complete the parts."""
+        try:
+            self.flush()
+        finally:
+            for writer, hidden, final in self.parts.values():
+                writer.close()
+                os.replace(hidden, final)
+            self.parts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,24 +2,57 @@
 """ 
 Get les données historique de BitMex en ligne
 Will update btxDatafile with latest data
+
+The csv files are updated with the standard library only (see core.py), so
+the script starts fast when cron runs it for many files.  pandas is imported
+only for the other storages.
 """
 
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
 import argparse
-import subprocess as sp
 import logging
 import os
+import re
+import shutil
 import time
 import sys
 
-from pandas import Timestamp, Timedelta
-
-import getBitMEXData.utils as u
-from getBitMEXData.settings import LIVE_URL, TEST_URL, TC
-from getBitMEXData.main import get_bucketed_trades
-
-
-os.environ["TZ"] = "UTC"
-time.tzset()
+from getBitMEXData.core import download, from_ns, parse_time, round_time
+from getBitMEXData.settings import (
+    LIVE_URL,
+    TEST_URL,
+    APPEND_EXT,
+    BIN_SECONDS,
+    PAUSE_DFT,
+    COUNT_DFT,
+    STORAGES,
+    STORAGE_DFT,
+    METRICS_DFT,
+    PROFILE_DFT,
+    CACHE_DFT,
+)
+from getBitMEXData.cache import cache_option
+from getBitMEXData.csvindex import (
+    NOT_RECORDS,
+    is_record,
+    last_ns,
+    last_record,
+    line_ns,
+    reversed_lines,
+)
+from getBitMEXData.metrics import get_metrics
+from getBitMEXData.partitions import (
+    HEADER,
+    current_partition,
+    is_partition,
+    parse_name,
+    partition_path,
+    refresh_manifest,
+    split_years,
+)
+from getBitMEXData.profiling import phase, profile_option
 
 # {"1m": "60s", "5m": "300s", "1h": "1H", "1d": "1D"}
 
@@ -34,47 +67,59 @@ URLS = {
 
 
 def get_last_record(fullname: str) -> str:
-    """Renvois le dernier enregistrement d'un fichier btxData with fullname."""
-    # on récupère les dernières lignes du fichier
-    _lrs = sp.run(f"tail {fullname}".split(), stdout=sp.PIPE).stdout.split(b"\n")
+    """
+    Renvois le dernier enregistrement d'un fichier btxData with fullname.
 
-    # on les filtres
-    lastRecords = [lr.decode() for lr in _lrs if not lr.startswith(b"#") and len(lr)]
+    The file is read backward from its end, skipping the comments and a
+    truncated last line (see csvindex.last_record).
+    """
+    lastRecord = last_record(fullname)
 
-    assert len(
-        lastRecords
-    ), f"Vérifier qu'il y a bien des enregistrements valides dans le fichier {fullname} et qu'il ne contient pas d'espace"
+    assert lastRecord is not None, (
+        "Vérifier qu'il y a bien des enregistrements valides dans le fichier"
+        f" {fullname}"
+    )
 
-    return lastRecords[-1]
+    return lastRecord.decode()
 
 
-def get_record_date(record) -> Timestamp:
+def get_record_date(record) -> datetime:
     """
-    Get the Timestamp from the record row.
+    Get the datetime (UTC) from the record row.
 
     Keyword Arguments:
     record -- un enregistrement valid de données historique de bitmex binned en 1m
     """
-    return Timestamp(record.split(",")[0])
+    return parse_time(record.split(",")[0])
 
 
-def get_recent_record_file_date(fullname: str) -> Timestamp:
+def get_recent_record_file_date(fullname: str) -> datetime:
     """
     Get the most recent record date from fullname.
 
-    get it from the last record of the file.
+    get it from the index of the file if up to date, else from the last
+    record of the file (see csvindex.last_ns).
     Keyword Arguments:
     fullname -- nom du fichier
     """
-    return get_record_date(get_last_record(fullname))
+    lastNs = last_ns(fullname)
+
+    assert lastNs is not None, (
+        "Vérifier qu'il y a bien des enregistrements valides dans le fichier"
+        f" {fullname}"
+    )
+
+    return from_ns(lastNs)
 
 
 def get_recent_data(
-    fromdate: Timestamp,
+    fromdate: datetime,
     binsize: str = "1m",
     fout: str = "tmp.csv",
     live: bool = False,
     symbol="XBTUSD",
+    storage: str = STORAGE_DFT,
+    resume: bool = False,
 ):
     """
     Load Bitmex's data fromdate in binsize and save them in fout.
@@ -84,56 +129,168 @@ def get_recent_data(
     fout     --  fichier de sortie
     live  -- use live or test keys
     symbol -- symbol to get (XBTUSD)
+    storage -- csv, parquet or binary, then the data go in the store or the
+    binary file of the symbol in the folder of fout
+    resume -- continue after the last record in fout (compressed storage)
+
+    csv files are written by core.download, without pandas.
     """
-    # {"1m": "60s", "5m": "300s", "1h": "1H", "1d": "1D"}
     binSize = binsize
-    timeUnit = TC[binSize]
-    _, tUnit = int(timeUnit[:-1]), timeUnit[-1]
-
     startTime = fromdate
-    endTime = (Timestamp.now() - Timedelta(2, tUnit)).round(timeUnit)
+    endTime = round_time(
+        datetime.now(timezone.utc) - timedelta(seconds=2 * BIN_SECONDS[binSize]),
+        binSize,
+    )
 
     query = {
         "binSize": binSize,
-        "count": 600,
+        "count": COUNT_DFT,
         "partial": "false",
         "reverse": "false",
         # need to get the symbol from records too or from file name
         "symbol": symbol,
     }
-    kwargs = {"endTime": endTime, "fout": fout, "pause": 1.2, "startTime": startTime}
+    kwargs = {
+        "endTime": endTime,
+        "fout": fout,
+        "pause": PAUSE_DFT,
+        "startTime": startTime,
+        "storage": storage,
+        "resume": resume,
+    }
 
     # use live or test ids
     URL = URLS[live]
     URL = URL + "trade/bucketed"
     logger.warning(f"{URL}, {query}, {kwargs}")
+    if storage == "csv":
+        return download(URL, query, fout, startTime, endTime, PAUSE_DFT)
+
+    from getBitMEXData.main import get_bucketed_trades
+
     sess = get_bucketed_trades(URL, Q=query, **kwargs)
     return sess
 
 
 def update_file(
-    fname: str, fout: str = "./tmp.csv", live: bool = False, prefix: str = "str"
+    fname: str,
+    fout: str = "./tmp.csv",
+    live: bool = False,
+    prefix: str = "str",
+    storage: str = STORAGE_DFT,
 ):
     """
     Write the fname updated with new data.
 
     Keyword Arguments:
-    fname -- name of the file to update. should be name btxData-{freq}-{lastudpatedate}.csv
+    fname -- name of the file to update. should be name btxData-{freq}-{year}.csv
+    (or btxData-{freq}-{lastudpatedate}.csv, then split in yearly partitions)
     live -- use live price else test
     prefix -- prefix of fname before the symbol
+    storage -- csv, parquet then fname is the folder of a parquet store (see
+    update_store), binary then fname is a binary file (see update_binary)
+    or compressed then fname is a compressed csv file (see update_compressed)
 
     Get the freq (ie bin size) from the file name.
     Download new data in tmp.csv
-    Append tmp.csv to original file but update the name with last updatedate
+    Append tmp.csv to the partition of the last year, or start the next ones
+    (see append_by_year).  Returns the partition of the last year.
     """
+    if storage == "parquet":
+        return update_store(fname, live)
+    if storage == "binary":
+        return update_binary(fname, live)
+    if storage == "compressed":
+        return update_compressed(fname, live)
+
     # get
-    oldDate = get_recent_record_file_date(fname)
+    with phase("read"):
+        fname = as_partition(fname)
+        oldDate = get_recent_record_file_date(fname)
     binSize = get_fname_binsize(fname)
     symbol = get_fname_symbol(fname, prefix)
     # download data in fout
     get_recent_data(oldDate, binSize, fout, live)
-    concat_files(fname, fout, removetmp=True)
-    return update_name(fname)
+    with phase("write"):
+        return append_by_year(fname, fout, removetmp=True)
+
+
+def update_store(path: str, live: bool = False):
+    """
+    Append the new data to a parquet store.
+
+    Keyword Arguments:
+    path -- folder <root>/symbol=<symbol>/binSize=<binSize> of the store
+    live -- use live price else test
+
+    Nothing is rewritten, the new records go in new parts of the store.
+    """
+    from getBitMEXData.storage import ParquetStore
+
+    store = ParquetStore.from_path(path)
+    lastTime = store.last_timestamp()
+    assert lastTime is not None, f"Nothing in {path} to update."
+    fromdate = lastTime + timedelta(seconds=BIN_SECONDS[store.binSize])
+    fout = store.root.joinpath("tmp.csv")
+    return get_recent_data(
+        fromdate, store.binSize, fout, live, store.symbol, storage="parquet"
+    )
+
+
+def update_binary(fname: str, live: bool = False):
+    """
+    Write the new data in the binary file fname.
+
+    Keyword Arguments:
+    fname -- binary file <symbol>-<binSize>.btx, see getBitMEXData.binstore
+    live -- use live price else test
+
+    The symbol and the bin size are read from the header of the file.
+    """
+    from getBitMEXData.binstore import BinFile
+
+    binFile = BinFile(fname)
+    lastTime = binFile.last_timestamp()
+    assert lastTime is not None, f"Nothing in {fname} to update."
+    fout = binFile.path.parent.joinpath("tmp.csv")
+    return get_recent_data(
+        lastTime + binFile.binDelta,
+        binFile.binSize,
+        fout,
+        live,
+        binFile.symbol,
+        storage="binary",
+    )
+
+
+def update_compressed(fname: str, live: bool = False):
+    """
+    Append the new data to the compressed csv file fname in new frames.
+
+    Keyword Arguments:
+    fname -- .zst or .gz file written with the compressed storage
+    live -- use live price else test
+
+    The symbol and the bin size are read from the frame index of the file.
+    The frames already written are not touched.  The file keeps its name as
+    it grows over the years, the loader finds it by the timestamps of its
+    frames (see frames.framed_files).
+    """
+    from getBitMEXData.frames import FramedFile
+
+    framed = FramedFile(fname)
+    lastTime = framed.last_timestamp()
+    assert lastTime is not None, f"Nothing in {fname} to update."
+    binSize = framed.index["binSize"]
+    return get_recent_data(
+        lastTime + timedelta(seconds=BIN_SECONDS[binSize]),
+        binSize,
+        fname,
+        live,
+        framed.index["symbol"],
+        storage="compressed",
+        resume=True,
+    )
 
 
 def get_fname_symbol(fname: str, prefix: str = "btx"):
@@ -141,66 +298,231 @@ def get_fname_symbol(fname: str, prefix: str = "btx"):
     return fname.split("-")[0].split(prefix)[1]
 
 
-def update_name(fname: str):
+def get_fname_binsize(fname: str) -> str:
+    """If the name is {base}-{binsize}-{date}.csv return the binsize."""
+    return Path(fname).name.split("-")[1]
+
+
+def get_fname_basename(fname: str) -> str:
+    """Return the {base} (with its folder) of {base}-{binsize}-{date}.csv."""
+    path = Path(fname)
+    return str(path.with_name(path.name.split("-")[0]))
+
+
+def find_data_files(folder=".", prefix: str = "") -> dict:
     """
-    Keyword Arguments:
-    fname -- name of the file to update
+    Return the csv data files of folder by (symbol, binSize).
 
-    Returns: updates the name of the file with date of the last record in it
-    "fout": f"{args.fout}-{args.binSize}-{endTime}.csv"""
-    newDate = get_recent_record_file_date(fname).strftime("%Y%m%dT%H:%M")
-    simpDate = get_recent_record_file_date(fname).strftime("%Y")
-    binSize = get_fname_binsize(fname)
-    baseName = get_fname_basename(fname)
-    newName = f"{baseName}-{binSize}-{newDate}.csv"
-    simpName = f"{baseName}-{binSize}-{simpDate}.csv"
-    logger.warning(f"Renaming {fname} -> {newName}\n" f"Updating link {simpName}")
-    os.rename(fname, newName)
+    The files are named {prefix}{symbol}-{binsize}-{date}.csv.  The links
+    (eg. to the file of the year) are skipped and if a symbol and bin size
+    has several files, the one modified last is kept.
+    """
+    pattern = re.compile(
+        rf"^{re.escape(prefix)}(?P<symbol>[^-]+)"
+        rf"-(?P<binSize>{'|'.join(BIN_SECONDS)})-[^-]+\.csv$"
+    )
+    files, mtimes = {}, {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match is None or entry.is_symlink() or not entry.is_file():
+                continue
+            key = (match["symbol"], match["binSize"])
+            mtime = entry.stat().st_mtime
+            if mtime > mtimes.get(key, -1):
+                files[key], mtimes[key] = entry.path, mtime
+    return files
+
+
+def append_path(fname: str) -> str:
+    """Return the path of the append journal of fname."""
+    return f"{fname}{APPEND_EXT}"
+
+
+def recover_append(fname: str) -> bool:
+    """
+    Roll back fname to its size before an append interrupted before its sync.
+
+    Returns True if fname was rolled back.
+    """
     try:
-        os.remove(simpName)
+        with open(append_path(fname)) as fd:
+            size = int(fd.read())
     except FileNotFoundError:
-        pass
+        return False
+    except ValueError:
+        # the journal itself was not synced, so nothing was appended
+        os.remove(append_path(fname))
+        return False
 
-    os.symlink(newName, simpName)
+    logger.warning(f"Rolling back an interrupted append to {fname}.")
+    os.truncate(fname, size)
+    os.remove(append_path(fname))
+    return True
 
-    return
 
+def first_new_row(fd, lastNs) -> int:
+    """
+    Return the offset of the first record of fd after lastNs.
 
-def get_fname_binsize(fname: str) -> str:
-    """If the name is {base}-{binsize}-{date}.csv return the binsize."""
-    return fname.split("-")[1]
+    The header, the comments and the rows already in the file updated (the
+    download starts at its last record) are skipped.
+    """
+    offset = fd.tell()
+    for line in iter(fd.readline, b""):
+        if line.strip() and not line.startswith(NOT_RECORDS):
+            if lastNs is None or line_ns(line) > lastNs:
+                break
+        offset += len(line)
+    return offset
 
 
-def get_fname_basename(fname: str) -> str:
-    """If the name is {base}-{binsize}-{date}.csv return the basename."""
-    return fname.split("-")[0]
+def copy_range(src, dst, offset: int, count: int):
+    """
+    Write count bytes of src from offset at the position of dst.
+
+    The bytes are copied by the kernel with copy_file_range or sendfile when
+    the system has them, else through a buffer.
+    """
+    dst.flush()
+    for copy in ("copy_file_range", "sendfile"):
+        if count <= 0 or not hasattr(os, copy):
+            continue
+        try:
+            while count > 0:
+                if copy == "copy_file_range":
+                    sent = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+                else:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+                if not sent:
+                    break
+                offset, count = offset + sent, count - sent
+        except OSError as e:
+            # eg. not supported between these file systems
+            logger.debug(f"{copy} failed ({e}), falling back.")
+        else:
+            dst.seek(0, os.SEEK_END)
+            return
+    src.seek(offset)
+    dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst)
+
+
+def append_range(fname: str, src, start: int, count: int):
+    """
+    Append count bytes of src from start to fname, with a journal.
+
+    The size of fname is journaled before the append and the journal removed
+    once fname is synced: an interrupted append is rolled back by
+    recover_append.
+    """
+    with open(fname, "r+b") as dst:
+        size = dst.seek(0, os.SEEK_END)
+        with open(append_path(fname), "w") as jd:
+            jd.write(str(size))
+            jd.flush()
+            os.fsync(jd.fileno())
+
+        # a last line without its end of line is completed or dropped
+        tail = next(reversed_lines(dst))
+        dst.seek(0, os.SEEK_END)
+        if is_record(tail.strip()):
+            dst.write(b"\n")
+        elif tail:
+            logger.warning(f"Dropping the truncated last line of {fname}.")
+            dst.truncate(size - len(tail))
+            dst.seek(0, os.SEEK_END)
+
+        copy_range(src, dst, start, count)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.remove(append_path(fname))
+
+
+def year_segments(fd, start: int) -> list:
+    """Return the [year, first byte, end byte] of each year in fd from start."""
+    fd.seek(start)
+    segments, offset = [], start
+    for line in iter(fd.readline, b""):
+        if line.strip() and not line.startswith(NOT_RECORDS):
+            year = int(line[:4])
+            if not segments or segments[-1][0] != year:
+                segments.append([year, offset, offset])
+        offset += len(line)
+        if segments:
+            segments[-1][2] = offset
+    return segments
+
+
+def new_partition(path, src, start: int, count: int):
+    """Write the partition path with the header and count bytes of src from start."""
+    tmp = Path(f"{path}.tmp")
+    with open(tmp, "w+b") as dst:
+        dst.write(HEADER)
+        copy_range(src, dst, start, count)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, path)
+    logger.warning(f"Starting the partition {path}.")
+
+
+def as_partition(fname: str) -> str:
+    """
+    Return the partition of the last year of the data of fname.
+
+    fname can be any partition, a link to one or a file of several years,
+    split first (see partitions.split_years).
+    """
+    path = Path(fname).resolve() if Path(fname).is_symlink() else Path(fname)
+    recover_append(path)
+    if not is_partition(path):
+        path = split_years(path)
+    path = current_partition(*parse_name(path)[:2])
+    recover_append(path)
+    return str(path)
 
 
-def concat_files(file1: str, file2: str, removetmp: bool = False):
+def append_by_year(fname: str, file2: str, removetmp: bool = False) -> str:
     """
-    Write a file fname which is the concatenation of file1 and file2.
+    Append the new records of file2 to the yearly partitions of fname.
 
     Keyword Arguments:
-    file1 -- first file (to be on the top)
-    file2 -- second or tail fail
-    Files should have the same format
-    concat file 2 at the end of file 1
-    removeoriginal (False) -- should we remove file1 and 2 after concatenation
+    fname -- the partition of the last year (see as_partition)
+    file2 -- downloaded file, with a header
+    removetmp (False) -- should we remove file2 after the append
+
+    The header of file2 and its rows up to the last record of fname are
+    skipped, so the bar where the download restarted is not repeated.  The
+    appends are journaled, see append_range.  The rows of fname's year are
+    appended to it and the rows of each next year start a new partition,
+    closing the previous one (see getBitMEXData.partitions).  The index of
+    the partitions and their manifest are updated.
+    Returns the partition of the last year.
     """
-    # pb this erased data
-    my_cmd = ["tail", "-n", "+2", file2]
-    with open(file1, "a") as f:
-        _ = sp.run(my_cmd, stdout=f)
+    recover_append(fname)
+    base, binSize, year = parse_name(fname)
+    lastNs = last_ns(fname)
+    years = {int(year)}
+    with open(file2, "rb") as src:
+        start = first_new_row(src, lastNs)
+        for year, first, end in year_segments(src, start):
+            path = partition_path(base, binSize, year)
+            if path.exists():
+                append_range(path, src, first, end - first)
+            else:
+                new_partition(path, src, first, end - first)
+            years.add(year)
+
+    refresh_manifest(base, binSize, years)
     if removetmp:
         logger.warning(f"Removing {file2}.")
-        return sp.run(f"rm {file2}".split(), stdout=sp.PIPE)
-    else:
-        return _
+        os.remove(file2)
+    return str(current_partition(base, binSize))
 
 
-def main(fname: str, live: bool, prefix: str):
+def main(fname: str, live: bool, prefix: str, storage: str = STORAGE_DFT):
     """Update the btxData file fname with latest data."""
-    update_file(fname, live=live, prefix=prefix)
+    update_file(fname, live=live, prefix=prefix, storage=storage)
 
 
 def parse_args():
@@ -217,8 +539,7 @@ def parse_args():
     parser.add_argument(
         "--fname",
         "-f",
-        help
-        == (
+        help=(
             "name of the file to update.  if None takes the latest"
             " btxDatafile in current directory"
         ),
@@ -229,6 +550,58 @@ def parse_args():
         "--live", "-l", action="store_true", help="If present use live historic data"
     )
 
+    parser.add_argument(
+        "--storage",
+        choices=STORAGES,
+        help=(
+            "With parquet, fname is the folder"
+            " <root>/symbol=<symbol>/binSize=<binSize> of the store to update,"
+            " with binary the <symbol>-<binSize>.btx file to update and with"
+            " compressed the .zst or .gz file to update"
+        ),
+        default=STORAGE_DFT,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        "-M",
+        help=(
+            "File where to write the metrics of the update: a Prometheus"
+            " textfile if it ends with .prom, else a json line is appended"
+        ),
+        default=METRICS_DFT,
+    )
+
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=True,
+        help=(
+            "Keep the pages of closed bins in a folder and read them from"
+            " there instead of requesting them again (default folder"
+            " ~/.cache/getBitMEXData/pages)"
+        ),
+        default=CACHE_DFT,
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="If present, read the pages from the cache only, send no request.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=True,
+        help=(
+            "Print the time and memory peak of each phase on stderr.  If a file"
+            " is given, also write a cProfile in it, or a sampling profile if"
+            " it ends with .folded"
+        ),
+        default=PROFILE_DFT,
+    )
+
     parser.add_argument("--logLevel", "-L", help=f"Set logLevel", default="INFO")
 
     return parser.parse_args()
@@ -238,18 +611,25 @@ def main_prg():
     """Main program."""
     args = parse_args()
     logger = logging.getLogger(args.logLevel)
+    os.environ["TZ"] = "UTC"
+    time.tzset()
 
     if args.fname is None:
-
-        def fcond(f):
-            return u.fcond(f, pat=r"btxData.*csv$")
-
-        fname = u.get_cond_recent_file(fcond=fcond)
+        # the data file modified last in the current directory
+        fnames = find_data_files().values()
+        assert fnames, "No {symbol}-{binsize}-{date}.csv file to update here."
+        fname = max(fnames, key=os.path.getmtime)
     else:
         fname = args.fname
 
     logger.warning(f"Running {'Live' if args.live else 'Test'} with {fname}")
-    main(fname, args.live, args.prefix)
+    cache_option(args.cache, args.offline)
+    try:
+        with profile_option(args.profile):
+            main(fname, args.live, args.prefix, args.storage)
+    finally:
+        if args.metrics:
+            get_metrics().export(args.metrics)
 
 
 if __name__ == "__main__":
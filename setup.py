@@ -28,6 +28,8 @@ setup(
         "console_scripts": [
             "get_bitmex_data=getBitmexData.main:main_prg",
             "update_bitmex_data=getBitmexData.update_kola:main_prg",            
+            "get_bitmex_batch=getBitMEXData.batch:main_prg",
+            "update_bitmex_daemon=getBitMEXData.daemon:main_prg",
         ]
     },
     install_requires=[
@@ -40,6 +42,9 @@ setup(
         'dev': ['mypy', 'flake8', 'black'],
         'packaging': ['twine'],
         "test": ['pytest', 'hypothesis'],
+        "async": ['aiohttp'],
+        "parquet": ['pyarrow'],
+        "zstd": ['zstandard'],
     },
     classifiers=[
         "Development Status :: 4 - Beta",